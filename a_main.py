@@ -1,50 +1,101 @@
+"""
+Vocal Weather App - command line :
+=====================
 
-from b_service_azure_speech import recognize_from_microphone
-from c_service_ner import extract_city, extract_horizon
-from d_service_geocoding import city_to_coordinates
-from e_service_weather_forecast import weather_forecast_from_coord
-from f_service_db_storage import connect_to_db, save_to_database, read_from_database
+python a_main.py                      : vocal command from the microphone, forecast and storage into the DB
+python a_main.py --text "la météo à Tours demain" : fast-start mode, NER and forecast only (no speech nor DB import)
+python a_main.py --import-report      : import time of the services (python -X importtime summary)
+"""
 
+import argparse
 
-# Part 1 - Vocal command
-#text_input = 'quelle est la météo à tours pour les 3 prochains jours'
-print("==== PART 1 : Vocal command ====================")
-text_input = recognize_from_microphone()
-print(f"Reconnaissande de l'audio - Statut : {text_input['speech_info']}")
-print(f"La transcription de l'audio est : {text_input['speech_text']}")
+from g_pipeline_orchestrator import run_pipeline
 
 
-# Part 2 - NLP NER
-# To be done : improve horizon extraction
-print("==== PART 2 - NLP NER ====================")
-city_input = extract_city(text = text_input['speech_text'])
-print(f"Extraction de la ville à partir de l'audio - Statut : {city_input['city_extracted_info']}")
-print(f"La ville extraite de l'audio est : {city_input['city_extracted']}")
+def main(text=None):
 
-horizon_input = extract_horizon(text = text_input['speech_text'])
-print(f"Extraction de l'horizon à partir de l'audio - Statut : {horizon_input['horizon_extracted_info']}")
-print(f"L'horizon des prévision est : {horizon_input['horizon_extracted']}")
+    # Part 0 - Warm up of the NLP models (loaded once for the whole process)
+    from c_service_ner import warm_up_models
+    print("==== PART 0 : Warm up of the NLP models ====================")
+    for model_name, model_metrics in warm_up_models().items():
+        print(f"Modèle {model_name} chargé en {model_metrics['load_time_s']:.2f} s ({model_metrics['memory_mb']:.0f} Mo) - Pipeline : {model_metrics['pipeline']}")
 
 
-# Part 3 - Geocoding from API
-print("==== PART 3 - Geocoding from API ====================")
-coord_input = city_to_coordinates(city = city_input['city_extracted'])
-print(f"Geocoding à partir de l'audio - Statut : {coord_input['geocoding_info']}")
-print(f"Les coordonnées de la ville de {coord_input['city']} sont : lat={coord_input['lat']} & lon={coord_input['lon']}")
+    # Part 1 - Vocal command
+    #text_input = 'quelle est la météo à tours pour les 3 prochains jours'
+    print("==== PART 1 : Vocal command ====================")
+    if text is None:
+        from b_service_azure_speech import recognize_from_microphone
+        text_input = recognize_from_microphone()
+    else:
+        # Fast-start mode : the text is given, the speech service is not imported
+        text_input = {'speech_text' : text,
+                      'speech_info' : "Successed"}
+    print(f"Reconnaissande de l'audio - Statut : {text_input['speech_info']}")
+    print(f"La transcription de l'audio est : {text_input['speech_text']}")
 
 
-# Part 4 - Weather forecast from API
-print("==== PART 4 - Weather forecast from API ====================")
-meteo_input = weather_forecast_from_coord(lat=coord_input['lat'], lon=coord_input['lon'], horizon=[horizon_input['horizon_extracted'] if horizon_input['horizon_extracted'] is not None else None])
-print(f"Prévision météo à partir de l'audio - Statut : {meteo_input['weather_info']}")
+    # Parts 2 to 5 run concurrently : city and horizon together, geocoding as soon as the city is known,
+    # the storage into the DB in the background (see g_pipeline_orchestrator), not in fast-start mode
+    pipeline_output = run_pipeline(speech = text_input, persist = text is None)
+    city_input = pipeline_output['city']
+    quality_input = pipeline_output['quality']
+    horizon_input = pipeline_output['horizon']
+    coord_input = pipeline_output['geocoding']
+    meteo_input = pipeline_output['weather']
 
 
-# Part 5 - Data storage into Azure DB for monitoring
-print("==== PART 5 - Data storage into Azure DB for monitoring ====================")
-save_to_database(speech = text_input,
-                 city = city_input,
-                 horizon = horizon_input,
-                 geocoding = coord_input,
-                 weather = meteo_input)#(meteo_input['weather_info'], meteo_input['weather_data']))
+    # Part 2 - NLP NER
+    # To be done : improve horizon extraction
+    print("==== PART 2 - NLP NER ====================")
+    print(f"Extraction de la ville à partir de l'audio - Statut : {city_input['city_extracted_info']}")
+    print(f"La ville extraite de l'audio est : {city_input['city_extracted']}")
 
-read_from_database()
\ No newline at end of file
+    print(f"Contrôle qualité de la commande - Décision : {quality_input['quality_decision']} ({quality_input['quality_reason']})")
+    if quality_input['quality_decision'] == "reprompt":
+        # Nothing was spent on the horizon, the geocoding and the forecast
+        print("Commande non comprise : merci de répéter la ville et l'horizon de la prévision.")
+
+    print(f"Extraction de l'horizon à partir de l'audio - Statut : {horizon_input['horizon_extracted_info']}")
+    print(f"L'horizon des prévision est : {horizon_input['horizon_extracted']}")
+
+
+    # Part 3 - Geocoding from API
+    print("==== PART 3 - Geocoding from API ====================")
+    print(f"Geocoding à partir de l'audio - Statut : {coord_input['geocoding_info']}")
+    print(f"Les coordonnées de la ville de {coord_input['city']} sont : lat={coord_input['lat']} & lon={coord_input['lon']}")
+
+
+    # Part 4 - Weather forecast from API
+    print("==== PART 4 - Weather forecast from API ====================")
+    print(f"Prévision météo à partir de l'audio - Statut : {meteo_input['weather_info']}")
+    print(f"Durée des étapes (s) : { {stage: round(duration, 3) for stage, duration in pipeline_output['timings'].items()} }")
+
+
+    # Part 5 - Data storage into Azure DB for monitoring
+    if text is None:
+        from f_service_db_storage import get_monitoring_writer, read_from_database
+        print("==== PART 5 - Data storage into Azure DB for monitoring ====================")
+        # The record is read just after : wait for the background storage and flush the writer
+        pipeline_output['storage'].result()
+        get_monitoring_writer().flush()
+
+        read_from_database()
+
+    return pipeline_output
+
+
+# Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Vocal Weather App - command line")
+    parser.add_argument("--text", default=None, help="text of the command : skips the speech-to-text and the DB storage")
+    parser.add_argument("--import-report", action="store_true", help="print the import time of the services and exit")
+    args = parser.parse_args()
+
+    if args.import_report:
+        from j_lazy_import import print_import_time_report
+        print_import_time_report(["b_service_azure_speech", "c_service_ner", "d_service_geocoding",
+                                  "e_service_weather_forecast", "f_service_db_storage", "g_pipeline_orchestrator"])
+    else:
+        main(text=args.text)
@@ -21,24 +21,152 @@ From : Nino Dakov on Github
 """
 
 import streamlit as st
-import pandas as pd
-import requests
-import json
-from plotly.subplots import make_subplots
-import plotly.graph_objs as go
+import streamlit.components.v1 as components
+import uuid
 from datetime import datetime
 from datetime import timezone as tmz
 #import pytz
 #from tzwhere import tzwhere
-import folium
-from streamlit_folium import folium_static
 
 # Internal services for serving app data
-from b_service_azure_speech import recognize_from_microphone
-from c_service_ner import extract_city, extract_horizon
+from b_service_azure_speech import recognize_from_microphone, recognize_from_audio_bytes
+from c_service_ner import warm_up_models
 from d_service_geocoding import city_to_coordinates
-from e_service_weather_forecast import weather_forecast_from_coord
-from f_service_db_storage import connect_to_db, save_to_database, read_from_database
+from e_service_weather_forecast import (DISPLAY_VARIABLES, get_openmeteo_client, plan_expiry, plan_forecast,
+                                        weather_forecast_from_coord)
+from f_service_db_storage import get_connection_pool
+from g_pipeline_orchestrator import run_pipeline
+from k_job_prewarm import start_prewarmer
+from m_service_tracing import start_metrics_server
+from o_service_quality import horizon_out_of_range
+# Rendering libraries (Plotly, Folium) are imported on the first chart, not needed before the first vocal command
+from p_service_rendering import MAP_HEIGHT, build_weather_figure, build_weather_map, figure_with_now
+from streamlit_mic_recorder import mic_recorder
+
+
+# Heavy resources are created once per process and shared by every session and rerun ----------------
+@st.cache_resource
+def load_nlp_models():
+    return warm_up_models()
+
+@st.cache_resource
+def load_openmeteo_client():
+    return get_openmeteo_client()
+
+@st.cache_resource
+def load_db_pool():
+    return get_connection_pool()
+
+# The forecasts of the most requested cities are refreshed after each model run into the caches of this process
+@st.cache_resource
+def load_prewarmer():
+    return start_prewarmer()
+
+# Latency of the stages for Prometheus on http://127.0.0.1:9108/metrics (the port may be taken by another app process)
+@st.cache_resource
+def load_metrics_server():
+    try:
+        return start_metrics_server()
+    except OSError as error:
+        print(f"Metrics server not started : {error}")
+        return None
+
+load_nlp_models()
+load_openmeteo_client()
+load_db_pool()
+load_prewarmer()
+load_metrics_server()
+
+
+# Geocoding and forecast are memoised : the same (city, horizon) is not requested again before the TTL
+# The failures are raised in the cached functions (Streamlit does not cache them) and returned by the wrappers :
+# a failed geocoding or forecast (timeout, service down, unknown city) is asked again on the next command
+# timeout : seconds left to the stage of the pipeline (not part of the cache key)
+# _computed : filled when the cached function runs, empty on a hit of the Streamlit cache (not part of the cache key)
+class ServiceFailed(Exception):
+    """Failed output of a service, raised in a cached function so that the failure is not cached."""
+
+    def __init__(self, output, info_key):
+        super().__init__(output[info_key])
+        self.output = output
+
+@st.cache_data(ttl=24 * 3600, show_spinner=False)
+def _cached_coordinates(city, _timeout=None, _computed=None):
+    _computed.append(True)
+    coord_input = city_to_coordinates(city = city, timeout = _timeout)
+    if coord_input['lat'] is None:
+        raise ServiceFailed(coord_input, 'geocoding_info')
+    return coord_input
+
+def cached_city_to_coordinates(city, timeout=None):
+    computed = []
+    try:
+        coord_input = _cached_coordinates(city, _timeout=timeout, _computed=computed)
+    except ServiceFailed as error:
+        return error.output
+    # No layer of the geocoding service was asked : the source is the cache of the app
+    return coord_input if computed else dict(coord_input, geocoding_source="app_cache")
+
+# Only the days asked and the variables shown are requested (see the query planner of the forecast service)
+# forecast_run : publication time of the next model run, a new run gives new keys
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def _cached_forecast(lat, lon, horizon, window, forecast_run, _timeout=None, _computed=None):
+    _computed.append(True)
+    weather_input = weather_forecast_from_coord(lat=lat,
+                                                lon=lon,
+                                                horizon=horizon,
+                                                variables=DISPLAY_VARIABLES,
+                                                window=window,
+                                                timeout=_timeout)
+    if weather_input['weather_info'] != "Successed":
+        raise ServiceFailed(weather_input, 'weather_info')
+    return weather_input
+
+def cached_weather_forecast(lat, lon, horizon, window, forecast_run, timeout=None):
+    computed = []
+    try:
+        weather_input = _cached_forecast(lat, lon, horizon, window, forecast_run, _timeout=timeout, _computed=computed)
+    except ServiceFailed as error:
+        return error.output
+    return weather_input if computed else dict(weather_input, weather_cache_hit=True)
+
+
+# Rendering artefacts by (coordinates, horizon, forecast run) : a repeated view reuses the figure JSON and the map HTML
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def cached_weather_figure(lat, lon, horizon, window, forecast_run):
+    weather_input = cached_weather_forecast(lat, lon, horizon, window, forecast_run)
+    return build_weather_figure(weather_input['weather_df'], weather_input['forecast_resolution'])
+
+# The map only depends on the city
+@st.cache_data(ttl=24 * 3600, max_entries=256, show_spinner=False)
+def cached_weather_map(city):
+    coord_input = cached_city_to_coordinates(city)
+    return build_weather_map(coord_input['city'], coord_input['lat'], coord_input['lon'])
+
+
+# Function dedicated to run the pipeline for a new vocal command, the outputs are kept in the session state
+# The stages run through the orchestrator (timeouts, quality gate, background storage) with the cached services of the app
+def process_vocal_command(text_input):
+
+    render_keys = []
+    def forecast(lat, lon, horizon, window, timeout=None):
+        render_keys.append((lat, lon, horizon, window, plan_expiry(plan_forecast(horizon, window, DISPLAY_VARIABLES))))
+        return cached_weather_forecast(*render_keys[-1], timeout=timeout)
+
+    # Monitoring : the record is queued by the storage stage, the DB write does not block the app
+    results = run_pipeline(speech = text_input,
+                           session = st.session_state['session_id'],
+                           geocode = cached_city_to_coordinates,
+                           forecast = forecast)
+
+    weather_input = results['weather']
+    st.session_state['pipeline'] = {'text_input': text_input,
+                                    'city_input': results['city'],
+                                    'quality_input': results['quality'],
+                                    'horizon_input': results['horizon'],
+                                    'coord_input': results['geocoding'],
+                                    'weather_input': weather_input,
+                                    'render_key': render_keys[-1] if render_keys and weather_input.get('weather_df') is not None else None}
 
 
 
@@ -48,20 +176,40 @@ st.subheader(" How's the weather? :mostly_sunny: or :sun_behind_rain_cloud: or :
 
 
 
+# Identifier of the user session : its last city is reused by the quality gate ("et pour demain ?")
+st.session_state.setdefault('session_id', uuid.uuid4().hex)
+
+
+
 # Section Azure STT : Vocal command --------------------------------------
 st.markdown("""---""")
 st.subheader("Vocal command :studio_microphone:")
 st.write("Please speak into your microphone to launch the app :microphone:")
 
-# Initialisation
-text_input = ({'speech_info' : None,
-              'speech_text' : None})
-
-# Process and render data
-text_input = recognize_from_microphone()
-#temp = text_input['speech_text']
-
-if text_input:
+# Process new audio only : a widget interaction reruns the script without running the pipeline again
+col1, col2 = st.columns(2)
+with col1:
+    audio = mic_recorder(start_prompt="Record :studio_microphone:", stop_prompt="Stop :black_square_for_stop:",
+                         format="wav", key="recorder")
+with col2:
+    use_server_microphone = st.button("Use the server microphone :microphone:")
+
+new_text_input = None
+if audio and audio['id'] != st.session_state.get('last_audio_id'):
+    st.session_state['last_audio_id'] = audio['id']
+    with st.spinner('Loading...'):
+        new_text_input = recognize_from_audio_bytes(audio['bytes'])
+elif use_server_microphone:
+    with st.spinner('Loading...'):
+        new_text_input = recognize_from_microphone()
+
+if new_text_input:
+    with st.spinner('Loading...'):
+        process_vocal_command(new_text_input)
+
+pipeline = st.session_state.get('pipeline')
+if pipeline:
+    text_input = pipeline['text_input']
     st.info(f'''The audio transcription from Speech-To-Text service is : "{text_input['speech_text']}"''')
 else:
     st.info("Waiting for vocal command ...")
@@ -70,6 +218,17 @@ else:
 
 st.write("Azure API is used here for the speech-to-text service ([see Azure documentation](https://azure.microsoft.com/en-us/products/ai-services/speech-to-text)).""")
 
+# Nothing else to render before the first vocal command
+if not pipeline:
+    st.stop()
+
+# Procedure below the minimal quality : the user is asked to repeat the command, nothing else is rendered
+quality_input = pipeline['quality_input']
+if quality_input['quality_decision'] == "reprompt":
+    st.warning(f"Sorry, the vocal command was not understood ({quality_input['quality_reason']}). "
+               "Please repeat the city and the horizon of the forecast :studio_microphone:")
+    st.stop()
+
 
 
 # Section NLP : City and horizon inputs from vocal command --------------------------------------
@@ -77,22 +236,21 @@ st.markdown("""---""")
 st.subheader("Extraction of entities :cityscape: & :date:")
 st.write("From NLP magics, your vocal command is processed as following :magic_wand:")
 
-# Initialisation
-city_input = None
-horizon_input = None
-
-# Process and render data
-#if text_input['speech_info']:
-#    city_input = extract_city(text = text_input['speech_text'])['city_extracted']
-#    horizon_input = extract_horizon(text = text_input['speech_text'])['horizon_extracted']
-with st.spinner('Loading...'):    
-    col1, col2 = st.columns(2)
-    with col1:    
-        city_input = extract_city(text = text_input['speech_text'])['city_extracted']
-        st.info(f'''The city extracted from the vocal command is "{city_input}"''')
-    with col2:
-        horizon_input = extract_horizon(text = text_input['speech_text'])['horizon_extracted']
-        st.info(f'''The horizon extracted from the vocal command is "{horizon_input}"''')
+# Render data from the session state
+city_input = pipeline['city_input']['city_extracted']
+horizon_input = pipeline['horizon_input']['horizon_extracted']
+col1, col2 = st.columns(2)
+with col1:    
+    st.info(f'''The city extracted from the vocal command is "{city_input}"''')
+    if quality_input['quality_decision'] == "fuzzy_gazetteer":
+        st.info(f'''No city recognized : "{quality_input['city']}" was found in the words of the command''')
+    elif quality_input['quality_decision'] == "last_city":
+        st.info(f'''No city in the command : the last city "{quality_input['city']}" is used''')
+with col2:
+    st.info(f'''The horizon extracted from the vocal command is "{horizon_input}"''')
+    horizon_info = pipeline['horizon_input']['horizon_extracted_info']
+    if horizon_info.startswith("Failed") and not horizon_out_of_range(pipeline['horizon_input']):
+        st.info(f"{horizon_info} : the forecast of the default horizon is shown")
 
 st.write("""LOC entities are processed with the Spacy' Python library and the `fr_core_news_md`,
          a French pipeline optimized for CPU ([see Spacy documentation](https://spacy.io/models/fr#fr_core_news_md)).""")
@@ -106,20 +264,18 @@ st.markdown("""---""")
 st.subheader("Geocoding :world_map:")
 st.write("From your vocal command the geocoding service returns the spatial coordinates.")
 
-# Initialisation
-#coord_input = None
-
-# Process and render data
-#if city_input:
-with st.spinner('Loading...'):
-    coord_input = city_to_coordinates(city = city_input)
-    st.info(f"Information from Geocoding service : {coord_input['geocoding_info']}")
-    st.info(f"Spatial coordinates of `{coord_input['city']}` are : `latitude={coord_input['lat']}` & `lon={coord_input['lon']}`.")
-#else:
-#    st.info(f"Spatial coordinates are uknown due to a failure during the LOC extraction process.")
+# Render data from the session state
+coord_input = pipeline['coord_input']
+st.info(f"Information from Geocoding service : {coord_input['geocoding_info']}")
+st.info(f"Spatial coordinates of `{coord_input['city']}` are : `latitude={coord_input['lat']}` & `lon={coord_input['lon']}`.")
 
 st.write("The Geopy' Python library is used here for the geocoding service and based on Open Street Map API ([see Geopy documentation](https://geopy.readthedocs.io/en/stable/)).""")
 
+# No coordinates : no forecast was requested
+if coord_input['lat'] is None:
+    st.warning("The city could not be geocoded, please repeat the vocal command :studio_microphone:")
+    st.stop()
+
 
 
 # Section Weather : --------------------------------------
@@ -127,77 +283,27 @@ st.markdown("""---""")
 st.subheader("Weather information :sun_with_face:")
 
 
-# Process and render data table
-with st.spinner('Loading...'):
-    st.subheader('Weather table :', divider='rainbow')
-    weather_input = weather_forecast_from_coord(lat=coord_input['lat'],
-                                          lon=coord_input['lon'],
-                                          horizon=[horizon_input if horizon_input is not None else None])
-
-    weather_df = weather_input['weather_df']
-    st.write(f"Finally the weather is shown here after for the city of {coord_input['city']} and considering a forecast horizon of {weather_input['forecast_horizon']} days.")
-    st.dataframe(data=weather_df)
-
-# Process and render graph
-
+# Render data table from the session state
+st.subheader('Weather table :', divider='rainbow')
+weather_input = pipeline['weather_input']
+weather_df = weather_input.get('weather_df')
+if horizon_out_of_range(pipeline['horizon_input']):
+    st.warning(f"{pipeline['horizon_input']['horizon_extracted_info']} : please ask for a closer date :studio_microphone:")
+    st.stop()
+if weather_df is None:
+    st.warning(f"Information from the weather service : {weather_input['weather_info']}")
+    st.stop()
+st.write(f"Finally the weather is shown here after for the city of {coord_input['city']} and considering a forecast horizon of {weather_input['forecast_horizon']} days.")
+st.dataframe(data=weather_df)
+
+# Render graph and map : artefacts built once per (city, horizon, forecast run), the current time is added on display
 with st.spinner('Loading...'):
     st.subheader('Weather graph :', divider='rainbow')
-    # Create figure with secondary y axis
-    fig = make_subplots(specs=[[{"secondary_y":True}]])
-    week_ahead = pd.to_datetime(weather_df['date'],format="%Y-%m-%dT%H:%M")
-    
-    # Add traces
-    fig.add_trace(go.Scatter(x = weather_df['date'],#week_ahead,#+tzoffset, 
-                             y = weather_df['temperature_2m'],
-                             name = "Temperature °C"),
-                  secondary_y = False)
-    
-    fig.add_trace(go.Bar(x = weather_df['date'],#week_ahead,#+tzoffset, 
-                         y = weather_df['precipitation'],
-                         name = "Precipitation mm"),
-                  secondary_y = True)
-    
-    time_now = datetime.now(tmz.utc)#+tzoffset
-    
-    fig.add_vline(x = time_now, line_color="red", opacity=0.4)
-    fig.add_annotation(x = time_now, y=max(weather_df['temperature_2m'])+5,
-                text = time_now.strftime("%d %b %y, %H:%M"),
-                showarrow=False,
-                yshift=0)
-    
-    fig.update_yaxes(range=[min(weather_df['temperature_2m'])-10,
-                            max(weather_df['temperature_2m'])+10],
-                      title_text="Temperature °C",
-                     secondary_y=False,
-                     showgrid=False,
-                     zeroline=False)
-        
-    fig.update_yaxes(range=[min(weather_df['precipitation'])-2,
-                            max(weather_df['precipitation'])+8], 
-                      title_text="Precipitation (rain/showers/snow) mm",
-                     secondary_y=True,
-                     showgrid=False)
-    
-    
-    fig.update_layout(legend=dict(
-        orientation="h",
-        yanchor="bottom",
-        y=1.02,
-        xanchor="right",
-        x=0.7
-    ))
-
-
-    # Section Map 
-with st.spinner('Loading...'):
+    figure = figure_with_now(cached_weather_figure(*pipeline['render_key']), datetime.now(tmz.utc))
+    st.plotly_chart(figure, use_container_width=True)
+
+    # Section Map
     st.subheader('Weather map :', divider='rainbow')
-    m = folium.Map(location=[coord_input['lat'], coord_input['lon']], zoom_start=7)
-    folium.Marker([coord_input['lat'], coord_input['lon']], 
-              popup=coord_input['city'], 
-              tooltip=f'Il fait toujours beau à {coord_input["city"]} 😃').add_to(m)
-    
-    # call to render Folium map in Streamlit
-    
     # Make folium map responsive to adapt to smaller display size (
     # e.g., on smartphones and tablets)
     make_map_responsive= """
@@ -206,13 +312,8 @@ with st.spinner('Loading...'):
      </style>
     """
     st.markdown(make_map_responsive, unsafe_allow_html=True)
-    
-    # Display chart
-    st.plotly_chart(fig, use_container_width=True)
-    
-    # Display map
-    st_data = folium_static(m, height = 370)
-    
+    components.html(cached_weather_map(coord_input['city']), height=MAP_HEIGHT + 10)
+
 
 
 # Concluding remarks --------------------------------------
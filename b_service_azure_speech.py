@@ -1,27 +1,55 @@
 """
-Service for NER - Named Entity Recognition :
+Service for speech-to-text - Azure Cognitive Services :
 =====================
 
-The service is dedicated for extrcationC CITY and HORIZON of forecast from a given text input.
-First, actions are needed on VS Code Terminal :
-- Load the French pipeline optimized for CPU from spacy with :
-python -m spacy download fr_core_news_md
+The service is dedicated to transcribe the vocal command of the user into a text.
+First, actions are needed on Azure :
+- Create a Speech resource and set AZURE_SPEECH_KEY, AZURE_SPEECH_REGION and AZURE_SPEECH_LANG in the .env file
 
 
 Then, this module can be processed as following :
-- One function is dedicated to extrcat the city
-- One function is dedicated to extrcat the horizon of forecasting (1 or several days)
+- One function is dedicated to the default microphone (local use)
+- One function is dedicated to audio files (WAV) and one to audio bytes (WAV or raw PCM, e.g. recorded in the browser),
+which can be used server-side
+- A push stream can be fed chunk by chunk with continuous recognition : partial results are sent to a callback,
+so the NER can start before the end of the utterance
+- The recognizer is set with SPEECH_BACKEND in the .env file : "azure" (default) or "local", a stand-in for tests
+which reads the transcription from a `.txt` file next to the audio file
 
 Ressources :
 - https://learn.microsoft.com/en-us/azure/ai-services/speech-service/get-started-speech-to-text?tabs=windows%2Cterminal&pivots=programming-language-python
+- https://learn.microsoft.com/en-us/azure/ai-services/speech-service/how-to-use-audio-input-streams
 
 """
 
+import asyncio
+import io
+import json
+import os
+import threading
+import time
+import wave
+from functools import lru_cache
 from dotenv import dotenv_values
-import azure.cognitiveservices.speech as speechsdk
+from j_lazy_import import lazy_import
+from m_service_tracing import record_upstream, traced
 
+# Heavy SDK imported on first use
+speechsdk = lazy_import("azure.cognitiveservices.speech")
 
-def recognize_from_microphone():
+
+# Format of the raw PCM audio when no WAV header is given
+SPEECH_SAMPLE_RATE = 16000
+SPEECH_BITS_PER_SAMPLE = 16
+SPEECH_CHANNELS = 1
+# Maximal duration in seconds of a continuous recognition
+SPEECH_CONTINUOUS_TIMEOUT = 60
+
+
+# Function dedicated to build (once per process and language) the configuration of the Azure service
+# language : recognition language (None : AZURE_SPEECH_LANG), a config is never modified once built (shared by threads)
+@lru_cache(maxsize=8)
+def get_speech_config(language=None):
     
     # Load credentials
     credentials = dotenv_values(".env")
@@ -33,23 +61,42 @@ def recognize_from_microphone():
     
     # Set the configuration of the Azure service
     speech_config = speechsdk.SpeechConfig(subscription=speech_key, region=speech_region)
-    speech_config.speech_recognition_language = credentials["AZURE_SPEECH_LANG"]
+    speech_config.speech_recognition_language = language or credentials["AZURE_SPEECH_LANG"]
+    # Detailed output : the N-best list carries the confidence of the recognition
+    speech_config.output_format = speechsdk.OutputFormat.Detailed
+    return speech_config
+
+
+# Function dedicated to build the recognizer of the default microphone
+def _microphone_recognizer():
 
     # Audio from microphone
     audio_config = speechsdk.audio.AudioConfig(use_default_microphone=True)
     
-    # OR ----------- Audio from audio file
-    #audio_config = speechsdk.audio.AudioConfig(filename="YourAudioFile.wav")
+    # OR ----------- Audio from audio file : see recognize_from_file
     
-    speech_recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+    return speechsdk.SpeechRecognizer(speech_config=get_speech_config(), audio_config=audio_config)
 
-    print("Speak into your microphone.")
-    speech_recognition_result = speech_recognizer.recognize_once_async().get()
+
+# Function dedicated to read the confidence (0 to 1) of the best hypothesis of a recognition result (None if unknown)
+def _speech_confidence(speech_recognition_result):
+
+    try:
+        detailed = json.loads(speech_recognition_result.properties.get(
+            speechsdk.PropertyId.SpeechServiceResponse_JsonResult) or "{}")
+        return float(detailed["NBest"][0]["Confidence"])
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+# Function dedicated to convert the Azure recognition result into the status dict of the service
+def _speech_result(speech_recognition_result):
 
     if speech_recognition_result.reason == speechsdk.ResultReason.RecognizedSpeech:
         #print("Recognized: {}".format(speech_recognition_result.text))
         return({'speech_text' : speech_recognition_result.text,
-               'speech_info' : "Successed"})
+               'speech_info' : "Successed",
+               'speech_confidence' : _speech_confidence(speech_recognition_result)})
     
     elif speech_recognition_result.reason == speechsdk.ResultReason.NoMatch:
         #print("No speech could be recognized: {}".format(speech_recognition_result.no_match_details))
@@ -59,18 +106,214 @@ def recognize_from_microphone():
     elif speech_recognition_result.reason == speechsdk.ResultReason.Canceled:
         cancellation_details = speech_recognition_result.cancellation_details
         #print("Speech Recognition canceled: {}".format(cancellation_details.reason))
-        return({'speech_text' : None,
-               'speech_info' : "Failed. Error : speech recognition canceled"})
-        
         if cancellation_details.reason == speechsdk.CancellationReason.Error:
             #print("Error details: {}".format(cancellation_details.error_details))
             #print("Did you set the speech resource key and region values?")
             return({'speech_text' : None,
                'speech_info' : "Failed. Error : Azure recognition service failed to connect"})
+
+        return({'speech_text' : None,
+               'speech_info' : "Failed. Error : speech recognition canceled"})
+
+
+@traced("speech", status_key="speech_info")
+def recognize_from_microphone():
+    
+    speech_recognizer = _microphone_recognizer()
+
+    print("Speak into your microphone.")
+    start = time.perf_counter()
+    speech_recognition_result = speech_recognizer.recognize_once_async().get()
+    record_upstream(time.perf_counter() - start)
+
+    return _speech_result(speech_recognition_result)
             
 
+# Async variant : the Azure future is not blocked on, the recognition events resolve an asyncio future
+@traced("speech", status_key="speech_info")
+async def recognize_from_microphone_async():
+
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def _resolve(evt):
+        # Called from a thread of the Speech SDK
+        loop.call_soon_threadsafe(lambda: done.done() or done.set_result(evt.result))
+
+    speech_recognizer = _microphone_recognizer()
+    speech_recognizer.recognized.connect(_resolve)
+    speech_recognizer.canceled.connect(_resolve)
+
+    print("Speak into your microphone.")
+    start = time.perf_counter()
+    recognition = speech_recognizer.recognize_once_async()
+    result = await done
+    record_upstream(time.perf_counter() - start)
+    del recognition
+    return _speech_result(result)
+
+
+# Audio files, audio bytes and push streams --------------------------------------
+
+# Function dedicated to read the format and the PCM frames of WAV bytes (None if the bytes are raw PCM)
+def _read_wav(data):
+
+    if data[:4] != b"RIFF":
+        return None
+    with wave.open(io.BytesIO(data)) as wav:
+        return (wav.getframerate(), wav.getsampwidth() * 8, wav.getnchannels()), wav.readframes(wav.getnframes())
+
+
+class AzureRecognizer:
+    """Azure Speech recognizer for audio files, audio bytes and push streams (the SpeechConfig is shared)."""
+
+    def recognize_file(self, path, language=None):
+        audio_config = speechsdk.audio.AudioConfig(filename=str(path))
+        recognizer = speechsdk.SpeechRecognizer(speech_config=get_speech_config(language), audio_config=audio_config)
+        return _speech_result(recognizer.recognize_once_async().get())
+
+    def create_stream(self, sample_rate=SPEECH_SAMPLE_RATE, bits_per_sample=SPEECH_BITS_PER_SAMPLE, channels=SPEECH_CHANNELS):
+        """Push stream to be fed with `write(chunk)` then `close()`, e.g. with the chunks recorded in the browser."""
+        stream_format = speechsdk.audio.AudioStreamFormat(samples_per_second=sample_rate,
+                                                          bits_per_sample=bits_per_sample,
+                                                          channels=channels)
+        return speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+
+    def recognize_stream(self, stream, on_partial=None, continuous=True, timeout=SPEECH_CONTINUOUS_TIMEOUT):
+        """Recognize a push stream until it is closed. `on_partial(text)` receives the partial results."""
+
+        audio_config = speechsdk.audio.AudioConfig(stream=stream)
+        recognizer = speechsdk.SpeechRecognizer(speech_config=get_speech_config(), audio_config=audio_config)
+
+        if not continuous:
+            return _speech_result(recognizer.recognize_once_async().get())
+
+        texts, confidences, errors = [], [], []
+        stopped = threading.Event()
+
+        def _recognizing(evt):
+            if on_partial is not None:
+                on_partial(" ".join(texts + [evt.result.text]))
+
+        def _recognized(evt):
+            if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech and evt.result.text:
+                texts.append(evt.result.text)
+                confidences.append(_speech_confidence(evt.result))
+                if on_partial is not None:
+                    on_partial(" ".join(texts))
+
+        def _canceled(evt):
+            if evt.cancellation_details.reason == speechsdk.CancellationReason.Error:
+                errors.append(evt.cancellation_details.error_details)
+            stopped.set()
+
+        recognizer.recognizing.connect(_recognizing)
+        recognizer.recognized.connect(_recognized)
+        recognizer.canceled.connect(_canceled)
+        recognizer.session_stopped.connect(lambda evt: stopped.set())
+
+        recognizer.start_continuous_recognition_async().get()
+        stopped.wait(timeout=timeout)
+        recognizer.stop_continuous_recognition_async().get()
+
+        if errors:
+            return({'speech_text' : None,
+                   'speech_info' : "Failed. Error : Azure recognition service failed to connect"})
+        if not texts:
+            return({'speech_text' : None,
+                   'speech_info' : "Failed. Error : no speech recognized"})
+        # Confidence of the whole text : the lowest confidence of its segments
+        known = [confidence for confidence in confidences if confidence is not None]
+        return({'speech_text' : " ".join(texts),
+               'speech_info' : "Successed",
+               'speech_confidence' : min(known) if known else None})
+
+    def recognize_bytes(self, data, sample_rate=SPEECH_SAMPLE_RATE, bits_per_sample=SPEECH_BITS_PER_SAMPLE,
+                        channels=SPEECH_CHANNELS, on_partial=None):
+        wav = _read_wav(data)
+        if wav is not None:
+            (sample_rate, bits_per_sample, channels), data = wav
+        stream = self.create_stream(sample_rate, bits_per_sample, channels)
+        stream.write(data)
+        stream.close()
+        return self.recognize_stream(stream, on_partial=on_partial)
+
+
+class LocalRecognizer:
+    """Stand-in recognizer for tests, without Azure : the transcription of `audio.wav` is read from `audio.txt`,
+    the audio bytes and streams return `default_text` (None : no speech recognized)."""
+
+    def __init__(self, default_text=None):
+        self.default_text = default_text
+
+    def _result(self, text):
+        if not text:
+            return({'speech_text' : None,
+                   'speech_info' : "Failed. Error : no speech recognized"})
+        return({'speech_text' : text,
+               'speech_info' : "Successed"})
+
+    def recognize_file(self, path, language=None):
+        transcript_path = os.path.splitext(str(path))[0] + ".txt"
+        if os.path.exists(transcript_path):
+            with open(transcript_path, encoding="utf-8") as file:
+                return self._result(file.read().strip())
+        return self._result(self.default_text)
+
+    def create_stream(self, sample_rate=SPEECH_SAMPLE_RATE, bits_per_sample=SPEECH_BITS_PER_SAMPLE, channels=SPEECH_CHANNELS):
+        return io.BytesIO()
+
+    def recognize_stream(self, stream, on_partial=None, continuous=True, timeout=SPEECH_CONTINUOUS_TIMEOUT):
+        if on_partial is not None and self.default_text:
+            # Partial results word by word, as the continuous recognition does
+            words = self.default_text.split()
+            for i in range(1, len(words) + 1):
+                on_partial(" ".join(words[:i]))
+        return self._result(self.default_text)
+
+    def recognize_bytes(self, data, sample_rate=SPEECH_SAMPLE_RATE, bits_per_sample=SPEECH_BITS_PER_SAMPLE,
+                        channels=SPEECH_CHANNELS, on_partial=None):
+        return self.recognize_stream(None, on_partial=on_partial)
+
+
+SPEECH_RECOGNIZERS = {
+    'azure': AzureRecognizer,
+    'local': LocalRecognizer,
+}
+
+_recognizer = None
+
+
+# Function dedicated to return the recognizer set with SPEECH_BACKEND in the .env file (or to replace it, e.g. in tests)
+def get_recognizer():
+
+    global _recognizer
+    if _recognizer is None:
+        backend = dotenv_values(".env").get("SPEECH_BACKEND") or "azure"
+        _recognizer = SPEECH_RECOGNIZERS[backend]()
+    return _recognizer
+
+def set_recognizer(recognizer):
+    global _recognizer
+    _recognizer = recognizer
+
+
+# Function dedicated to transcribe an audio file (WAV), language : None for AZURE_SPEECH_LANG
+def recognize_from_file(path, language=None):
+    return get_recognizer().recognize_file(path, language=language)
+
+
+# Function dedicated to transcribe audio bytes : WAV (the format is read from the header) or raw PCM
+@traced("speech", status_key="speech_info")
+def recognize_from_audio_bytes(data, sample_rate=SPEECH_SAMPLE_RATE, bits_per_sample=SPEECH_BITS_PER_SAMPLE,
+                               channels=SPEECH_CHANNELS, on_partial=None):
+    return get_recognizer().recognize_bytes(data, sample_rate, bits_per_sample, channels, on_partial=on_partial)
+
+
 # Test
 # recognize_from_microphone()
+# recognize_from_file(path="YourAudioFile.wav")
+# asyncio.run(recognize_from_microphone_async())
 
 # Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
 if __name__ == "__main__":
@@ -11,6 +11,11 @@ python -m spacy download fr_core_news_md
 Then, this module can be processed as following :
 - One function is dedicated to extrcat the city
 - One function is dedicated to extrcat the horizon of forecasting (1 or several days)
+- The horizon is first extracted with rules (French relative expressions : demain, dans N jours, lundi, le 7 mars...),
+the transformer backend is only called when the rules find nothing
+- The horizon backend is set with HORIZON_NER_BACKEND in the .env file : "remote" (Hugging Face Inference API),
+"local", "local_int8" or "local_onnx" (CamemBERT pipeline on CPU), several backends are tried in order ("local_int8,remote")
+- Latency of the backends : python c_service_ner.py --benchmark
 
 Ressources :
 - https://spacy.io/usage#quickstart
@@ -19,40 +24,112 @@ Ressources :
 """
 
 from sys import argv
-from os.path import basename
-import requests
-from dotenv import dotenv_values
-import spacy
-import datefinder
+import asyncio
+import json
+import re
+import threading
+import unicodedata
+import time
+import statistics
+import tracemalloc
 import datetime
+from collections import namedtuple
+from dotenv import dotenv_values
+from j_lazy_import import lazy_import
+from m_service_tracing import record_upstream, traced
+
+# Heavy libraries imported on first use
+requests = lazy_import("requests")
+spacy = lazy_import("spacy")
+datefinder = lazy_import("datefinder")
 
 
 # Load the French NLP model from SpaCy
 #en_core_web_sm => OK sur DATE recognition !!!
 #nlp = spacy.load("fr_core_news_md") #"fr_core_news_lg"
 
+# Process-wide registry of the SpaCy models (loaded once, shared by the CLI and the Streamlit app)
+SPACY_MODEL_NAME = "fr_core_news_md"
+# Only the NER component is needed for the city extraction
+SPACY_DISABLED_COMPONENTS = ["parser", "lemmatizer", "morphologizer"]
+
+_nlp_models = {}
+_nlp_metrics = {}
+_nlp_lock = threading.Lock()
+
+
+# Function dedicated to load (once) and return the SpaCy model
+def get_nlp_model(model_name=SPACY_MODEL_NAME):
+
+    # Fast path : the model is already loaded
+    nlp = _nlp_models.get(model_name)
+    if nlp is not None:
+        return nlp
+
+    # Slow path : only one thread loads the model, the others wait for it
+    with _nlp_lock:
+        nlp = _nlp_models.get(model_name)
+        if nlp is None:
+            tracing_memory = tracemalloc.is_tracing()
+            if not tracing_memory:
+                tracemalloc.start()
+            memory_before = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+
+            nlp = spacy.load(model_name, disable=SPACY_DISABLED_COMPONENTS)
+
+            _nlp_metrics[model_name] = {'load_time_s': time.perf_counter() - start,
+                                        'memory_mb': (tracemalloc.get_traced_memory()[0] - memory_before) / 1024**2,
+                                        'pipeline': nlp.pipe_names,
+                                        'calls': 0}
+            if not tracing_memory:
+                tracemalloc.stop()
+            _nlp_models[model_name] = nlp
+    return nlp
+
+
+# Function dedicated to warm up the models at startup (optional)
+def warm_up_models(model_name=SPACY_MODEL_NAME):
+
+    nlp = get_nlp_model(model_name)
+    # A first call initialises the internal buffers of the pipeline
+    nlp("Quelle est la météo à Paris demain ?")
+    return get_model_metrics()
+
+
+# Function dedicated to expose the load-time and memory metrics of the models
+def get_model_metrics():
+    return {name: dict(metrics) for name, metrics in _nlp_metrics.items()}
+
+
+# Convert a processed SpaCy document into the city result
+def _city_from_doc(doc):
+
+    # Extract entities (locations) from the processed text
+    locations = [ent.text for ent in doc.ents if ent.label_ in ("LOC", "GPE")]
+
+    # If there are multiple locations, you may need additional logic to choose the correct one
+    if locations:
+        #print(locations[0])
+        return{'city_extracted' : locations[0],
+            'city_extracted_info' : 'Successed'}
+    else:
+        #print('None')
+        return{'city_extracted' : None,
+            'city_extracted_info' : 'Failed'}
+
+
 # Cities are handled with SPACY - NER
+@traced("city", status_key="city_extracted_info")
 def extract_city(text):
     
-    nlp = spacy.load("fr_core_news_md")
+    nlp = get_nlp_model()
+    _nlp_metrics[SPACY_MODEL_NAME]['calls'] += 1
     
     # Process if text is not NONE
     if text:
         # Process the text using SpaCy
-        doc = nlp(text)
-
-        # Extract entities (locations) from the processed text
-        locations = [ent.text for ent in doc.ents if ent.label_ in ("LOC", "GPE")]
-
-        # If there are multiple locations, you may need additional logic to choose the correct one
-        if locations:
-            #print(locations[0])
-            return{'city_extracted' : locations[0],
-                'city_extracted_info' : 'Successed'}
-        else:
-            #print('None')
-            return{'city_extracted' : None,
-                'city_extracted_info' : 'Failed'}
+        return _city_from_doc(nlp(text))
     else:
         #print('None')
         return{'city_extracted' : None,
@@ -62,55 +139,508 @@ def extract_city(text):
 # extract_city(text='quelle est la météo à tours')#je voudrais connaitre la météo à tours')# en France')
 
 
-# Dates are handled with transformers - CAMEMBERT - from Hugging Face Inference API
-def extract_horizon(text):
+# Cities for many texts at once, streamed through nlp.pipe
+def extract_cities_batch(texts, batch_size=256, n_process=1):
+
+    nlp = get_nlp_model()
+    texts = list(texts)
+    _nlp_metrics[SPACY_MODEL_NAME]['calls'] += len(texts)
+
+    # Empty texts are not sent to the pipeline, they fail as in extract_city
+    results = [{'city_extracted' : None,
+                'city_extracted_info' : 'Failed'} for _ in texts]
+    indexes = [i for i, text in enumerate(texts) if text]
+
+    docs = nlp.pipe((texts[i] for i in indexes), batch_size=batch_size, n_process=n_process)
+    for i, doc in zip(indexes, docs):
+        results[i] = _city_from_doc(doc)
+    return results
+
+# Test
+# extract_cities_batch(texts=['quelle est la météo à tours', 'il pleut à Lyon ?', None])
+
+
+# CamemBERT model for the DATE entities
+HORIZON_MODEL_NAME = "Jean-Baptiste/camembert-ner-with-dates"
+# Hugging Face inference end point for the DATE entities
+HF_NER_API_URL = f"https://api-inference.huggingface.co/models/{HORIZON_MODEL_NAME}"
+# Timeout (connect, read) in seconds of the Hugging Face inference API
+HF_NER_TIMEOUT = (3.05, 15)
+# Backends tried in order when none is set with HORIZON_NER_BACKEND in the .env file (e.g. "local_int8,remote")
+HORIZON_NER_DEFAULT_BACKEND = "remote"
+
+_hf_session = None
+_horizon_pipelines = {}
+_horizon_lock = threading.Lock()
+
+
+# Function dedicated to build the headers of the Hugging Face inference API
+def _hf_headers():
 
-    # Part 1 - Extract NER with Hugging Face API
     # Load credentials
     credentials = dotenv_values(".env")
-    HF_API_TOKEN = credentials["HF_USER_ACCESS_TOKENS"]
-
-    # Define Hugging Face end point 
-    API_URL = "https://api-inference.huggingface.co/models/Jean-Baptiste/camembert-ner-with-dates"
-    headers = {"Authorization": f"Bearer {HF_API_TOKEN}"}
-        
-    # Get response from Hugging Face inference API
-    response = requests.post(API_URL, headers=headers, json=text)
-    #print(response.status_code)
+    HF_API_TOKEN = credentials.get("HF_USER_ACCESS_TOKENS")
+    # Anonymous requests without a token (rate limited by Hugging Face, enough for a local stand-in)
+    return {"Authorization": f"Bearer {HF_API_TOKEN}"} if HF_API_TOKEN else {}
+
+
+# Function dedicated to return the HTTP session (connection reuse) of the Hugging Face inference API
+def _get_hf_session():
+
+    global _hf_session
+    if _hf_session is None:
+        with _horizon_lock:
+            if _hf_session is None:
+                session = requests.Session()
+                session.headers.update(_hf_headers())
+                _hf_session = session
+    return _hf_session
+
+
+# Function dedicated to load (once) the local CamemBERT token-classification pipeline on CPU
+# optimization : None, "int8" (dynamic quantization) or "onnx" (ONNX Runtime export)
+def get_horizon_pipeline(optimization=None):
+
+    ner = _horizon_pipelines.get(optimization)
+    if ner is not None:
+        return ner
+
+    with _horizon_lock:
+        ner = _horizon_pipelines.get(optimization)
+        if ner is None:
+            from transformers import AutoTokenizer, AutoModelForTokenClassification, pipeline
+
+            tokenizer = AutoTokenizer.from_pretrained(HORIZON_MODEL_NAME)
+            if optimization == "onnx":
+                from optimum.onnxruntime import ORTModelForTokenClassification
+                model = ORTModelForTokenClassification.from_pretrained(HORIZON_MODEL_NAME, export=True)
+            else:
+                model = AutoModelForTokenClassification.from_pretrained(HORIZON_MODEL_NAME)
+                if optimization == "int8":
+                    import torch
+                    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+            ner = pipeline("token-classification", model=model, tokenizer=tokenizer,
+                           aggregation_strategy="simple", device=-1)
+            _horizon_pipelines[optimization] = ner
+    return ner
+
+
+# Backend : Hugging Face inference API, returns the status code and the entities of each text
+# timeout : seconds left to the caller (None : HF_NER_TIMEOUT)
+def _entities_from_remote(texts, batch_size=32, timeout=None):
+
+    session = _get_hf_session()
+    entities_per_text = []
+    for start in range(0, len(texts), batch_size):
+        request_start = time.perf_counter()
+        response = session.post(HF_NER_API_URL, json={"inputs": texts[start:start + batch_size]},
+                                timeout=timeout or HF_NER_TIMEOUT)
+        record_upstream(time.perf_counter() - request_start, len(response.content))
+        if response.status_code != 200:
+            return response.status_code, None
+        entities_per_text.extend(response.json())
+    return 200, entities_per_text
+
+
+# Backend : local CamemBERT pipeline, returns 200 (as the remote API) and the entities of each text
+def _local_backend(optimization):
+
+    def _entities_from_local(texts, batch_size=32, timeout=None):
+        ner = get_horizon_pipeline(optimization)
+        return 200, ner(texts, batch_size=batch_size)
+    return _entities_from_local
+
+
+HORIZON_NER_BACKENDS = {
+    'remote': _entities_from_remote,
+    'local': _local_backend(None),
+    'local_int8': _local_backend("int8"),
+    'local_onnx': _local_backend("onnx"),
+}
+
+
+# Function dedicated to return the backends to use, from the argument or the .env file
+def _horizon_backend_names(backend=None):
+
+    if backend is None:
+        backend = dotenv_values(".env").get("HORIZON_NER_BACKEND") or HORIZON_NER_DEFAULT_BACKEND
+    return [name.strip() for name in backend.split(",") if name.strip()]
+
+
+# Function dedicated to run the NER on texts, trying each backend in order until one succeeds
+def _horizon_entities(texts, backend=None, batch_size=32, timeout=None):
+
+    code = None
+    for name in _horizon_backend_names(backend):
+        try:
+            code, entities_per_text = HORIZON_NER_BACKENDS[name](texts, batch_size=batch_size, timeout=timeout)
+        except (requests.RequestException, ImportError, OSError) as error:
+            print(f"Horizon NER backend {name} failed : {error}")
+            continue
+        if code == 200:
+            return code, entities_per_text
+    return code, None
+
+
+# Score of the first DATE entity of one text (None without DATE entity)
+def _date_entity_score(entities):
+    scores = [float(ent['score']) for ent in entities if ent['entity_group'] == 'DATE' and 'score' in ent]
+    return scores[0] if scores else None
+
+
+# Convert the NER entities of one text into a horizon in days with datefinder
+# Returns the day of the DATE entity as a HorizonWindow (same contract as the rules), None if no date or a past date
+def _horizon_from_entities(entities, today=None):
+
+    # Extract date only
+    time_entities = [ent['word'] for ent in entities if ent['entity_group'] == 'DATE']
+    if not time_entities:
+        return None
+    #print(time_entities[0])
+
+    # Convert to a convenient format
+    date_find = None
+    for matches in datefinder.find_dates(time_entities[0]):
+        date_find = matches
+    if date_find is None:
+        return None
+
+    # Day of the date from today (0), a past date is rejected
+    days = (date_find.date() - (today or datetime.date.today())).days
+    return HorizonWindow(days, days) if days >= 0 else None
+
+
+# Rule-based first pass for the French relative expressions of time (no model, a few microseconds)
+# The horizon returned by the rules is the number of forecast days needed to cover the expression (today counts as 1)
+HORIZON_MAX_DAYS = 16
+
+# Days covered by the expression, from today (0) : "demain" is (1, 1), "les 3 prochains jours" is (0, 2)
+# now : the current conditions are asked ("en ce moment"), used by the forecast query planner
+HorizonWindow = namedtuple('HorizonWindow', ['first_day', 'last_day', 'now'], defaults=(False,))
+# Status of a date beyond the forecast (no forecast of a wrong day)
+HORIZON_OUT_OF_RANGE_INFO = f"Failed. Out of range : the forecast covers the next {HORIZON_MAX_DAYS} days"
+# Status of a text without a date of the forecast (no DATE entity, no date found or a past date)
+HORIZON_NOT_FOUND_INFO = "Failed. No date found"
+
+_NUMBER_WORDS = {'un': 1, 'une': 1, 'deux': 2, 'trois': 3, 'quatre': 4, 'cinq': 5, 'six': 6, 'sept': 7, 'huit': 8,
+                 'neuf': 9, 'dix': 10, 'onze': 11, 'douze': 12, 'treize': 13, 'quatorze': 14, 'quinze': 15, 'seize': 16}
+_WEEKDAYS = {'lundi': 0, 'mardi': 1, 'mercredi': 2, 'jeudi': 3, 'vendredi': 4, 'samedi': 5, 'dimanche': 6}
+_MONTHS = {'janvier': 1, 'fevrier': 2, 'mars': 3, 'avril': 4, 'mai': 5, 'juin': 6, 'juillet': 7, 'aout': 8,
+           'septembre': 9, 'octobre': 10, 'novembre': 11, 'decembre': 12}
+
+_NUMBER = r"(\d{1,2}|" + "|".join(_NUMBER_WORDS) + r")"
+_DAY = r"(\d{1,2}|1er|premier)"
+
+def _to_number(word):
+    return int(word) if word.isdigit() else _NUMBER_WORDS[word]
+
+def _date_to_window(date, today):
+    days = (date - today).days
+    return HorizonWindow(days, days) if days >= 0 else None
+
+# "lundi" said on a Monday is today, "lundi prochain" is in 7 days
+def _weekday_window(match, today):
+    days = (_WEEKDAYS[match.group(1)] - today.weekday()) % 7
+    if days == 0 and match.group(2):
+        days = 7
+    return HorizonWindow(days, days)
+
+def _weekend_window(match, today):
+    # On Sunday, the weekend is today
+    return HorizonWindow(0 if today.weekday() == 6 else 5 - today.weekday(), 6 - today.weekday())
+
+def _day_month_to_window(match, today):
+    day = 1 if match.group(1) in ('1er', 'premier') else int(match.group(1))
+    month = _MONTHS[match.group(2)]
+    try:
+        if match.group(3):
+            return _date_to_window(datetime.date(int(match.group(3)), month, day), today)
+        date = datetime.date(today.year, month, day)
+        if date < today:
+            date = datetime.date(today.year + 1, month, day)
+    except ValueError:
+        return None
+    return _date_to_window(date, today)
+
+# Ordered rules (pattern on the normalised text, days covered from the match and today's date), the first match wins
+_HORIZON_RULES = [
+    (re.compile(r"\bapres[ -]demain\b"), lambda match, today: HorizonWindow(2, 2)),
+    (re.compile(r"\bdemain\b"), lambda match, today: HorizonWindow(1, 1)),
+    (re.compile(r"\b(maintenant|en ce moment|actuellement)\b"), lambda match, today: HorizonWindow(0, 0, now=True)),
+    (re.compile(r"\b(aujourd ?hui|ce soir|ce matin|cet apres[ -]midi)\b"), lambda match, today: HorizonWindow(0, 0)),
+    (re.compile(r"\b(?:les|pour|sur)\s+(?:les\s+)?" + _NUMBER + r"\s+(?:prochains|jours suivants|jours a venir)"),
+     lambda match, today: HorizonWindow(0, _to_number(match.group(1)) - 1)),
+    (re.compile(r"\bdans\s+" + _NUMBER + r"\s+jours?\b"),
+     lambda match, today: HorizonWindow(_to_number(match.group(1)), _to_number(match.group(1)))),
+    (re.compile(r"\b" + _NUMBER + r"\s+(?:prochains\s+)?jours\b"),
+     lambda match, today: HorizonWindow(0, _to_number(match.group(1)) - 1)),
+    (re.compile(r"\b(?:ce|le|du)\s+(?:week[ -]?end|weekend)\b"), _weekend_window),
+    (re.compile(r"\bla semaine prochaine\b"), lambda match, today: HorizonWindow(7 - today.weekday(), 13 - today.weekday())),
+    (re.compile(r"\bcette semaine\b"), lambda match, today: HorizonWindow(0, 6 - today.weekday())),
+    (re.compile(r"\b" + _DAY + r"\s+(" + "|".join(_MONTHS) + r")(?:\s+(\d{4}))?\b"), _day_month_to_window),
+    (re.compile(r"\b(" + "|".join(_WEEKDAYS) + r")\b(\s+prochain)?"), _weekday_window),
+]
+
+# Counters of the path taken by the horizon extraction
+_horizon_metrics = {'rules_hit': 0, 'rules_miss': 0, 'model_calls': 0}
+
+
+# Function dedicated to normalise a text for the rules : lower case, no accents, no apostrophes
+def _normalise_text(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return text.replace("'", " ").replace("’", " ")
+
+
+# Function dedicated to extract the days covered by the expression with the rules, None if no rule matches
+def extract_horizon_window(text, today=None):
+
+    if not text:
+        return None
+    today = today or datetime.date.today()
+    normalised_text = _normalise_text(text)
+
+    for pattern, to_window in _HORIZON_RULES:
+        match = pattern.search(normalised_text)
+        if match:
+            window = to_window(match, today)
+            if window is not None:
+                # Not clamped : a window beyond HORIZON_MAX_DAYS is reported as out of range by `_horizon_fields`
+                return window._replace(first_day=max(0, window.first_day), last_day=max(0, window.last_day))
+    return None
+
+# Test
+# extract_horizon_window(text='quelle est la météo à tours pour demain')
+
+
+# Function dedicated to extract the horizon (in forecast days) with the rules, None if no rule matches or out of range
+def extract_horizon_rules(text, today=None):
+
+    window = extract_horizon_window(text, today)
+    if window is None or window.last_day >= HORIZON_MAX_DAYS:
+        return None
+    return window.last_day + 1
+
+
+# Function dedicated to build the horizon fields of a result from a window (rules or model)
+# horizon_extracted : number of forecast days from today covering the window ("demain" : 2)
+# status : status of the extraction, a missing window is a failure (no date found) and a late one is out of range
+def _horizon_fields(window, status="Successed"):
+
+    if window is None or window.last_day >= HORIZON_MAX_DAYS:
+        info = status if status != "Successed" else HORIZON_NOT_FOUND_INFO if window is None else HORIZON_OUT_OF_RANGE_INFO
+        return {'horizon_extracted_info': info,
+                'horizon_extracted': None,
+                'horizon_extracted_window': None}
+    return {'horizon_extracted_info': status,
+            'horizon_extracted': window.last_day + 1,
+            'horizon_extracted_window': window}
+
+# Test
+# extract_horizon_rules(text='quelle est la météo à tours pour les 3 prochains jours')
+
+
+# Function dedicated to expose how often each path of the horizon extraction is taken
+def get_horizon_metrics():
+    metrics = dict(_horizon_metrics)
+    total = metrics['rules_hit'] + metrics['rules_miss']
+    metrics['rules_hit_ratio'] = metrics['rules_hit'] / total if total else None
+    return metrics
+
+
+# Function dedicated to build the result of a horizon found by the rules
+def _horizon_from_rules(text):
+
+    window = extract_horizon_window(text)
+    if window is None:
+        _horizon_metrics['rules_miss'] += 1
+        return None
+    _horizon_metrics['rules_hit'] += 1
+    return dict(_horizon_fields(window),
+                horizon_extracted_code=None,
+                horizon_extracted_source="rules",
+                horizon_extracted_score=1.0)
+
+
+# Dates are handled first with the rules, then with transformers - CAMEMBERT - from Hugging Face Inference API or a local pipeline
+# timeout : seconds of the HTTP request to the inference API (None : HF_NER_TIMEOUT)
+@traced("horizon", status_key="horizon_extracted_info")
+def extract_horizon(text, backend=None, use_rules=True, timeout=None):
+
+    # Part 0 - Zero-model first pass with the rules
+    if use_rules and text:
+        result = _horizon_from_rules(text)
+        if result is not None:
+            return result
+
+    # Part 1 - Extract NER with the configured backend(s)
+    if text:
+        _horizon_metrics['model_calls'] += 1
+        code, entities_per_text = _horizon_entities([text], backend=backend, timeout=timeout)
+    else:
+        code, entities_per_text = None, None
     
     # Part 2 - Convert date to horizon with datefinder
     # Code status
-    if response.status_code == 200:
-        
-        status = "Successed"
-        
-        # Extract date only
-        time_entitiy = [ent['word'] for ent in response.json() if ent['entity_group'] == 'DATE'][0]
-        #print(time_entitiy)
-        
-        # Convert to a convenient format
-        for matches in datefinder.find_dates(time_entitiy):
-            date_find = matches 
-
-        # Calculate horizon in days with datetime.now()
-        horizon_in_days = (date_find - datetime.datetime.now()).days
-    
+    if entities_per_text is not None:
+        fields = _horizon_fields(_horizon_from_entities(entities_per_text[0]))
+        score = _date_entity_score(entities_per_text[0])
     else:
-        horizon_in_days = None
-        status = "Failed"
+        fields = _horizon_fields(None, status="Failed")
+        score = None
 
     # End 
-    return({'horizon_extracted_info': status,
-            'horizon_extracted_code': response.status_code,
-            'horizon_extracted': horizon_in_days})
+    return dict(fields,
+                horizon_extracted_code=code,
+                horizon_extracted_source="model",
+                horizon_extracted_score=score)
 
 # Test
 # extract_horizon(text='je voudrais connaitre la météo à tours en France pour 7 mars 2024') #le 7 mars 2024
+# extract_horizon(text='je voudrais connaitre la météo à tours en France pour 7 mars 2024', backend='local_int8')
+
+
+# Horizons for many texts at once : rules first, then batched payloads sent to the backend for the misses
+def extract_horizons_batch(texts, batch_size=32, backend=None, use_rules=True):
+
+    texts = list(texts)
+
+    # Empty texts are not sent to the backend
+    results = [{'horizon_extracted_info': "Failed",
+                'horizon_extracted_code': None,
+                'horizon_extracted_source': "model",
+                'horizon_extracted_score': None,
+                'horizon_extracted': None,
+                'horizon_extracted_window': None} for _ in texts]
+    indexes = []
+    for i, text in enumerate(texts):
+        if not text:
+            continue
+        rules_result = _horizon_from_rules(text) if use_rules else None
+        if rules_result is not None:
+            results[i] = rules_result
+        else:
+            indexes.append(i)
+    if not indexes:
+        return results
+
+    _horizon_metrics['model_calls'] += len(indexes)
+    code, entities_per_text = _horizon_entities([texts[i] for i in indexes], backend=backend, batch_size=batch_size)
+    for position, i in enumerate(indexes):
+        results[i]['horizon_extracted_code'] = code
+        if entities_per_text is not None:
+            results[i].update(_horizon_fields(_horizon_from_entities(entities_per_text[position])))
+            results[i]['horizon_extracted_score'] = _date_entity_score(entities_per_text[position])
+    return results
+
+# Test
+# extract_horizons_batch(texts=['la météo à tours pour le 7 mars 2024', 'la météo à Lyon pour demain'])
+
+
+# Async variants : the CPU-bound SpaCy and local pipelines run in a thread, the remote API uses the shared aiohttp pool
+async def extract_city_async(text):
+    return await asyncio.to_thread(extract_city, text)
+
+
+async def _entities_from_remote_async(texts, batch_size=32):
+
+    from h_service_async_http import get_async_session
+
+    session = get_async_session()
+    entities_per_text = []
+    for start in range(0, len(texts), batch_size):
+        request_start = time.perf_counter()
+        async with session.post(HF_NER_API_URL, headers=_hf_headers(),
+                                json={"inputs": texts[start:start + batch_size]}) as response:
+            if response.status != 200:
+                return response.status, None
+            payload = await response.read()
+        record_upstream(time.perf_counter() - request_start, len(payload))
+        entities_per_text.extend(json.loads(payload))
+    return 200, entities_per_text
+
+
+@traced("horizon", status_key="horizon_extracted_info")
+async def extract_horizon_async(text, backend=None, use_rules=True):
+
+    # Part 0 - Zero-model first pass with the rules
+    if use_rules and text:
+        result = _horizon_from_rules(text)
+        if result is not None:
+            return result
+
+    # Part 1 - Extract NER with the configured backend(s), without blocking the event loop
+    code, entities_per_text = None, None
+    if text:
+        _horizon_metrics['model_calls'] += 1
+        for name in _horizon_backend_names(backend):
+            try:
+                if name == 'remote':
+                    code, entities_per_text = await _entities_from_remote_async([text])
+                else:
+                    code, entities_per_text = await asyncio.to_thread(HORIZON_NER_BACKENDS[name], [text])
+            except Exception as error:
+                print(f"Horizon NER backend {name} failed : {error}")
+                continue
+            if code == 200:
+                break
+            entities_per_text = None
+
+    # Part 2 - Convert date to horizon with datefinder
+    if entities_per_text is not None:
+        fields = _horizon_fields(_horizon_from_entities(entities_per_text[0]))
+        score = _date_entity_score(entities_per_text[0])
+    else:
+        fields = _horizon_fields(None, status="Failed")
+        score = None
+
+    return dict(fields,
+                horizon_extracted_code=code,
+                horizon_extracted_source="model",
+                horizon_extracted_score=score)
+
+# Test
+# asyncio.run(extract_horizon_async(text='je voudrais connaitre la météo à tours en France pour 7 mars 2024'))
+
+
+# Benchmark of the latency (p50/p95 in ms) of extract_horizon for each backend
+BENCHMARK_TEXTS = ["quelle est la météo à Tours pour les 3 prochains jours",
+                   "je voudrais connaitre la météo à Lyon pour demain",
+                   "quel temps fera-t-il à Paris le 7 mars 2024",
+                   "la météo à Marseille ce week-end"]
+
+def benchmark_horizon_backends(texts=BENCHMARK_TEXTS, backends=('remote', 'local', 'local_int8', 'local_onnx'), repeat=5):
+
+    report = {}
+    for name in backends:
+        # The first call (model loading, cold start of the API) is not measured
+        extract_horizon(texts[0], backend=name, use_rules=False)
+
+        latencies = []
+        for _ in range(repeat):
+            for text in texts:
+                start = time.perf_counter()
+                extract_horizon(text, backend=name, use_rules=False)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        percentiles = statistics.quantiles(latencies, n=100)
+        report[name] = {'p50_ms': round(percentiles[49], 2),
+                        'p95_ms': round(percentiles[94], 2),
+                        'calls': len(latencies)}
+    return report
+
+# Test
+# benchmark_horizon_backends(backends=('remote', 'local_int8'))
 
 
 # Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
 # "lundi dernier était le premier jour de Juillet à Blois et Paris"
 if __name__ == "__main__":
 
-    extract_city(argv[1])
-    extract_horizon(argv[1])
\ No newline at end of file
+    if argv[1] == "--benchmark":
+        for backend_name, backend_latency in benchmark_horizon_backends().items():
+            print(f"{backend_name} : {backend_latency}")
+    else:
+        extract_city(argv[1])
+        extract_horizon(argv[1])
@@ -4,36 +4,387 @@ Service for geocoding :
 
 This module can be processed as following :
 - `city` as a string is passed from the user input.
-- The Nominatim geocoder (from Open Street Map) is invoked.
+- The city is resolved by layers, from the fastest to the slowest :
+    1. an in-memory LRU cache,
+    2. an on-disk SQLite cache (`.geocoding_cache.sqlite`) with a TTL,
+    3. a local gazetteer of French cities (`data/fr_cities.csv`, simplemaps-like CSV) loaded into an array-backed index :
+    exact names and names with the same French phonetic key ("tour", "bordo"), mangled by the speech-to-text,
+    4. the Nominatim geocoder (from Open Street Map), with a rate limiter (1 request per second).
+    The closest city of the fuzzy search (trigrams + phonetic key) is only used when Nominatim fails : the gazetteer
+    has few cities and a close name is often another town ("Saint-Lô" is not "Saint-Malo").
+- The output carries the name of the city found (e.g. "Tours" for "tour") and the layer which found it.
 - The `user_agent` should be declared for OSM' monitoring purpose. `user_agent` is the name of your service.
 
 
 Ressources :
 - Geopy : https://github.com/geopy/geopy
 - Open Street Map : https://www.openstreetmap.fr/
+- Nominatim usage policy : https://operations.osmfoundation.org/policies/nominatim/
+- World cities database : https://simplemaps.com/data/world-cities
 """
 
-from geopy.geocoders import Nominatim
+from array import array
+import asyncio
+from bisect import bisect_left
+from collections import OrderedDict
+import csv
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import weakref
 from sys import argv
+from j_lazy_import import lazy_import
+from m_service_tracing import record_cache, record_upstream, traced
+
+# Geopy imported on first use (only needed when the local layers miss)
+geopy_geocoders = lazy_import("geopy.geocoders")
+geopy_rate_limiter = lazy_import("geopy.extra.rate_limiter")
+
+
+# Local gazetteer of the French cities (city, lat, lng, admin_name, population)
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "fr_cities.csv")
+# On-disk cache of the Nominatim results
+GEOCODING_CACHE_PATH = ".geocoding_cache.sqlite"
+GEOCODING_CACHE_TTL = 30 * 24 * 3600 # seconds
+# Size of the in-memory LRU cache
+GEOCODING_LRU_SIZE = 1024
+# Minimal score of the fuzzy search to accept a gazetteer candidate when Nominatim fails
+FUZZY_MIN_SCORE = 0.6
+# Nominatim usage policy : 1 request per second at most
+NOMINATIM_MIN_DELAY = 1
+# Nominatim server (a self-hosted instance or a local stand-in for the benchmark)
+NOMINATIM_DOMAIN = "nominatim.openstreetmap.org"
+NOMINATIM_SCHEME = "https"
+
+
+# Function dedicated to normalise a city name : lower case, no accents, no hyphens or apostrophes
+def normalise_city_name(name):
+
+    name = unicodedata.normalize("NFKD", name.strip().lower())
+    name = "".join(char for char in name if not unicodedata.combining(char))
+    for separator in ("-", "'", "’", "."):
+        name = name.replace(separator, " ")
+    words = name.split()
+    # "st etienne" and "saint etienne" share the same key
+    words = ["saint" if word == "st" else "sainte" if word == "ste" else word for word in words]
+    return " ".join(words)
+
+
+# Layer 1 : in-memory LRU cache --------------------------------------
+_lru_cache = OrderedDict()
+_lru_lock = threading.Lock()
+
+def _lru_get(key):
+    with _lru_lock:
+        value = _lru_cache.get(key)
+        if value is not None:
+            _lru_cache.move_to_end(key)
+        return value
+
+def _lru_set(key, value):
+    with _lru_lock:
+        _lru_cache[key] = value
+        _lru_cache.move_to_end(key)
+        if len(_lru_cache) > GEOCODING_LRU_SIZE:
+            _lru_cache.popitem(last=False)
+
+
+# Layer 2 : on-disk SQLite cache with TTL --------------------------------------
+_sqlite_connection = None
+_sqlite_lock = threading.Lock()
+
+def _get_sqlite_connection():
+
+    global _sqlite_connection
+    if _sqlite_connection is None:
+        connection = sqlite3.connect(GEOCODING_CACHE_PATH, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS geocoding_cache (
+                key TEXT PRIMARY KEY,
+                city TEXT,
+                lat REAL,
+                lon REAL,
+                created_at REAL
+            )
+        ''')
+        connection.commit()
+        _sqlite_connection = connection
+    return _sqlite_connection
+
+def _sqlite_get(key):
+    with _sqlite_lock:
+        row = _get_sqlite_connection().execute(
+            "SELECT city, lat, lon FROM geocoding_cache WHERE key = ? AND created_at > ?",
+            (key, time.time() - GEOCODING_CACHE_TTL)).fetchone()
+    return row
+
+def _sqlite_set(key, city, lat, lon):
+    with _sqlite_lock:
+        connection = _get_sqlite_connection()
+        connection.execute("INSERT OR REPLACE INTO geocoding_cache (key, city, lat, lon, created_at) VALUES (?, ?, ?, ?, ?)",
+                           (key, city, lat, lon, time.time()))
+        connection.commit()
+
+
+# Layer 3 : local gazetteer indexed by normalised name, trigrams and phonetic key --------------------------------------
+# French phonetic key : close spellings of the same pronunciation share the key ("tour"/"Tours", "bordo"/"Bordeaux")
+_PHONETIC_RULES = [(re.compile(p), r) for p, r in (
+    (r"[^a-z]", ""),
+    (r"h", ""),
+    (r"ph", "f"),
+    (r"ch|sh", "5"),
+    (r"qu|q", "k"),
+    (r"gu(?=[eiy])", "g"),
+    (r"g(?=[eiy])", "j"),
+    (r"c(?=[eiy])", "s"),
+    (r"ck|c", "k"),
+    (r"y", "i"),
+    (r"w", "v"),
+    (r"z", "s"),
+    (r"eil+e?", "el"),
+    (r"ail+e?", "al"),
+    (r"ill", "i"),
+    (r"[stxdp]+$", ""),
+    (r"eaux?|aux?|o", "o"),
+    (r"ou", "u"),
+    (r"oi", "wa"),
+    (r"(ai|ei|er|ez|et)$", "e"),
+    (r"ai|ei", "e"),
+    (r"[ae][nm](?![aeiou])", "an"),
+    (r"([aeu]i|i)[nm](?![aeiou])", "in"),
+    (r"e+$", ""),
+    (r"(.)\1+", r"\1"),
+)]
+
+def phonetic_key(name):
+    key = normalise_city_name(name)
+    for pattern, replacement in _PHONETIC_RULES:
+        key = pattern.sub(replacement, key)
+    return key
+
+
+# Trigrams of a normalised name, padded to weight the beginning of the name
+def _trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _Gazetteer:
+    """Sorted normalised keys with the coordinates stored in compact arrays (binary search lookup),
+    plus a trigram inverted index and a phonetic index for the fuzzy search."""
+
+    def __init__(self, path):
+
+        rows = {}
+        with open(path, encoding="utf-8", newline="") as file:
+            for row in csv.DictReader(file):
+                key = normalise_city_name(row['city'])
+                population = int(row['population'] or 0)
+                # Homonyms : the most populated city is kept
+                if key not in rows or population > rows[key][3]:
+                    rows[key] = (row['city'], float(row['lat']), float(row['lng']), population)
+
+        self.keys = sorted(rows)
+        self.names = [rows[key][0] for key in self.keys]
+        self.lat = array('d', (rows[key][1] for key in self.keys))
+        self.lon = array('d', (rows[key][2] for key in self.keys))
+        self.population = array('l', (rows[key][3] for key in self.keys))
+
+        # Inverted indexes : trigram -> cities, phonetic key -> cities
+        trigram_index, phonetic_index = {}, {}
+        self.trigram_counts = array('l')
+        for i, key in enumerate(self.keys):
+            trigrams = _trigrams(key)
+            self.trigram_counts.append(len(trigrams))
+            for trigram in trigrams:
+                trigram_index.setdefault(trigram, []).append(i)
+            phonetic_index.setdefault(phonetic_key(key), []).append(i)
+        self.trigram_index = {trigram: array('l', indexes) for trigram, indexes in trigram_index.items()}
+        self.phonetic_index = {code: array('l', indexes) for code, indexes in phonetic_index.items()}
+
+    def lookup(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.names[i], self.lat[i], self.lon[i]
+        return None
+
+    def sound_alike(self, key):
+        """Most populated city with the same phonetic key, as (index, score), or None."""
+        same_sound = self.phonetic_index.get(phonetic_key(key), ())
+        if not same_sound:
+            return None
+        i = max(same_sound, key=lambda j: self.population[j])
+        trigrams = _trigrams(key)
+        dice = 2 * len(trigrams & _trigrams(self.keys[i])) / (len(trigrams) + self.trigram_counts[i])
+        return i, 0.5 * dice + 0.5
+
+    def search(self, key, limit=5):
+        """Ranked (index, score) candidates, score in [0, 1] from the trigram similarity (Dice) and the phonetic key."""
+
+        trigrams = _trigrams(key)
+        shared = {}
+        for trigram in trigrams:
+            for i in self.trigram_index.get(trigram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        same_sound = set(self.phonetic_index.get(phonetic_key(key), ()))
+
+        scores = []
+        for i in shared.keys() | same_sound:
+            dice = 2 * shared.get(i, 0) / (len(trigrams) + self.trigram_counts[i])
+            score = max(dice, 0.5 * dice + 0.5 * (i in same_sound))
+            scores.append((score, self.population[i], i))
+        scores.sort(reverse=True)
+        return [(i, score) for score, _, i in scores[:limit]]
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+def get_gazetteer():
+
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                _gazetteer = _Gazetteer(GAZETTEER_PATH)
+    return _gazetteer
+
+
+# Layer 4 : Nominatim with a rate limiter --------------------------------------
+_nominatim_geocode = None
+
+def _get_nominatim_geocode():
+
+    global _nominatim_geocode
+    if _nominatim_geocode is None:
+        # Define the name of your app (for external service monitoring)
+        geolocator = geopy_geocoders.Nominatim(user_agent="vocal_weather_app", domain=NOMINATIM_DOMAIN,
+                                                scheme=NOMINATIM_SCHEME)
+        _nominatim_geocode = geopy_rate_limiter.RateLimiter(geolocator.geocode, min_delay_seconds=NOMINATIM_MIN_DELAY)
+    return _nominatim_geocode
+
+
+# Counters of the layer serving each lookup
+_geocoding_metrics = {'lru': 0, 'sqlite': 0, 'gazetteer': 0, 'gazetteer_phonetic': 0, 'gazetteer_fuzzy': 0,
+                      'nominatim': 0, 'failed': 0}
+
+def get_geocoding_metrics():
+    return dict(_geocoding_metrics)
+
+
+# Function dedicated to return the ranked candidates of the local gazetteer for a (misspelled) city name
+def search_city_candidates(city, limit=5):
+
+    gazetteer = get_gazetteer()
+    return [{'city': gazetteer.names[i],
+             'lat': gazetteer.lat[i],
+             'lon': gazetteer.lon[i],
+             'score': round(score, 3)}
+            for i, score in gazetteer.search(normalise_city_name(city), limit=limit)]
+
+# Test
+# search_city_candidates(city='saint étiene')
+
+
+# Function dedicated to resolve a city with the local layers only (no network), returns (city, lat, lon, score, source) or None
+def _resolve_locally(key):
+
+    value = _lru_get(key)
+    if value is not None:
+        _geocoding_metrics['lru'] += 1
+        return value + ('lru',)
+
+    row = _sqlite_get(key)
+    if row is not None:
+        _geocoding_metrics['sqlite'] += 1
+        value = tuple(row) + (None,)
+        _lru_set(key, value)
+        return value + ('sqlite',)
+
+    gazetteer = get_gazetteer()
+    value = gazetteer.lookup(key)
+    if value is not None:
+        _geocoding_metrics['gazetteer'] += 1
+        value = value + (1.0,)
+        _lru_set(key, value)
+        return value + ('gazetteer',)
+
+    # ASR-mangled names which sound like a city ("tour", "bordo") are recovered without any API call
+    alike = gazetteer.sound_alike(key)
+    if alike is not None:
+        i, score = alike
+        _geocoding_metrics['gazetteer_phonetic'] += 1
+        value = (gazetteer.names[i], gazetteer.lat[i], gazetteer.lon[i], score)
+        _lru_set(key, value)
+        return value + ('gazetteer_phonetic',)
+    return None
+
+
+# Function dedicated to return the closest city of the fuzzy search, when Nominatim fails (not cached : Nominatim
+# is asked again next time), returns (city, lat, lon, score, source) or None
+def _resolve_fuzzy(key):
+
+    gazetteer = get_gazetteer()
+    candidates = gazetteer.search(key, limit=1)
+    if candidates and candidates[0][1] >= FUZZY_MIN_SCORE:
+        i, score = candidates[0]
+        _geocoding_metrics['gazetteer_fuzzy'] += 1
+        return gazetteer.names[i], gazetteer.lat[i], gazetteer.lon[i], score, 'gazetteer_fuzzy'
+    return None
+
+
+# Function dedicated to store the Nominatim location into the caches
+def _resolve_from_location(key, city, location):
+
+    if location is None:
+        _geocoding_metrics['failed'] += 1
+        return None
+    _geocoding_metrics['nominatim'] += 1
+    _sqlite_set(key, city, location.latitude, location.longitude)
+    value = (city, location.latitude, location.longitude, None)
+    _lru_set(key, value)
+    return value + ('nominatim',)
+
+
+# Function dedicated to resolve a city through the layers, returns (city, lat, lon, score, source) or None
+# timeout : seconds of the Nominatim request (None : the geopy default)
+def resolve_city(city, timeout=None):
+
+    key = normalise_city_name(city)
+    resolved = _resolve_locally(key)
+    record_cache(resolved is not None)
+    if resolved is not None:
+        return resolved
+
+    # Send the user' city to geocode service, the fuzzy search of the gazetteer if it fails
+    start = time.perf_counter()
+    try:
+        location = _get_nominatim_geocode()(city, **({} if timeout is None else {'timeout': timeout}))
+    except Exception as error:
+        resolved = _resolve_fuzzy(key)
+        if resolved is None:
+            raise
+        print(f"Nominatim failed, closest city of the gazetteer : {error}")
+        return resolved
+    finally:
+        record_upstream(time.perf_counter() - start)
+    return (_resolve_fuzzy(key) if location is None else None) or _resolve_from_location(key, city, location)
+
+
+# Function dedicated to build the output of the service
+def _geocoding_output(city, geocoding_info, resolved):
 
-def city_to_coordinates(city):
-    
-    # Define the name of your app (for external service monitoring)
-    geolocator = Nominatim(user_agent="vocal_weather_app")
-    
-    if city is None:
-        city = "Tours" # default value if city recognition failed
-        geocoding_info = "Failed. No city from user input, city of Tours as default value."
-    else :
-        geocoding_info = "Successed"
-    
-    # Send the user' city to geocode service
-    location = geolocator.geocode(city)
     # Extract desired data : coordinates
-    lat = location.latitude
-    lon = location.longitude    
-        
-    if (lat or lon) is None :
+    if resolved is None:
+        lat, lon, geocoding_score, geocoding_source = None, None, None, None
+    else:
+        city, lat, lon, geocoding_score, geocoding_source = resolved
+
+    if (lat or lon) is None and geocoding_info == "Successed":
         geocoding_info = "Failed. OSM API service failed to return coordinates."
 
 
@@ -42,12 +393,80 @@ def city_to_coordinates(city):
     return({'city' : city,
             'lat' : lat,
             'lon' : lon,
-            'geocoding_info' : geocoding_info})
+            'geocoding_info' : geocoding_info,
+            'geocoding_score' : geocoding_score,
+            'geocoding_source' : geocoding_source})
+
+
+@traced("geocoding", status_key="geocoding_info")
+def city_to_coordinates(city, timeout=None):
+
+    # No default city : the quality gate (o_service_quality) re-prompts the user instead of geocoding a guess
+    if city is None:
+        return _geocoding_output(None, "Failed. No city from user input.", None)
+
+    # Resolve the user' city with the caches, the gazetteer or the geocode service
+    return _geocoding_output(city, "Successed", resolve_city(city, timeout=timeout))
 
 # Test
 # city_to_coordinates(city='Tours')
 
+
+# Async variant : the local layers (SQLite, gazetteer) run in a thread, Nominatim through geopy's aiohttp adapter
+# One geocoder per event loop, its aiohttp session is closed by h_service_async_http.close_async_sessions()
+_async_nominatim = weakref.WeakKeyDictionary()
+
+def _get_async_nominatim_geocode():
+
+    from geopy.adapters import AioHTTPAdapter
+    from h_service_async_http import on_close
+
+    loop = asyncio.get_running_loop()
+    geocode = _async_nominatim.get(loop)
+    if geocode is None:
+        geolocator = geopy_geocoders.Nominatim(user_agent="vocal_weather_app", domain=NOMINATIM_DOMAIN,
+                                                scheme=NOMINATIM_SCHEME, adapter_factory=AioHTTPAdapter)
+        geocode = geopy_rate_limiter.AsyncRateLimiter(geolocator.geocode, min_delay_seconds=NOMINATIM_MIN_DELAY)
+        _async_nominatim[loop] = geocode
+
+        async def _close():
+            _async_nominatim.pop(loop, None)
+            await geolocator.__aexit__(None, None, None)
+        on_close(_close)
+    return geocode
+
+
+@traced("geocoding", status_key="geocoding_info")
+async def city_to_coordinates_async(city):
+
+    if city is None:
+        return _geocoding_output(None, "Failed. No city from user input.", None)
+
+    # The SQLite cache and the gazetteer are blocking : they do not run on the event loop
+    key = normalise_city_name(city)
+    resolved = await asyncio.to_thread(_resolve_locally, key)
+    record_cache(resolved is not None)
+    if resolved is None:
+        start = time.perf_counter()
+        try:
+            location = await _get_async_nominatim_geocode()(city)
+        except Exception as error:
+            resolved = await asyncio.to_thread(_resolve_fuzzy, key)
+            if resolved is None:
+                raise
+            print(f"Nominatim failed, closest city of the gazetteer : {error}")
+            return _geocoding_output(city, "Successed", resolved)
+        finally:
+            record_upstream(time.perf_counter() - start)
+        resolved = await asyncio.to_thread(_resolve_fuzzy, key) if location is None else None
+        if resolved is None:
+            resolved = await asyncio.to_thread(_resolve_from_location, key, city, location)
+    return _geocoding_output(city, "Successed", resolved)
+
+# Test
+# asyncio.run(city_to_coordinates_async(city='Tours'))
+
 # Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
 if __name__ == "__main__":
 
-    city_to_coordinates(argv[1])
\ No newline at end of file
+    city_to_coordinates(argv[1])
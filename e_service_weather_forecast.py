@@ -1,77 +1,602 @@
-import openmeteo_requests
-import requests_cache
-import pandas as pd
-from retry_requests import retry
+"""
+Service for weather forecast :
+=====================
+
+This module can be processed as following :
+- The coordinates (`lat`, `lon`) and the `horizon` (number of forecast days) are passed from the geocoding and NER services.
+- The Open-Meteo API (Météo-France models) is invoked through one shared client, reused across calls and Streamlit reruns :
+pooled HTTP connections, default timeouts, retries on server errors and a thread-safe SQLite cache (WAL mode).
+- The hourly variables are declared once in `HOURLY_VARIABLES` (name, unit, dtype) : the spec drives the request
+and the decoding into a float32 block (variables x times), wrapped without copy into a DataFrame, or returned as is
+(`as_pandas=False`) for API consumers.
+- Many locations are forecast at once with `weather_forecast_batch()`, which packs the coordinates into multi-location requests.
+- The cache hit ratio and the request latency are exposed with `get_openmeteo_metrics()`.
+- A query planner maps the horizon to the data returned (`plan_forecast`) : the `current` conditions for "now",
+the `hourly` variables of the days asked only (`start_date`/`end_date`, no past days) up to PLAN_HOURLY_MAX_DAYS days,
+a `daily` summary for longer windows. The app gets only the variables it shows (`DISPLAY_VARIABLES`).
+- In front of the HTTP cache, a forecast cache keyed on the coordinates snapped to the model grid and the resolution
+holds the blocks fetched for the cell : the minimal requests of the app and the widest block of the pre-warmer
+(`fetch_plan(widen=True)` : FORECAST_MAX_DAYS days of every hourly variable). The plans covered by a block are slices
+of it, and the blocks expire when the next Météo-France run is published (`get_forecast_cache_metrics()` for the hits,
+misses and bytes).
+- The payload sizes and decoding times are exposed with `get_openmeteo_metrics()`
+(before/after comparison of the plans : python l_benchmark.py --plans).
+
+Ressources :
+- Open-Meteo : https://open-meteo.com/en/docs/meteofrance-api
+- Requests cache : https://requests-cache.readthedocs.io/en/stable/
+"""
+
+import asyncio
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta, timezone
+import statistics
+import threading
+import time
 from sys import argv
+from j_lazy_import import lazy_import
+from m_service_tracing import record_cache, record_upstream, traced
+
+# Heavy libraries imported on first use
+openmeteo_requests = lazy_import("openmeteo_requests")
+requests_cache = lazy_import("requests_cache")
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+# Open-Meteo end point (Météo-France models)
+OPENMETEO_URL = "https://api.open-meteo.com/v1/meteofrance"
+# SQLite cache of the responses (file `.cache.sqlite`)
+OPENMETEO_CACHE_NAME = ".cache"
+OPENMETEO_CACHE_EXPIRE = 3600 # seconds
+# Size of the pool of HTTP connections, to be set with the number of concurrent users
+OPENMETEO_POOL_SIZE = 10
+# Timeout (connect, read) in seconds
+OPENMETEO_TIMEOUT = (3.05, 10)
+
+# Declarative spec of the hourly variables : drives both the request and the decoding (order of the block rows)
+WeatherVariable = namedtuple('WeatherVariable', ['name', 'unit', 'dtype'])
+
+HOURLY_VARIABLES = (
+    WeatherVariable("temperature_2m", "°C", "float32"),
+    WeatherVariable("relative_humidity_2m", "%", "float32"),
+    WeatherVariable("precipitation", "mm", "float32"),
+    WeatherVariable("cloud_cover", "%", "float32"),
+    WeatherVariable("wind_speed_10m", "km/h", "float32"),
+)
+
+# Daily summary, for the windows longer than PLAN_HOURLY_MAX_DAYS days
+DAILY_VARIABLES = (
+    WeatherVariable("temperature_2m_max", "°C", "float32"),
+    WeatherVariable("temperature_2m_min", "°C", "float32"),
+    WeatherVariable("precipitation_sum", "mm", "float32"),
+)
+# Hourly variables shown by the app (graph and table)
+DISPLAY_VARIABLES = (HOURLY_VARIABLES[0], HOURLY_VARIABLES[2])
+
+# Decoded data without pandas : epoch seconds (int64) and one row of `values` per variable
+# (hourly, daily or current rows, see ForecastPlan.resolution)
+HourlyForecast = namedtuple('HourlyForecast', ['time', 'variables', 'values'])
+# Minimal request for a horizon : resolution ("current", "hourly" or "daily"), days asked (GMT dates) and variables
+ForecastPlan = namedtuple('ForecastPlan', ['resolution', 'start_date', 'end_date', 'variables'])
+# Number of locations packed in one multi-location request
+OPENMETEO_BATCH_SIZE = 50
+
+# Forecast cache : grid of the AROME France model (degrees), days fetched by the pre-warmer
+FORECAST_GRID_STEP = 0.025
+FORECAST_MAX_DAYS = 4
+# Longest window served with hourly data, a daily summary beyond
+PLAN_HOURLY_MAX_DAYS = FORECAST_MAX_DAYS
+# Météo-France runs every 3 hours (UTC), published by Open-Meteo about 2 hours after the run time
+MODEL_RUN_INTERVAL = 3 * 3600 # seconds
+MODEL_RUN_DELAY = 2 * 3600 # seconds
+# The current conditions are updated every 15 minutes
+CURRENT_INTERVAL = 900 # seconds
+FORECAST_CACHE_SIZE = 1024 # entries
+FORECAST_CACHE_BLOCKS = 4 # blocks per entry
+
+_openmeteo_client = None
+_openmeteo_lock = threading.Lock()
+_openmeteo_metrics = {'requests': 0, 'cache_hits': 0, 'payload_bytes': 0}
+_openmeteo_latencies_ms = deque(maxlen=1000)
+_decode_latencies_ms = deque(maxlen=1000)
+
+
+# Function dedicated to build the HTTP adapter applying a default timeout to every request
+# (the class is defined here to import requests only when the client is built)
+def _timeout_http_adapter(timeout=OPENMETEO_TIMEOUT, **kwargs):
+
+    from requests.adapters import HTTPAdapter
+
+    class _TimeoutHTTPAdapter(HTTPAdapter):
+
+        def send(self, request, **send_kwargs):
+            if send_kwargs.get('timeout') is None:
+                send_kwargs['timeout'] = timeout
+            return super().send(request, **send_kwargs)
+
+    return _TimeoutHTTPAdapter(**kwargs)
+
+
+# Hook counting the responses served by the cache, the others are upstream calls of the current span
+def _record_response(response, *args, **kwargs):
+    _openmeteo_metrics['requests'] += 1
+    if getattr(response, 'from_cache', False):
+        _openmeteo_metrics['cache_hits'] += 1
+    else:
+        _openmeteo_metrics['payload_bytes'] += len(response.content)
+        record_upstream(response.elapsed.total_seconds(), len(response.content))
+    return response
+
+
+# Function dedicated to build (once) the Open-Meteo client shared by every call
+# (settings left to None are read from the module when the client is built, so they can be configured before)
+def get_openmeteo_client(pool_size=None, timeout=None, cache_name=None, expire_after=None):
+
+    global _openmeteo_client
+    if _openmeteo_client is None:
+        with _openmeteo_lock:
+            if _openmeteo_client is None:
+                pool_size = OPENMETEO_POOL_SIZE if pool_size is None else pool_size
+                timeout = OPENMETEO_TIMEOUT if timeout is None else timeout
+                cache_name = OPENMETEO_CACHE_NAME if cache_name is None else cache_name
+                expire_after = OPENMETEO_CACHE_EXPIRE if expire_after is None else expire_after
+                # Setup the Open-Meteo API client with cache and retry on error
+                cache_backend = requests_cache.SQLiteCache(cache_name, wal=True)
+                cache_session = requests_cache.CachedSession(backend=cache_backend, expire_after=expire_after)
+                from urllib3.util.retry import Retry
+                retries = Retry(total=5, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+                adapter = _timeout_http_adapter(timeout=timeout, pool_connections=pool_size, pool_maxsize=pool_size,
+                                                max_retries=retries)
+                cache_session.mount("https://", adapter)
+                cache_session.mount("http://", adapter)
+                cache_session.hooks['response'].append(_record_response)
+                _openmeteo_client = openmeteo_requests.Client(session=cache_session)
+    return _openmeteo_client
+
+
+# Function dedicated to expose the cache hit ratio, the latency of the Open-Meteo requests and the decoding time
+def get_openmeteo_metrics():
+
+    metrics = dict(_openmeteo_metrics)
+    metrics['cache_hit_ratio'] = metrics['cache_hits'] / metrics['requests'] if metrics['requests'] else None
+    for name, latencies in (('latency', list(_openmeteo_latencies_ms)), ('decode', list(_decode_latencies_ms))):
+        if len(latencies) >= 2:
+            percentiles = statistics.quantiles(latencies, n=100)
+            metrics[f'{name}_p50_ms'] = round(percentiles[49], 3)
+            metrics[f'{name}_p95_ms'] = round(percentiles[94], 3)
+    return metrics
+
+
+# Function dedicated to decode a series (hourly or daily) into a preallocated 2-D block (variables x times)
+def _decode_series(series, variables):
+
+    times = np.arange(series.Time(), series.TimeEnd(), series.Interval(), dtype="int64")
+    values = np.empty((len(variables), times.shape[0]), dtype=np.result_type(*(variable.dtype for variable in variables)))
+    # The order of variables is the same as requested
+    for i in range(len(variables)):
+        values[i] = series.Variables(i).ValuesAsNumpy()
+    return HourlyForecast(time=times, variables=tuple(variable.name for variable in variables), values=values)
 
 
-def weather_forecast_from_coord(lat, lon, horizon=1):
+# Function dedicated to decode the hourly data of one response
+def decode_hourly(response, variables=HOURLY_VARIABLES):
+    return _decode_series(response.Hourly(), variables)
 
-    # Setup the Open-Meteo API client with cache and retry on error
-    cache_session = requests_cache.CachedSession('.cache', expire_after = 3600)
-    retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
-    openmeteo = openmeteo_requests.Client(session = retry_session)
 
-    # Make sure all required weather variables are listed here
-    # The order of variables in hourly or daily is important to assign them correctly below
-    url = "https://api.open-meteo.com/v1/meteofrance"
+# Function dedicated to decode one response at the resolution of the plan (the current conditions are one column)
+def decode_forecast(response, plan):
+
+    if plan.resolution == "hourly":
+        return _decode_series(response.Hourly(), plan.variables)
+    if plan.resolution == "daily":
+        return _decode_series(response.Daily(), plan.variables)
+    current = response.Current()
+    values = np.array([[current.Variables(i).Value()] for i in range(len(plan.variables))],
+                      dtype=np.result_type(*(variable.dtype for variable in plan.variables)))
+    return HourlyForecast(time=np.array([current.Time()], dtype="int64"),
+                          variables=tuple(variable.name for variable in plan.variables), values=values)
+
+
+# Function dedicated to decode the responses and to record the decoding time
+def _decode_timed(response, plan):
+
+    start = time.perf_counter()
+    forecast = decode_forecast(response, plan)
+    _decode_latencies_ms.append((time.perf_counter() - start) * 1000)
+    return forecast
+
+
+# Function dedicated to wrap the decoded block into a DataFrame without copying the values
+def hourly_to_dataframe(forecast):
+
+    # values.T is a view : pandas keeps the block as is (one float block, no copy)
+    weather_df = pd.DataFrame(forecast.values.T, columns=list(forecast.variables), copy=False)
+    weather_df.insert(0, "date", pd.to_datetime(forecast.time, unit="s", utc=True))
+    return weather_df
+
+
+# Function dedicated to plan the minimal request of a horizon
+# horizon : number of forecast days from today (NER output), window : days asked (HorizonWindow of the NER rules)
+# hourly_max_days : longest window served with hourly data (None : always hourly)
+def plan_forecast(horizon=1, window=None, variables=HOURLY_VARIABLES, today=None, hourly_max_days=PLAN_HOURLY_MAX_DAYS):
+
+    today = today or datetime.now(timezone.utc).date()
+    if window is not None and getattr(window, 'now', False):
+        return ForecastPlan("current", today, today, tuple(variables))
+    if window is not None:
+        first_day, last_day = window.first_day, window.last_day
+    else:
+        first_day, last_day = 0, max(1, horizon or 1) - 1
+
+    start_date, end_date = today + timedelta(days=first_day), today + timedelta(days=last_day)
+    if hourly_max_days is not None and last_day - first_day + 1 > hourly_max_days:
+        return ForecastPlan("daily", start_date, end_date, DAILY_VARIABLES)
+    return ForecastPlan("hourly", start_date, end_date, tuple(variables))
+
+# Test
+# plan_forecast(horizon=2, window=extract_horizon_window("demain")) : hourly data of tomorrow only
+# plan_forecast(horizon=10) : daily summary of 10 days
+
+
+# Function dedicated to return the request fetched for a plan : the plan itself (minimal request) by default
+# widen : the widest block of the grid cell, the plan is a slice of it (the pre-warmer, see weather_forecast_batch)
+# - hourly : from today to FORECAST_MAX_DAYS days at least, every hourly variable (the same request for every hourly plan)
+# - daily : from today, every daily variable
+def fetch_plan(plan, today=None, widen=False):
+
+    if not widen or plan.resolution == "current":
+        return plan
+    today = min(today or datetime.now(timezone.utc).date(), plan.start_date)
+    end_date = plan.end_date
+    spec = HOURLY_VARIABLES if plan.resolution == "hourly" else DAILY_VARIABLES
+    if plan.resolution == "hourly":
+        end_date = max(end_date, today + timedelta(days=FORECAST_MAX_DAYS - 1))
+    variables = tuple(spec) + tuple(variable for variable in plan.variables if variable not in spec)
+    return ForecastPlan(plan.resolution, today, end_date, variables)
+
+
+# Function dedicated to build the request parameters from the plan
+def _forecast_params(lat, lon, plan):
+
+    # The weather variables are listed in the spec, the same order is used to assign them below
     params = {
         "latitude": lat,
         "longitude": lon,
-        "hourly": ["temperature_2m", "relative_humidity_2m", "precipitation", "cloud_cover", "wind_speed_10m"],
+        plan.resolution: [variable.name for variable in plan.variables],
         "timezone": "GMT",
-        "past_days": 2,
-        "forecast_days": horizon
     }
-    responses = openmeteo.weather_api(url, params=params)
-    
-    if responses is None:
+    if plan.resolution != "current":
+        params["start_date"] = plan.start_date.isoformat()
+        params["end_date"] = plan.end_date.isoformat()
+    return params
+
+
+# Function dedicated to snap the coordinates to the model grid : every point of a grid cell gets the same forecast
+def snap_to_grid(lat, lon, step=FORECAST_GRID_STEP):
+    return round(round(float(lat) / step) * step, 4), round(round(float(lon) / step) * step, 4)
+
+
+# Function dedicated to return the time (epoch seconds) at which the next model run is published
+def next_model_run(now=None, interval=MODEL_RUN_INTERVAL, delay=MODEL_RUN_DELAY):
+
+    now = time.time() if now is None else now
+    # Latest run already published, the next one is published one interval later
+    published_run = (now - delay) // interval * interval
+    return published_run + interval + delay
+
+
+# Function dedicated to return the time (epoch seconds) at which a forecast of the plan is outdated
+def plan_expiry(plan, now=None):
+
+    now = time.time() if now is None else now
+    if plan.resolution == "current":
+        return min(next_model_run(now), (now // CURRENT_INTERVAL + 1) * CURRENT_INTERVAL)
+    return next_model_run(now)
+
+
+# Function dedicated to cut a forecast to the days and the variables of a plan (views of the block if all the variables)
+def slice_plan(forecast, plan):
+
+    rows = [forecast.variables.index(variable.name) for variable in plan.variables]
+    values = forecast.values if rows == list(range(len(forecast.variables))) else forecast.values[rows]
+    if plan.resolution != "current":
+        # The days are GMT dates, the times are epoch seconds
+        start = datetime(plan.start_date.year, plan.start_date.month, plan.start_date.day, tzinfo=timezone.utc).timestamp()
+        start, end = np.searchsorted(forecast.time, [start, start + ((plan.end_date - plan.start_date).days + 1) * 86400])
+        return HourlyForecast(time=forecast.time[start:end], variables=tuple(forecast.variables[i] for i in rows),
+                              values=values[:, start:end])
+    return HourlyForecast(time=forecast.time, variables=tuple(forecast.variables[i] for i in rows), values=values)
+
+
+class ForecastCache:
+    """Thread-safe LRU cache of decoded forecasts keyed on (grid latitude, grid longitude, resolution).
+
+    A key holds up to FORECAST_CACHE_BLOCKS blocks fetched for its grid cell : the minimal blocks of the app and the widest
+    block of the pre-warmer (see `fetch_plan`), a block covered by a new one is dropped. The plans covered by a block are
+    slices of it. A block expires when the next model run is published (every 15 minutes for the current conditions).
+    """
+
+    def __init__(self, max_entries=FORECAST_CACHE_SIZE, max_blocks=FORECAST_CACHE_BLOCKS):
+        self.max_entries = max_entries
+        self.max_blocks = max_blocks
+        self.entries = OrderedDict()  # key -> [(forecast, plan, expires_at)]
+        self.lock = threading.Lock()
+        self.metrics = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'bytes': 0, 'bytes_served': 0}
+
+    @staticmethod
+    def _covers(cached, plan):
+        return (cached.start_date <= plan.start_date and plan.end_date <= cached.end_date
+                and set(plan.variables) <= set(cached.variables))
+
+    @staticmethod
+    def _nbytes(forecast):
+        return forecast.time.nbytes + forecast.values.nbytes
+
+    # Blocks of the key which are not expired (lock held)
+    def _live(self, key, now):
+        blocks = self.entries.get(key, [])
+        live = [block for block in blocks if block[2] > now]
+        if len(live) < len(blocks):
+            self.metrics['expired'] += len(blocks) - len(live)
+            self.metrics['bytes'] -= sum(self._nbytes(block[0]) for block in blocks if block[2] <= now)
+            if live:
+                self.entries[key] = live
+            else:
+                del self.entries[key]
+        return live
+
+    def get(self, key, plan, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            block = next((block for block in self._live(key, now) if self._covers(block[1], plan)), None)
+            if block is None:
+                self.metrics['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            forecast = slice_plan(block[0], plan)
+            self.metrics['hits'] += 1
+            self.metrics['bytes_served'] += self._nbytes(forecast)
+            return forecast
+
+    def put(self, key, forecast, plan, now=None):
+        now = time.time() if now is None else now
+        expires_at = plan_expiry(plan, now)
+        with self.lock:
+            blocks = self._live(key, now)
+            # A block covering the new one (e.g. stored meanwhile by another thread) is kept as is
+            if any(self._covers(block[1], plan) for block in blocks):
+                return
+            # The blocks covered by the new one are dropped, then the oldest ones beyond `max_blocks`
+            covered = [block for block in blocks if self._covers(plan, block[1])]
+            kept = [block for block in blocks if not self._covers(plan, block[1])] + [(forecast, plan, expires_at)]
+            evicted, kept = kept[:-self.max_blocks], kept[-self.max_blocks:]
+            self.metrics['bytes'] += self._nbytes(forecast) - sum(self._nbytes(block[0]) for block in covered + evicted)
+            self.metrics['evictions'] += len(evicted)
+            self.entries[key] = kept
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.metrics['evictions'] += 1
+
+    def _remove(self, key):
+        for forecast, _, _ in self.entries.pop(key):
+            self.metrics['bytes'] -= self._nbytes(forecast)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.metrics['bytes'] = 0
+
+
+_forecast_cache = ForecastCache()
+
+
+# Function dedicated to expose the hits, misses and memory of the forecast cache
+def get_forecast_cache_metrics():
+
+    with _forecast_cache.lock:
+        metrics = dict(_forecast_cache.metrics)
+        metrics['entries'] = len(_forecast_cache.entries)
+    lookups = metrics['hits'] + metrics['misses']
+    metrics['hit_ratio'] = metrics['hits'] / lookups if lookups else None
+    return metrics
+
+
+# Function dedicated to return the cache key, the plan fetched on a miss and its request parameters (grid point)
+def _cached_request(lat, lon, plan):
+
+    grid_lat, grid_lon = snap_to_grid(lat, lon)
+    key = (grid_lat, grid_lon, plan.resolution)
+    fetched = fetch_plan(plan)
+    return key, fetched, _forecast_params(grid_lat, grid_lon, fetched)
+
+
+# Function dedicated to build the output of the service from the decoded forecast (None if the request failed)
+# weather_hourly : decoded block at the resolution of the plan (hourly, daily or current)
+def _forecast_output(weather_hourly, horizon, plan, as_pandas=True, cache_hit=None):
+
+    weather_data = None
+    weather_df = None
+    if weather_hourly is None:
         weather_info = "Failed"
-        weather_data = None
-        weather_df = None
         
     else:
         weather_info = "Successed"
 
-        # Process first location. Add a for-loop for multiple locations or weather models
-        response = responses[0]
-        #print(f"Coordinates {response.Latitude()}°N {response.Longitude()}°E")
-        #print(f"Elevation {response.Elevation()} m asl")
-        #print(f"Timezone {response.Timezone()} {response.TimezoneAbbreviation()}")
-        #print(f"Timezone difference to GMT+0 {response.UtcOffsetSeconds()} s")
-
-        # Process hourly data. The order of variables needs to be the same as requested.
-        hourly = response.Hourly()
-        hourly_temperature_2m = hourly.Variables(0).ValuesAsNumpy()
-        hourly_relative_humidity_2m = hourly.Variables(1).ValuesAsNumpy()
-        hourly_precipitation = hourly.Variables(2).ValuesAsNumpy()
-        hourly_cloud_cover = hourly.Variables(3).ValuesAsNumpy()
-        hourly_wind_speed_10m = hourly.Variables(4).ValuesAsNumpy()
-
-        hourly_data = {"date": pd.date_range(
-            start = pd.to_datetime(hourly.Time(), unit = "s", utc = True),
-            end = pd.to_datetime(hourly.TimeEnd(), unit = "s", utc = True),
-            freq = pd.Timedelta(seconds = hourly.Interval()),
-            inclusive = "left"
-        )}
-        hourly_data["temperature_2m"] = hourly_temperature_2m
-        hourly_data["relative_humidity_2m"] = hourly_relative_humidity_2m
-        hourly_data["precipitation"] = hourly_precipitation
-        hourly_data["cloud_cover"] = hourly_cloud_cover
-        hourly_data["wind_speed_10m"] = hourly_wind_speed_10m
-
-        weather_df = pd.DataFrame(data = hourly_data)
-        if weather_df.shape[0] > 0:
-            weather_data = "OK"
+        # Process the block into the DataFrame (optional for API consumers)
+        # Number of hourly rows of the forecast
+        if weather_hourly.time.shape[0] > 0:
+            weather_data = int(weather_hourly.time.shape[0])
+        if as_pandas:
+            weather_df = hourly_to_dataframe(weather_hourly)
         #print(weather_df)
     
     return({'weather_info' : weather_info,
             'weather_data': weather_data,
             'forecast_horizon' : horizon,
-            'weather_df': weather_df})
+            'forecast_resolution': plan.resolution,
+            'weather_df': weather_df,
+            'weather_hourly': weather_hourly,
+            'weather_cache_hit': cache_hit})
+
+
+# window : days asked (HorizonWindow of the NER rules), None for the `horizon` days from today
+# timeout : seconds of the HTTP request (None : OPENMETEO_TIMEOUT)
+@traced("weather", status_key="weather_info")
+def weather_forecast_from_coord(lat, lon, horizon=1, variables=HOURLY_VARIABLES, as_pandas=True, window=None,
+                                timeout=None):
+
+    # Days and variables asked, then the forecast cache : the grid cell may already cover them
+    plan = plan_forecast(horizon, window, variables)
+    key, fetched, params = _cached_request(lat, lon, plan)
+    weather_hourly = _forecast_cache.get(key, plan)
+    cache_hit = weather_hourly is not None
+    record_cache(cache_hit)
+
+    if weather_hourly is None:
+        # Shared Open-Meteo API client with cache and retry on error
+        openmeteo = get_openmeteo_client()
+
+        start = time.perf_counter()
+        # The HTTP cache entry expires with the model run too, a refresh never gets the previous run
+        responses = openmeteo.weather_api(OPENMETEO_URL, params=params, timeout=timeout,
+                                          expire_after=max(1, int(plan_expiry(fetched) - time.time())))
+        _openmeteo_latencies_ms.append((time.perf_counter() - start) * 1000)
+
+        if responses:
+            # Process first location, see weather_forecast_batch for multiple locations
+            forecast = _decode_timed(responses[0], fetched)
+            _forecast_cache.put(key, forecast, fetched)
+            weather_hourly = slice_plan(forecast, plan)
+
+    return _forecast_output(weather_hourly, horizon, plan, as_pandas, cache_hit)
 
 # Test:
 # weather_forecast_from_coord(lat=47.3900474, lon=0.6889268)
+# weather_forecast_from_coord(lat=47.3900474, lon=0.6889268, as_pandas=False)['weather_hourly']
+# weather_forecast_from_coord(lat=47.3900474, lon=0.6889268, horizon=10) : daily summary
+
+
+# Function dedicated to split the FlatBuffers payload of Open-Meteo into responses (as openmeteo_requests does)
+def _parse_flatbuffers(data):
+
+    from openmeteo_sdk.WeatherApiResponse import WeatherApiResponse
+
+    responses = []
+    position = 0
+    while position < len(data):
+        length = int.from_bytes(data[position:position + 4], byteorder="little")
+        responses.append(WeatherApiResponse.GetRootAs(data, position + 4))
+        position += length + 4
+    return responses
+
+
+# Async variant with the shared aiohttp pool (the forecast cache is shared, the requests_cache SQLite cache is not used)
+# timeout : total seconds of the HTTP request (None : ASYNC_TIMEOUT of the shared session)
+# An HTTP error or a timeout gives the failed output of the sync variant
+@traced("weather", status_key="weather_info")
+async def weather_forecast_from_coord_async(lat, lon, horizon=1, variables=HOURLY_VARIABLES, as_pandas=True,
+                                            window=None, timeout=None):
+
+    import aiohttp
+    from h_service_async_http import get_async_session
+
+    plan = plan_forecast(horizon, window, variables)
+    key, fetched, params = _cached_request(lat, lon, plan)
+    weather_hourly = _forecast_cache.get(key, plan)
+    cache_hit = weather_hourly is not None
+    record_cache(cache_hit)
+
+    if weather_hourly is None:
+        params[plan.resolution] = ",".join(params[plan.resolution])
+        params["format"] = "flatbuffers"
+
+        start = time.perf_counter()
+        try:
+            async with get_async_session().get(OPENMETEO_URL, params=params,
+                                               timeout=aiohttp.ClientTimeout(total=timeout) if timeout else None
+                                               ) as response:
+                response.raise_for_status()
+                data = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            print(f"Open-Meteo request failed : {error!r}")
+            data = None
+        _openmeteo_latencies_ms.append((time.perf_counter() - start) * 1000)
+
+        if data:
+            _openmeteo_metrics['payload_bytes'] += len(data)
+            record_upstream(time.perf_counter() - start, len(data))
+
+            # Decoding and DataFrame building are CPU bound : they do not run on the event loop
+            forecast = await asyncio.to_thread(_decode_timed, _parse_flatbuffers(data)[0], fetched)
+            _forecast_cache.put(key, forecast, fetched)
+            weather_hourly = slice_plan(forecast, plan)
+
+    return await asyncio.to_thread(_forecast_output, weather_hourly, horizon, plan, as_pandas, cache_hit)
+
+# Test:
+# asyncio.run(weather_forecast_from_coord_async(lat=47.3900474, lon=0.6889268))
+
+
+# Multi-location forecast : the coordinates are packed into chunked requests (vectorised latitude/longitude parameters)
+# Returns one long-format DataFrame (location_id, lat, lon, date, variables) or a dict of frames keyed by (lat, lon)
+# warm_cache : the widest block of the grid cell of each location is requested and stored in the forecast cache,
+# as on a miss of weather_forecast_from_coord (the coordinates of the output are the grid points)
+def weather_forecast_batch(coords, horizon=1, chunk_size=OPENMETEO_BATCH_SIZE, as_dict=False, variables=HOURLY_VARIABLES,
+                           warm_cache=False):
+
+    openmeteo = get_openmeteo_client()
+    coords = list(coords)
+    # Hourly data of the `horizon` days from today, whatever the horizon
+    plan = plan_forecast(horizon, variables=variables, hourly_max_days=None)
+    if warm_cache:
+        plan = fetch_plan(plan, widen=True)
+        coords = [snap_to_grid(lat, lon) for lat, lon in coords]
+
+    forecasts = []
+    for chunk_start in range(0, len(coords), chunk_size):
+        chunk = coords[chunk_start:chunk_start + chunk_size]
+        params = _forecast_params([lat for lat, _ in chunk], [lon for _, lon in chunk], plan)
+        start = time.perf_counter()
+        responses = openmeteo.weather_api(OPENMETEO_URL, params=params,
+                                          expire_after=max(1, int(plan_expiry(plan) - time.time())))
+        _openmeteo_latencies_ms.append((time.perf_counter() - start) * 1000)
+
+        # The responses are in the same order as the requested locations
+        decoded = [decode_hourly(response, plan.variables) for response in responses]
+        if warm_cache:
+            for (lat, lon), forecast in zip(chunk, decoded):
+                _forecast_cache.put((lat, lon, plan.resolution), forecast, plan)
+        forecasts.extend(decoded)
+
+    if not forecasts:
+        return {} if as_dict else None
+
+    # One concatenation of the blocks instead of one DataFrame per location
+    sizes = [forecast.time.shape[0] for forecast in forecasts]
+    location_id = np.repeat(np.arange(len(forecasts), dtype="int32"), sizes)
+    coords_array = np.asarray(coords, dtype="float64")
+    values = np.concatenate([forecast.values for forecast in forecasts], axis=1)
+
+    weather_df = hourly_to_dataframe(HourlyForecast(time=np.concatenate([forecast.time for forecast in forecasts]),
+                                                    variables=forecasts[0].variables,
+                                                    values=values))
+    weather_df.insert(0, "lon", coords_array[location_id, 1])
+    weather_df.insert(0, "lat", coords_array[location_id, 0])
+    weather_df.insert(0, "location_id", location_id)
+
+    if not as_dict:
+        return weather_df
+
+    # Frames per location are slices of the long-format frame (rows are grouped by location)
+    bounds = np.cumsum([0] + sizes)
+    return {tuple(coords[i]): weather_df.iloc[bounds[i]:bounds[i + 1]].reset_index(drop=True)
+            for i in range(len(forecasts))}
+
+# Test:
+# weather_forecast_batch(coords=[(47.3900474, 0.6889268), (45.7578137, 4.8320114)], horizon=3)
+
 
 # Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
 if __name__ == "__main__":
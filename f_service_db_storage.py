@@ -9,8 +9,12 @@ First, actions are needed on Azure :
 
 Then, this module can be processed as following :
 - Credentials are available as environnement variables
-- One function is dedicated to store data
-- One function is dedicated to retrieve data from the db
+- One function is dedicated to store data : the records are queued and written by batches by a background writer,
+with a pool of connections and the table created once per process (flushed on shutdown)
+- One function is dedicated to retrieve data from the db : time-range and status filters, keyset pagination on the
+indexed (timestamp, id) (rows without timestamp first) and one page per query into DataFrames (or Arrow batches)
+- The table created with `timestamp NVARCHAR(100)` is migrated to `DATETIME2` with `migrate_database()`
+- DB_BACKEND=sqlite in the .env file uses a local SQLite file instead of Azure SQL (tests, development)
 
 Ressources :
 - ODBC Driver : https://learn.microsoft.com/en-us/sql/connect/odbc/download-odbc-driver-for-sql-server?view=sql-server-ver16
@@ -19,16 +23,140 @@ Ressources :
 
 """
 
-import pyodbc
-import pandas as pd
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from dotenv import dotenv_values
+from j_lazy_import import lazy_import
+from m_service_tracing import traced
+
+# Heavy libraries imported on first use (pyodbc is not needed with the SQLite backend)
+pyodbc = lazy_import("pyodbc")
+pd = lazy_import("pandas")
 from time import gmtime, strftime
+from sys import argv
+
+
+# Backend of the monitoring DB, set with DB_BACKEND in the .env file : "azure" (Azure SQL with ODBC) or "sqlite" (local stand-in)
+DB_DEFAULT_BACKEND = "azure"
+DB_DEFAULT_SQLITE_PATH = "weather_app_monitoring.sqlite"
+# Size of the connection pool
+DB_POOL_SIZE = 5
+# The background writer flushes the queued records every DB_WRITER_BATCH_SIZE records or DB_WRITER_FLUSH_INTERVAL seconds
+DB_WRITER_BATCH_SIZE = 100
+DB_WRITER_FLUSH_INTERVAL = 5.0
+
+# Quality and latency columns (name, Azure SQL type, SQLite type), added by the migrations to new and existing tables
+QUALITY_COLUMNS = (
+    ("speech_confidence", "FLOAT", "REAL"),
+    ("extract_horizon_score", "FLOAT", "REAL"),
+    ("geocoding_score", "FLOAT", "REAL"),
+    ("geocoding_cache_hit", "BIT", "INTEGER"),
+    ("weather_cache_hit", "BIT", "INTEGER"),
+    ("speech_ms", "FLOAT", "REAL"),
+    ("extract_city_ms", "FLOAT", "REAL"),
+    ("extract_horizon_ms", "FLOAT", "REAL"),
+    ("geocoding_ms", "FLOAT", "REAL"),
+    ("weather_ms", "FLOAT", "REAL"),
+    # Decision of the quality gate : proceed, fuzzy_gazetteer, last_city or reprompt
+    ("quality_decision", "NVARCHAR(50)", "TEXT"),
+)
+
+# weather_data : number of hourly rows of the forecast
+MONITORING_COLUMNS = ("timestamp", "speech_status", "speech_text", "extract_city_status", "extract_city_text",
+                      "extract_horizon_status", "extract_horizon_text", "geocoding_status", "geocoding_city",
+                      "geocoding_lat", "geocoding_lon", "weather_status", "weather_data") \
+                     + tuple(name for name, _, _ in QUALITY_COLUMNS)
+
+AZURE_CREATE_TABLE = '''
+    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'weather_app_monitoring')
+    BEGIN
+        CREATE TABLE weather_app_monitoring (
+            id INT IDENTITY(1,1) NOT NULL PRIMARY KEY,
+            timestamp DATETIME2(0),
+            speech_status NVARCHAR(100),
+            speech_text NVARCHAR(1000),
+            extract_city_status NVARCHAR(100),
+            extract_city_text NVARCHAR(1000),
+            extract_horizon_status NVARCHAR(100),
+            extract_horizon_text NVARCHAR(1000),
+            geocoding_status NVARCHAR(100),
+            geocoding_city NVARCHAR(1000),
+            geocoding_lat FLOAT(16),
+            geocoding_lon FLOAT(16),
+            weather_status NVARCHAR(100),
+            weather_data NVARCHAR(100)          
+        );
+    END;
+'''
+
+# Migration of a table created with `timestamp NVARCHAR(100)` and without `id` : each statement is idempotent
+# and runs in its own batch (SQL Server compiles a batch before the new columns exist)
+AZURE_MIGRATIONS = (
+    '''IF COL_LENGTH('weather_app_monitoring', 'id') IS NULL
+           ALTER TABLE weather_app_monitoring ADD id INT IDENTITY(1,1) NOT NULL;''',
+    '''IF EXISTS (SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = 'weather_app_monitoring'
+                  AND COLUMN_NAME = 'timestamp' AND DATA_TYPE = 'nvarchar')
+           ALTER TABLE weather_app_monitoring ADD timestamp_dt DATETIME2(0) NULL;''',
+    '''IF COL_LENGTH('weather_app_monitoring', 'timestamp_dt') IS NOT NULL
+       BEGIN
+           EXEC('UPDATE weather_app_monitoring SET timestamp_dt = TRY_CONVERT(DATETIME2(0), timestamp, 120)');
+           EXEC('ALTER TABLE weather_app_monitoring DROP COLUMN timestamp');
+           EXEC sp_rename 'weather_app_monitoring.timestamp_dt', 'timestamp', 'COLUMN';
+       END;''',
+    '''IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_weather_app_monitoring_timestamp')
+           CREATE INDEX IX_weather_app_monitoring_timestamp ON weather_app_monitoring (timestamp, id);''',
+) + tuple(f"""IF COL_LENGTH('weather_app_monitoring', '{name}') IS NULL
+                  ALTER TABLE weather_app_monitoring ADD {name} {azure_type} NULL;"""
+          for name, azure_type, _ in QUALITY_COLUMNS)
+
+# SQLite : `id` is an alias of the rowid (also available on the tables created without it)
+SQLITE_CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS weather_app_monitoring (
+        id INTEGER PRIMARY KEY,
+        timestamp TEXT,
+        speech_status TEXT,
+        speech_text TEXT,
+        extract_city_status TEXT,
+        extract_city_text TEXT,
+        extract_horizon_status TEXT,
+        extract_horizon_text TEXT,
+        geocoding_status TEXT,
+        geocoding_city TEXT,
+        geocoding_lat REAL,
+        geocoding_lon REAL,
+        weather_status TEXT,
+        weather_data TEXT
+    );
+'''
+
+SQLITE_MIGRATIONS = (
+    "CREATE INDEX IF NOT EXISTS IX_weather_app_monitoring_timestamp ON weather_app_monitoring (timestamp)",
+)
+
+STATUS_COLUMNS = ("speech_status", "extract_city_status", "extract_horizon_status", "geocoding_status", "weather_status",
+                  "quality_decision")
+# Number of rows per page (keyset pagination)
+DB_READ_PAGE_SIZE = 10000
+
+
+# Function dedicated to return the backend of the DB
+def get_db_backend():
+    return dotenv_values(".env").get("DB_BACKEND") or DB_DEFAULT_BACKEND
+
 
 # Function dedicated for connection to the DB
 def connect_to_db():
     
     # Load credentials
     credentials = dotenv_values(".env")
+
+    # Local stand-in of the DB (tests, development without Azure)
+    if (credentials.get("DB_BACKEND") or DB_DEFAULT_BACKEND) == "sqlite":
+        return sqlite3.connect(credentials.get("DB_SQLITE_PATH") or DB_DEFAULT_SQLITE_PATH, check_same_thread=False)
     
     # This example requires environment variables named "AZURE_SPEECH_KEY" and "AZURE_SPEECH_REGION"  
     driver = credentials["AZURE_ODBC_DRIVER"]
@@ -60,90 +188,366 @@ def connect_to_db():
     return connection
 
 
-# Function dedicated to store data
-def save_to_database(speech, city, horizon, geocoding, weather):
+class ConnectionPool:
+    """Pool of open DB connections, the TLS handshake is paid once per connection instead of once per query."""
 
-    # Establish the connection to the DB
-    connection = connect_to_db()
-        
-    if connection:
-        cursor = connection.cursor()
+    def __init__(self, size=DB_POOL_SIZE, connect=connect_to_db):
+        self.size = size
+        self.connect = connect
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.opened = 0
+        self.lock = threading.Lock()
 
-        # Create table if not exists
-        cursor.execute('''
-            IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'weather_app_monitoring')
-            BEGIN
-                CREATE TABLE weather_app_monitoring (
-                    timestamp NVARCHAR(100),
-                    speech_status NVARCHAR(100),
-                    speech_text NVARCHAR(1000),
-                    extract_city_status NVARCHAR(100),
-                    extract_city_text NVARCHAR(1000),
-                    extract_horizon_status NVARCHAR(100),
-                    extract_horizon_text NVARCHAR(1000),
-                    geocoding_status NVARCHAR(100),
-                    geocoding_city NVARCHAR(1000),
-                    geocoding_lat FLOAT(16),
-                    geocoding_lon FLOAT(16),
-                    weather_status NVARCHAR(100),
-                    weather_data NVARCHAR(100)          
-                );
-            END;
-        ''')
-        
+    @contextmanager
+    def connection(self, timeout=30):
+        """Yield a connection (None if the DB is unreachable), given back to the pool afterwards."""
+
+        connection = None
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                if can_open:
+                    self.opened += 1
+            if can_open:
+                connection = self.connect()
+                if connection is None:
+                    with self.lock:
+                        self.opened -= 1
+            else:
+                connection = self.idle.get(timeout=timeout)
+
+        broken = False
+        try:
+            yield connection
+        except Exception:
+            broken = True
+            raise
+        finally:
+            if connection is not None:
+                if broken:
+                    # A failed connection is not reused
+                    self._discard(connection)
+                else:
+                    self.idle.put(connection)
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.opened -= 1
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+_pool = None
+_schema_ready = False
+_pool_lock = threading.Lock()
+
+
+# Function dedicated to return the connection pool, the schema is created once per process
+def get_connection_pool():
+
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+# Function dedicated to replace the connection pool (e.g. a SQLite stand-in for tests and benchmarks)
+def set_connection_pool(pool):
+
+    global _pool, _schema_ready
+    with _pool_lock:
+        _pool = pool
+        _schema_ready = False
+
+
+# Function dedicated to create the table and migrate an existing one (once per process instead of once per insert)
+def bootstrap_schema(connection):
+
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _pool_lock:
+        if not _schema_ready:
+            cursor = connection.cursor()
+            # Create table if not exists
+            if isinstance(connection, sqlite3.Connection):
+                statements = (SQLITE_CREATE_TABLE,) + SQLITE_MIGRATIONS
+            else:
+                statements = (AZURE_CREATE_TABLE,) + AZURE_MIGRATIONS
+            for statement in statements:
+                cursor.execute(statement)
+                connection.commit()
+            if isinstance(connection, sqlite3.Connection):
+                # SQLite has no ADD COLUMN IF NOT EXISTS : the missing columns are read from the table info
+                existing = {row[1] for row in cursor.execute("PRAGMA table_info(weather_app_monitoring)")}
+                for name, _, sqlite_type in QUALITY_COLUMNS:
+                    if name not in existing:
+                        cursor.execute(f"ALTER TABLE weather_app_monitoring ADD COLUMN {name} {sqlite_type}")
+                connection.commit()
+            _schema_ready = True
+
+
+# Function dedicated to migrate the table (timestamp NVARCHAR -> DATETIME2, id and index), to be run once on existing data
+def migrate_database():
+
+    with get_connection_pool().connection() as connection:
+        if connection is None:
+            print('Impossible to migrate the DB.')
+            return
+        bootstrap_schema(connection)
+
+
+# Function dedicated to insert many records at once
+def insert_records(records):
+
+    if not records:
+        return 0
+    with get_connection_pool().connection() as connection:
+        if connection is None:
+            print('Data not saved to DB.')
+            return 0
+        bootstrap_schema(connection)
+        cursor = connection.cursor()
+        if not isinstance(connection, sqlite3.Connection):
+            # One round trip for the whole batch with the ODBC driver
+            cursor.fast_executemany = True
         # Insert data into the table
-        cursor.execute("""
+        cursor.executemany(f"""
                     INSERT INTO weather_app_monitoring
-                    (timestamp, speech_status, speech_text, extract_city_status, extract_city_text, extract_horizon_status, extract_horizon_text,
-                    geocoding_status, geocoding_city, geocoding_lat, geocoding_lon, weather_status, weather_data)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (str(strftime("%Y-%m-%d %H:%M:%S", gmtime())),
-                        speech['speech_info'],
-                        speech['speech_text'],
-                        city['city_extracted_info'],
-                        city['city_extracted'],
-                        horizon['horizon_extracted_info'],
-                        horizon['horizon_extracted'],
-                        geocoding['geocoding_info'],
-                        geocoding['city'],
-                        geocoding['lat'],
-                        geocoding['lon'],
-                        weather['weather_info'],
-                        weather['weather_data'])
-                    )
-
-        # Close the connection
+                    ({", ".join(MONITORING_COLUMNS)})
+                    VALUES ({", ".join("?" * len(MONITORING_COLUMNS))})
+                    """, records)
         connection.commit()
-        connection.close()
-    
-    else:
-        print('Data not saved to DB.')
+    return len(records)
+
+
+class MonitoringWriter:
+    """Background writer : the records are queued on the request path and flushed by batches in a thread."""
+
+    # Queued by `close` : the thread stops waiting for the end of the flush interval
+    _CLOSE = object()
+
+    def __init__(self, batch_size=DB_WRITER_BATCH_SIZE, flush_interval=DB_WRITER_FLUSH_INTERVAL, insert=insert_records):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.insert = insert
+        self.records = queue.Queue()
+        self.flushed = threading.Condition()
+        self.pending = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="monitoring-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, record):
+        with self.flushed:
+            self.pending += 1
+        self.records.put(record)
+
+    def _run(self):
+        while not (self.stopped.is_set() and self.records.empty()):
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.records.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is self._CLOSE:
+                    break
+                batch.append(record)
+            if batch:
+                try:
+                    self.insert(batch)
+                except Exception as error:
+                    print(f'Data not saved to DB : {error}')
+                with self.flushed:
+                    self.pending -= len(batch)
+                    self.flushed.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until every queued record has been written (or dropped on error)."""
+        with self.flushed:
+            return self.flushed.wait_for(lambda: self.pending == 0, timeout=timeout)
+
+    def close(self, timeout=None):
+        """Flush the queued records and stop the thread (called on shutdown)."""
+        self.stopped.set()
+        self.flush_interval = 0
+        self.records.put(self._CLOSE)
+        self.thread.join(timeout=timeout)
+
+
+_writer = None
+
+
+# Function dedicated to return the background writer, flushed on shutdown
+def get_monitoring_writer():
+
+    global _writer
+    if _writer is None:
+        with _pool_lock:
+            if _writer is None:
+                _writer = MonitoringWriter()
+                atexit.register(close_database)
+    return _writer
+
+
+# Function dedicated to flush the queued records and close the connections (graceful shutdown)
+def close_database(timeout=30):
+
+    if _writer is not None:
+        _writer.close(timeout=timeout)
+    if _pool is not None:
+        _pool.close()
+
+
+# Function dedicated to convert a duration in seconds into milliseconds (None if unknown)
+def _milliseconds(duration):
+    return round(duration * 1000, 1) if duration is not None else None
+
+
+# Function dedicated to build one monitoring record from the outputs of the services and the timings (s) of the stages
+def monitoring_record(speech, city, horizon, geocoding, weather, timings=None, quality=None):
+
+    timings = timings or {}
+    geocoding_source = geocoding.get('geocoding_source')
+    return (str(strftime("%Y-%m-%d %H:%M:%S", gmtime())),
+            speech['speech_info'],
+            speech['speech_text'],
+            city['city_extracted_info'],
+            city['city_extracted'],
+            horizon['horizon_extracted_info'],
+            horizon['horizon_extracted'],
+            geocoding['geocoding_info'],
+            geocoding['city'],
+            geocoding['lat'],
+            geocoding['lon'],
+            weather['weather_info'],
+            weather['weather_data'],
+            speech.get('speech_confidence'),
+            horizon.get('horizon_extracted_score'),
+            geocoding.get('geocoding_score'),
+            # The LRU and SQLite layers and the cache of the app are caches, the gazetteer and Nominatim are lookups
+            geocoding_source in ('lru', 'sqlite', 'app_cache') if geocoding_source else None,
+            weather.get('weather_cache_hit'),
+            _milliseconds(timings.get('speech')),
+            _milliseconds(timings.get('city')),
+            _milliseconds(timings.get('horizon')),
+            _milliseconds(timings.get('geocoding')),
+            _milliseconds(timings.get('weather')),
+            quality.get('quality_decision') if quality else None)
+
+
+# Function dedicated to store data : the record is queued, the background writer inserts it by batch
+@traced("storage")
+def save_to_database(speech, city, horizon, geocoding, weather, wait=False, timings=None, quality=None):
+
+    writer = get_monitoring_writer()
+    writer.put(monitoring_record(speech, city, horizon, geocoding, weather, timings, quality))
+    if wait:
+        writer.flush()
 
 # Test :
 # save_to_database()
 
 
-# Function dedicated to retrieve data from the db
-def read_from_database():
+# Function dedicated to build the filters of the queries : time range [start, end[ and status prefixes
+# status : {'weather_status': 'Failed'} keeps the rows with a weather status starting with "Failed"
+def _monitoring_filters(start=None, end=None, status=None):
 
-    # Establish the connection to the DB
-    connection = connect_to_db()
-    
-    if connection:
-        cursor = connection.cursor()
-        
-        # Read data from the table
-        cursor.execute("SELECT * FROM weather_app_monitoring")
-        for row in cursor.fetchall():
-            print(row)
-        
-        # Close the connection
-        connection.commit()
-        connection.close()
-    
+    conditions, params = [], []
+    if start is not None:
+        conditions.append("timestamp >= ?")
+        params.append(str(start))
+    if end is not None:
+        conditions.append("timestamp < ?")
+        params.append(str(end))
+    for column, value in (status or {}).items():
+        if column not in STATUS_COLUMNS:
+            raise ValueError(f"Unknown status column : {column}")
+        conditions.append(f"{column} LIKE ?")
+        params.append(f"{value}%")
+    return conditions, params
+
+
+# Function dedicated to read one page of rows after the (timestamp, id) key of the previous page
+# The NULL timestamps come first (SQLite and SQL Server order) : after=(None, id) is still in the rows without timestamp
+def query_monitoring_page(connection, start=None, end=None, status=None, after=None, page_size=DB_READ_PAGE_SIZE):
+
+    is_sqlite = isinstance(connection, sqlite3.Connection)
+    id_column = "rowid" if is_sqlite else "id"
+
+    conditions, params = _monitoring_filters(start, end, status)
+    if after is not None and after[0] is None:
+        conditions.append(f"(timestamp IS NOT NULL OR {id_column} > ?)")
+        params.append(after[1])
+    elif after is not None:
+        # Keyset pagination on the indexed (timestamp, id) : no OFFSET scan
+        conditions.append(f"(timestamp > ? OR (timestamp = ? AND {id_column} > ?))")
+        params.extend([str(after[0]), str(after[0]), after[1]])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    columns = ", ".join((id_column,) + MONITORING_COLUMNS)
+
+    if is_sqlite:
+        query = f"SELECT {columns} FROM weather_app_monitoring {where} ORDER BY timestamp, rowid LIMIT ?"
+        params.append(page_size)
     else:
-        print('Impossible to read data from DB.')
+        query = f"SELECT TOP ({int(page_size)}) {columns} FROM weather_app_monitoring {where} ORDER BY timestamp, id"
+
+    # The page is fetched and the cursor closed before the connection is given back to the pool
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+# Generator of the monitoring rows as pandas DataFrames (or Arrow record batches) of at most `batch_size` rows
+def read_monitoring_batches(start=None, end=None, status=None, batch_size=DB_READ_PAGE_SIZE, as_arrow=False):
+
+    columns = ["id"] + list(MONITORING_COLUMNS)
+    after = None
+    while True:
+        # One connection per page, given back before the page is yielded : the consumer does not hold it
+        with get_connection_pool().connection() as connection:
+            if connection is None:
+                print('Impossible to read data from DB.')
+                return
+            bootstrap_schema(connection)
+            rows = query_monitoring_page(connection, start, end, status, after, page_size=batch_size)
+        if rows:
+            after = (rows[-1][1], rows[-1][0])
+            batch = pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns)
+            if as_arrow:
+                import pyarrow as pa
+                batch = pa.RecordBatch.from_pandas(batch, preserve_index=False)
+            yield batch
+        if len(rows) < batch_size:
+            break
+
+# Test :
+# for batch in read_monitoring_batches(start="2024-03-01", status={'weather_status': 'Failed'}): print(batch)
+
+
+# Function dedicated to retrieve data from the db
+def read_from_database(start=None, end=None, status=None):
+
+    for batch in read_monitoring_batches(start=start, end=end, status=status):
+        for row in batch.itertuples(index=False):
+            print(tuple(row))
 
 # Test :    
 # test_database()
@@ -152,20 +556,27 @@ def read_from_database():
 # Function dedicated to drop table from the db
 def drop_table_from_database():
 
-    # Establish the connection to the DB
-    connection = connect_to_db()
-    cursor = connection.cursor()
-    
-    # Read data from the table
-    cursor.execute("DROP TABLE dbo.weather_app_monitoring")
+    global _schema_ready
 
-    # Close the connection
-    connection.commit()
-    connection.close()
+    # Borrow a connection from the pool
+    with get_connection_pool().connection() as connection:
+        if connection is None:
+            print('Impossible to drop the table from DB.')
+            return
+        cursor = connection.cursor()
+    
+        # Drop the table
+        cursor.execute("DROP TABLE weather_app_monitoring" if isinstance(connection, sqlite3.Connection)
+                       else "DROP TABLE dbo.weather_app_monitoring")
+        connection.commit()
+    _schema_ready = False
 
 
 
 # Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
 if __name__ == "__main__":
     
-    read_from_database()
\ No newline at end of file
+    if len(argv) > 1 and argv[1] == "--migrate":
+        migrate_database()
+    else:
+        read_from_database()
\ No newline at end of file
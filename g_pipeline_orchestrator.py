@@ -0,0 +1,312 @@
+"""
+Pipeline orchestrator :
+=====================
+
+The services of the app are modelled as stages of a dependency graph and run concurrently in a thread pool :
+- `city` and `horizon` extractions start together as soon as the transcription is known,
+- `quality` gates the command (o_service_quality) : on a "reprompt" decision the geocoding and the weather
+are skipped (no upstream request is spent on a command which will be asked again),
+- `geocoding` of the city chosen by the gate starts with the decision,
+- `weather` starts when both the coordinates and the horizon are known,
+- `storage` (monitoring DB) runs in the background, off the critical path, with the decision of the gate.
+
+Each stage has a timeout, counted from the start of its function (not from its submission to the pool) and passed
+down to its HTTP request : a stage which is too slow is replaced by its failed status dict, so the end-to-end latency
+is close to the longest path of the graph instead of the sum of the stages.
+
+This module can be processed as following :
+- `run_pipeline(speech)` with the output of the speech-to-text service (or None to recognize from the microphone),
+`geocode` and `forecast` replace the geocoding and forecast services (e.g. by the cached functions of the app).
+- `run_pipeline_async(speech)` does the same with the async services, to serve many queries from one event loop.
+"""
+
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import functools
+import threading
+import time
+from sys import argv
+
+
+# A stage : its function takes the results of the previous stages, `requires` lists the stages it depends on
+Stage = namedtuple('Stage', ['name', 'function', 'requires', 'timeout', 'fallback', 'background'])
+
+# Number of threads shared by all the pipeline runs
+PIPELINE_MAX_WORKERS = 8
+# Interval (seconds) to check the deadlines of the stages queued in the pool (their clock starts with their function)
+PIPELINE_POLL_INTERVAL = 0.05
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# Function dedicated to return the thread pool shared by the pipeline runs
+def get_executor():
+
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS, thread_name_prefix="pipeline")
+    return _executor
+
+
+# Functions of the stages (the services are imported here to keep the orchestrator importable without them)
+def _speech(results):
+    from b_service_azure_speech import recognize_from_microphone
+    return recognize_from_microphone()
+
+def _city(results):
+    from c_service_ner import extract_city
+    return extract_city(text=results['speech']['speech_text'])
+
+def _quality(results):
+    from o_service_quality import assess_command
+    return assess_command(results['speech'], results['city'], session=results.get('session'))
+
+def _horizon(results):
+    from c_service_ner import extract_horizon
+    return extract_horizon(text=results['speech']['speech_text'], timeout=_time_left(results, 'horizon'))
+
+def _geocoding(results, geocode=None):
+    if _reprompt(results):
+        return _skipped('geocoding')
+    if geocode is None:
+        from d_service_geocoding import city_to_coordinates as geocode
+    from o_service_quality import remember_city
+    geocoding = geocode(city=results['quality']['city'], timeout=_time_left(results, 'geocoding'))
+    if geocoding['lat'] is not None:
+        remember_city(geocoding['city'], session=results.get('session'))
+    return geocoding
+
+def _weather(results, forecast=None):
+    from o_service_quality import horizon_in_days, horizon_out_of_range, horizon_window
+    if results['geocoding']['lat'] is None:
+        return _skipped('weather')
+    if horizon_out_of_range(results['horizon']):
+        return dict(_skipped('weather'), weather_info="Skipped. Horizon out of range")
+    if forecast is None:
+        from e_service_weather_forecast import weather_forecast_from_coord as forecast
+    return forecast(lat=results['geocoding']['lat'],
+                    lon=results['geocoding']['lon'],
+                    horizon=horizon_in_days(results['horizon']),
+                    window=horizon_window(results['horizon']),
+                    timeout=_time_left(results, 'weather'))
+
+def _storage(results):
+    from f_service_db_storage import save_to_database
+    return save_to_database(speech=results['speech'],
+                            city=results['city'],
+                            horizon=results['horizon'],
+                            geocoding=results['geocoding'],
+                            weather=results['weather'],
+                            timings=dict(results.get('timings') or {}),
+                            quality=results.get('quality'))
+
+
+# Function dedicated to return the seconds left to a stage before its deadline (None : no deadline)
+# The HTTP request of the stage gets this timeout : a timed out stage does not keep its thread waiting on the network
+def _time_left(results, name):
+    deadline = results.get('deadlines', {}).get(name)
+    return None if deadline is None else max(0.1, deadline - time.perf_counter())
+
+# Function dedicated to run the function of a stage in a thread of the pool, its clock starts here
+def _run_stage(stage, results, started):
+    started[stage.name] = start = time.perf_counter()
+    if stage.timeout and not stage.background:
+        results['deadlines'][stage.name] = start + stage.timeout
+    return stage.function(results)
+
+
+# Function dedicated to tell if the quality gate asks the user again
+def _reprompt(results):
+    return results['quality']['quality_decision'] == "reprompt"
+
+# Function dedicated to return the output of a stage skipped by the quality gate (failed status of the stage)
+def _skipped(name):
+    return dict(_SKIPPED[name])
+
+
+_SKIPPED = {
+    'horizon': {'horizon_extracted': None, 'horizon_extracted_info': "Skipped. Command to be repeated",
+                'horizon_extracted_code': None, 'horizon_extracted_score': None},
+    'geocoding': {'city': None, 'lat': None, 'lon': None, 'geocoding_info': "Skipped. No city to geocode"},
+    'weather': {'weather_info': "Skipped. No coordinates", 'weather_data': None, 'forecast_horizon': None,
+                'forecast_resolution': None, 'weather_df': None},
+}
+
+
+PIPELINE_STAGES = (
+    Stage('speech', _speech, (), 30,
+          {'speech_text': None, 'speech_info': "Failed. Error : speech recognition timeout"}, False),
+    Stage('city', _city, ('speech',), 10,
+          {'city_extracted': None, 'city_extracted_info': "Failed. Timeout"}, False),
+    Stage('quality', _quality, ('speech', 'city'), 10,
+          {'quality_decision': "reprompt", 'quality_reason': "Timeout", 'city': None, 'quality_score': None}, False),
+    Stage('horizon', _horizon, ('speech',), 20,
+          {'horizon_extracted': None, 'horizon_extracted_info': "Failed. Timeout", 'horizon_extracted_code': None}, False),
+    Stage('geocoding', _geocoding, ('quality',), 15,
+          {'city': None, 'lat': None, 'lon': None, 'geocoding_info': "Failed. Timeout"}, False),
+    Stage('weather', _weather, ('geocoding', 'horizon'), 20,
+          {'weather_info': "Failed. Timeout", 'weather_data': None, 'forecast_horizon': None,
+           'forecast_resolution': None, 'weather_df': None}, False),
+    Stage('storage', _storage, ('speech', 'city', 'quality', 'horizon', 'geocoding', 'weather'), None, None, True),
+)
+
+
+# Function dedicated to run the stages of a dependency graph, each stage is started as soon as its requirements are done
+# Returns the results and the timings (seconds) of the stages, the background stages are not awaited
+# timings : dict filled as the stages end, shared with the stages through results['timings'] (e.g. for the storage)
+# The deadline of a stage starts with its function : the wait in the queue of the pool is not counted against it
+def run_stages(stages, results=None, executor=None, timings=None):
+
+    executor = executor or get_executor()
+    results = dict(results or {})
+    results['deadlines'] = deadlines = {}
+    timings = {} if timings is None else timings
+    pending = {stage.name: stage for stage in stages if stage.name not in results}
+    running = {}  # future -> (stage, submission time)
+    started = {}  # stage name -> start of its function
+
+    while pending or running:
+        # Start the stages whose requirements are done
+        for name, stage in list(pending.items()):
+            if all(required in results for required in stage.requires):
+                del pending[name]
+                future = executor.submit(_run_stage, stage, results, started)
+                if stage.background:
+                    results[name] = future
+                else:
+                    running[future] = (stage, time.perf_counter())
+
+        if not running:
+            if pending:
+                raise ValueError(f"Stages with unknown requirements : {sorted(pending)}")
+            break
+
+        # Wait for the next stage to complete, or for the nearest deadline (queued stages are checked again shortly)
+        now = time.perf_counter()
+        timeouts = [deadlines[stage.name] - now if stage.name in deadlines else PIPELINE_POLL_INTERVAL
+                    for stage, _ in running.values() if stage.timeout]
+        timeout = max(0.0, min(timeouts)) if timeouts else None
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            stage, submitted = running.pop(future)
+            timings[stage.name] = time.perf_counter() - started.get(stage.name, submitted)
+            try:
+                results[stage.name] = future.result()
+            except Exception as error:
+                print(f"Stage {stage.name} failed : {error}")
+                results[stage.name] = dict(stage.fallback)
+
+        # The stages past their deadline are replaced by their failed status (their HTTP request times out on its own)
+        now = time.perf_counter()
+        for future, (stage, submitted) in list(running.items()):
+            if stage.name in deadlines and now >= deadlines[stage.name]:
+                del running[future]
+                results[stage.name] = dict(stage.fallback)
+                timings[stage.name] = now - started[stage.name]
+
+    del results['deadlines']
+    return results, timings
+
+
+# Function dedicated to run the whole pipeline of the app from the transcription
+# session : identifier of the user session, its last city is reused when a command has no city ("et demain ?")
+# geocode, forecast : functions with the arguments of city_to_coordinates and weather_forecast_from_coord (None : the services)
+def run_pipeline(speech=None, persist=True, executor=None, session=None, geocode=None, forecast=None):
+
+    start = time.perf_counter()
+    stages = [stage for stage in PIPELINE_STAGES if persist or stage.name != 'storage']
+    if geocode is not None or forecast is not None:
+        services = {'geocoding': functools.partial(_geocoding, geocode=geocode),
+                    'weather': functools.partial(_weather, forecast=forecast)}
+        stages = [stage._replace(function=services.get(stage.name, stage.function)) for stage in stages]
+    timings = {}
+    results = {'timings': timings, 'session': session}
+    if speech is not None:
+        results['speech'] = speech
+    results, timings = run_stages(stages, results=results, executor=executor, timings=timings)
+    timings['total'] = time.perf_counter() - start
+    results['timings'] = timings
+    return results
+
+# Test
+# run_pipeline(speech={'speech_text': 'quelle est la météo à tours pour les 3 prochains jours', 'speech_info': 'Successed'})
+
+
+# Async variant of the pipeline with the async services : one event loop serves many concurrent voice queries
+async def run_pipeline_async(speech=None, persist=True, session=None):
+
+    from b_service_azure_speech import recognize_from_microphone_async
+    from c_service_ner import extract_city_async, extract_horizon_async
+    from d_service_geocoding import city_to_coordinates_async
+    from e_service_weather_forecast import weather_forecast_from_coord_async
+    from o_service_quality import assess_command, horizon_in_days, horizon_out_of_range, horizon_window, remember_city
+
+    timeouts = {stage.name: stage.timeout for stage in PIPELINE_STAGES}
+    fallbacks = {stage.name: stage.fallback for stage in PIPELINE_STAGES}
+    timings = {}
+    start = time.perf_counter()
+
+    async def _stage(name, coroutine):
+        stage_start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(coroutine, timeout=timeouts[name])
+        except Exception as error:
+            print(f"Stage {name} failed : {error!r}")
+            return dict(fallbacks[name])
+        finally:
+            timings[name] = time.perf_counter() - stage_start
+
+    if speech is None:
+        speech = await _stage('speech', recognize_from_microphone_async())
+
+    if speech.get('speech_text'):
+        # The horizon runs during the city extraction and the quality gate
+        horizon_task = asyncio.ensure_future(_stage('horizon', extract_horizon_async(speech['speech_text'])))
+        city = await _stage('city', extract_city_async(speech['speech_text']))
+    else:
+        horizon_task = None
+        city = dict(fallbacks['city'])
+    # The gate may scan the gazetteer : it does not run on the event loop
+    quality = await asyncio.to_thread(assess_command, speech, city, session=session)
+    results = {'speech': speech, 'city': city, 'quality': quality}
+
+    # The quality gate asks the user again : nothing is spent on the geocoding and the forecast
+    if quality['quality_decision'] == "reprompt":
+        geocoding = _skipped('geocoding')
+    else:
+        geocoding = await _stage('geocoding', city_to_coordinates_async(quality['city']))
+    horizon = await horizon_task if horizon_task is not None else _skipped('horizon')
+    if geocoding['lat'] is None:
+        weather = _skipped('weather')
+    elif horizon_out_of_range(horizon):
+        remember_city(geocoding['city'], session=session)
+        weather = dict(_skipped('weather'), weather_info="Skipped. Horizon out of range")
+    else:
+        remember_city(geocoding['city'], session=session)
+        weather = await _stage('weather', weather_forecast_from_coord_async(
+            lat=geocoding['lat'], lon=geocoding['lon'], horizon=horizon_in_days(horizon),
+            window=horizon_window(horizon), timeout=timeouts['weather']))
+
+    results.update({'horizon': horizon, 'geocoding': geocoding, 'weather': weather, 'timings': timings})
+    if persist:
+        # The queued record is written by the background writer of the DB service
+        results['storage'] = await asyncio.to_thread(_storage, results)
+    timings['total'] = time.perf_counter() - start
+    results['timings'] = timings
+    return results
+
+# Test
+# asyncio.run(run_pipeline_async(speech={'speech_text': 'quelle est la météo à tours demain', 'speech_info': 'Successed'}))
+
+
+# Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
+if __name__ == "__main__":
+
+    pipeline_output = run_pipeline(speech={'speech_text': argv[1], 'speech_info': "Successed"} if len(argv) > 1 else None)
+    print(pipeline_output['quality'])
+    print(pipeline_output['timings'])
@@ -0,0 +1,58 @@
+"""
+Shared async HTTP client :
+=====================
+
+The async variants of the services (`*_async` functions) share one `aiohttp` session per event loop,
+so a single loop serves many concurrent voice queries with a bounded pool of connections.
+
+This module can be processed as following :
+- `get_async_session()` inside a coroutine returns the session of the running loop.
+- `close_async_sessions()` is awaited once at shutdown, it also closes the clients registered with `on_close`
+(e.g. the aiohttp adapter of the Nominatim geocoder).
+
+Ressources :
+- aiohttp : https://docs.aiohttp.org/en/stable/client_advanced.html#limiting-connection-pool-size
+"""
+
+import asyncio
+import weakref
+
+
+# Maximal number of simultaneous connections of the pool (all hosts) and per host
+ASYNC_POOL_SIZE = 100
+ASYNC_POOL_SIZE_PER_HOST = 30
+# Total timeout of a request in seconds
+ASYNC_TIMEOUT = 20
+
+_sessions = weakref.WeakKeyDictionary()
+_closers = weakref.WeakKeyDictionary()
+
+
+# Function dedicated to return the session of the running event loop (created on first use)
+def get_async_session():
+
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE, limit_per_host=ASYNC_POOL_SIZE_PER_HOST, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=ASYNC_TIMEOUT))
+        _sessions[loop] = session
+    return session
+
+
+# Function dedicated to register a client of the running event loop to close with its session (coroutine function)
+def on_close(close):
+    _closers.setdefault(asyncio.get_running_loop(), []).append(close)
+
+
+# Function dedicated to close the session and the registered clients of the running event loop
+async def close_async_sessions():
+
+    loop = asyncio.get_running_loop()
+    for close in _closers.pop(loop, []):
+        await close()
+    session = _sessions.pop(loop, None)
+    if session is not None and not session.closed:
+        await session.close()
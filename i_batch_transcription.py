@@ -0,0 +1,224 @@
+"""
+Batch transcription of archived audio :
+=====================
+
+The recorded voice queries are re-transcribed (e.g. after a change of AZURE_SPEECH_LANG or of the Azure model)
+with a bounded pool of workers and a rate limit which respects the quota of the Azure Speech resource.
+
+This module can be processed as following :
+- Input : a directory of audio files (WAV) or a manifest (a text file with one audio path per line).
+- Output : a JSONL file written incrementally, one line per audio file, with the transcription and its latency.
+The run is resumable : the files already transcribed in the output with the same language are skipped,
+the failed ones are transcribed again and the output keeps the latest record of each (file, language).
+- A Parquet copy of the output can be written at the end with `--parquet`.
+- A summary reports the throughput and the latency percentiles.
+
+From the terminal :
+python i_batch_transcription.py audio_dir/ --output transcriptions.jsonl --workers 4 --rate 5 --language fr-FR
+"""
+
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from time import gmtime, strftime
+
+from dotenv import dotenv_values
+
+from b_service_azure_speech import recognize_from_file
+
+
+# Default number of workers and of requests per second (Azure free tier : 1 concurrent request, paid tier : 100)
+BATCH_MAX_WORKERS = 4
+BATCH_MAX_PER_SECOND = 5
+AUDIO_EXTENSIONS = (".wav",)
+
+
+class RateLimiter:
+    """Thread-safe limiter : at most `max_per_second` calls start per second."""
+
+    def __init__(self, max_per_second=None):
+        self.interval = 1 / max_per_second if max_per_second else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Function dedicated to list the audio files of a directory or of a manifest
+def list_audio_files(source):
+
+    if os.path.isdir(source):
+        return sorted(os.path.join(root, name)
+                      for root, _, names in os.walk(source)
+                      for name in names if name.lower().endswith(AUDIO_EXTENSIONS))
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding="utf-8") as manifest:
+        paths = [line.strip() for line in manifest if line.strip() and not line.startswith("#")]
+    return [path if os.path.isabs(path) else os.path.join(base, path) for path in paths]
+
+
+# Function dedicated to read the latest record of each (path, language) of the output, in the order of the output
+def _latest_records(output_path):
+
+    records = {}
+    if os.path.exists(output_path):
+        with open(output_path, encoding="utf-8") as output:
+            for line in output:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line of an interrupted run
+                    continue
+                key = (record['path'], record.get('language'))
+                # A file transcribed again (failed before) moves to the end of the output
+                records.pop(key, None)
+                records[key] = record
+    return records
+
+
+# Function dedicated to read the paths already transcribed in the language in the output (resume)
+def _done_paths(output_path, language=None):
+
+    return {path for (path, record_language), record in _latest_records(output_path).items()
+            if record_language == language and record.get('speech_info') == "Successed"}
+
+
+# Function dedicated to rewrite the output with the latest record of each (path, language) only
+def compact_output(output_path):
+
+    records = _latest_records(output_path)
+    temporary_path = output_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as output:
+        for record in records.values():
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(temporary_path, output_path)
+    return len(records)
+
+
+# Function dedicated to return the duration in seconds of a WAV file (None if unknown)
+def _audio_duration(path):
+    try:
+        with wave.open(path) as wav:
+            return wav.getnframes() / wav.getframerate()
+    except (wave.Error, OSError, EOFError):
+        return None
+
+
+# Function dedicated to transcribe one file, language : recognition language written in the record
+def _transcribe(path, limiter, language=None):
+
+    limiter.wait()
+    start = time.perf_counter()
+    try:
+        result = recognize_from_file(path, language=language)
+    except Exception as error:
+        result = {'speech_text': None, 'speech_info': f"Failed. Error : {error}"}
+    return {'path': path,
+            'language': language,
+            'timestamp': strftime("%Y-%m-%d %H:%M:%S", gmtime()),
+            'speech_text': result['speech_text'],
+            'speech_info': result['speech_info'],
+            'latency_s': round(time.perf_counter() - start, 3),
+            'audio_duration_s': _audio_duration(path)}
+
+
+# Function dedicated to transcribe many files, the results are appended to the JSONL output as soon as they are known
+# The output is compacted at the end : a file transcribed again keeps its latest record only
+def transcribe_batch(paths, output_path, max_workers=BATCH_MAX_WORKERS, max_per_second=BATCH_MAX_PER_SECOND,
+                     resume=True, language=None):
+
+    # The default language is resolved : a run with AZURE_SPEECH_LANG and a run with the same explicit language match
+    language = language or dotenv_values(".env").get("AZURE_SPEECH_LANG")
+    done = _done_paths(output_path, language) if resume else set()
+    todo = [path for path in paths if path not in done]
+    limiter = RateLimiter(max_per_second)
+    latencies, failed, audio_seconds = [], 0, 0.0
+    start = time.perf_counter()
+
+    # At most 2 files per worker are in flight : the backlog is not loaded into the pool at once
+    in_flight = threading.BoundedSemaphore(2 * max_workers)
+    write_lock = threading.Lock()
+
+    with open(output_path, "a", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        # The slot of the file is given back even if the record cannot be written (the submission loop would wait forever)
+        def _write(future):
+            nonlocal failed, audio_seconds
+            try:
+                record = future.result()
+                with write_lock:
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output.flush()
+                    latencies.append(record['latency_s'])
+                    audio_seconds += record['audio_duration_s'] or 0
+                    if record['speech_info'] != "Successed":
+                        failed += 1
+            except Exception as error:
+                print(f"Transcription not written : {error}")
+                with write_lock:
+                    failed += 1
+            finally:
+                in_flight.release()
+
+        for path in todo:
+            in_flight.acquire()
+            executor.submit(_transcribe, path, limiter, language).add_done_callback(_write)
+
+    elapsed = time.perf_counter() - start
+    records = compact_output(output_path) if todo else None
+    summary = {'files': len(paths),
+               'skipped': len(paths) - len(todo),
+               'transcribed': len(todo),
+               'failed': failed,
+               'records': records,
+               'elapsed_s': round(elapsed, 2),
+               'files_per_s': round(len(todo) / elapsed, 2) if elapsed else None,
+               'audio_s_per_s': round(audio_seconds / elapsed, 2) if elapsed else None}
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100)
+        summary['latency_p50_s'] = round(percentiles[49], 3)
+        summary['latency_p95_s'] = round(percentiles[94], 3)
+    return summary
+
+# Test
+# transcribe_batch(list_audio_files("audio_dir"), "transcriptions.jsonl")
+
+
+# Function dedicated to write a Parquet copy of the JSONL output (latest record of each (path, language))
+def jsonl_to_parquet(output_path, parquet_path):
+
+    import pandas as pd
+    pd.DataFrame(list(_latest_records(output_path).values())).to_parquet(parquet_path, index=False)
+
+
+# Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Batch transcription of archived audio files")
+    parser.add_argument("source", help="directory of audio files or manifest (one path per line)")
+    parser.add_argument("--output", default="transcriptions.jsonl", help="JSONL output, resumable")
+    parser.add_argument("--workers", type=int, default=BATCH_MAX_WORKERS, help="number of concurrent transcriptions")
+    parser.add_argument("--rate", type=float, default=BATCH_MAX_PER_SECOND, help="maximal number of requests per second")
+    parser.add_argument("--language", default=None, help="recognition language, instead of AZURE_SPEECH_LANG")
+    parser.add_argument("--no-resume", action="store_true", help="transcribe again the files already in the output")
+    parser.add_argument("--parquet", default=None, help="Parquet copy of the output written at the end")
+    args = parser.parse_args()
+
+    batch_summary = transcribe_batch(list_audio_files(args.source), args.output, max_workers=args.workers,
+                                     max_per_second=args.rate, resume=not args.no_resume, language=args.language)
+    if args.parquet:
+        jsonl_to_parquet(args.output, args.parquet)
+    print(json.dumps(batch_summary, indent=2))
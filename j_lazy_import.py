@@ -0,0 +1,103 @@
+"""
+Lazy imports and import-time report :
+=====================
+
+The heavy libraries (spaCy, pandas, the Azure Speech SDK, pyodbc, plotly, folium...) are imported by the services
+through `lazy_import` : the module is only loaded on the first access to one of its attributes, so a code path
+which does not use a library does not pay for its import (container cold starts, health checks, `a_main.py --text`).
+
+This module can be processed as following :
+- `spacy = lazy_import("spacy")` in place of `import spacy`.
+- `import_time_report(modules)` returns the slowest imports of the given modules (`python -X importtime` summary).
+
+From the terminal :
+python j_lazy_import.py a_main c_service_ner
+"""
+
+import importlib
+import re
+import subprocess
+import sys
+import threading
+import types
+
+
+class _LazyModule(types.ModuleType):
+    """Placeholder of a module imported on the first access to one of its attributes.
+
+    The import runs under a lock (the first access may come from several threads) and goes through the regular import
+    system : a dotted name ("geopy.geocoders") does not import its parent package before the first use, and a module
+    which is not installed raises ModuleNotFoundError on first use, not at import time.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_lock'] = threading.RLock()
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            with self.__dict__['_lazy_lock']:
+                module = self.__dict__['_lazy_module']
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    # Next accesses are plain attribute lookups
+                    self.__dict__.update(module.__dict__)
+                    self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+
+# Function dedicated to import a module on first use
+def lazy_import(name):
+
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return _LazyModule(name)
+
+
+# Function dedicated to measure the import time of modules in a fresh interpreter (python -X importtime)
+# Returns the `top` slowest imports as (module, self time in ms, cumulative time in ms) and the total in ms
+def import_time_report(modules, top=15):
+
+    statement = "; ".join(f"import {module}" for module in modules)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                             capture_output=True, text=True)
+
+    imports = []
+    pattern = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+    for line in process.stderr.splitlines():
+        match = pattern.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append((module, int(self_us) / 1000, int(cumulative_us) / 1000, len(indent)))
+
+    # The top-level imports (smallest indentation) sum up to the total time
+    total_ms = sum(cumulative for _, _, cumulative, level in imports if level == 1)
+    slowest = sorted(imports, key=lambda item: item[2], reverse=True)[:top]
+    return {'total_ms': round(total_ms, 1),
+            'slowest': [(module, round(self_ms, 1), round(cumulative_ms, 1)) for module, self_ms, cumulative_ms, _ in slowest],
+            'error': process.stderr.splitlines()[-1] if process.returncode else None}
+
+
+# Function dedicated to print the import-time report
+def print_import_time_report(modules, top=15):
+
+    report = import_time_report(modules, top=top)
+    print(f"Import time of {', '.join(modules)} : {report['total_ms']} ms")
+    if report['error']:
+        print(f"Import failed : {report['error']}")
+    print(f"{'module':<60} {'self (ms)':>10} {'cumulative (ms)':>16}")
+    for module, self_ms, cumulative_ms in report['slowest']:
+        print(f"{module:<60} {self_ms:>10} {cumulative_ms:>16}")
+    return report
+
+
+# Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
+if __name__ == "__main__":
+
+    print_import_time_report(sys.argv[1:] or ["a_main"])
@@ -0,0 +1,148 @@
+"""
+Pre-warmer of the forecasts of the most requested cities :
+=====================
+
+The monitoring table records the geocoded city of every voice query. This job mines the most requested cities
+of the recent rows and refreshes their coordinates and forecasts right after each Météo-France model update,
+so the queries for popular cities are served by the caches instead of waiting on Nominatim and Open-Meteo.
+
+This module can be processed as following :
+- `top_cities(top, days)` returns the most requested cities of the last days (city, lat, lon, requests).
+- `prewarm(cities)` refreshes the geocoding of the cities with a bounded pool of workers, then their forecasts with
+multi-location requests (`weather_forecast_batch`, OPENMETEO_BATCH_SIZE cities per request).
+- `run_forever()` refreshes after each model run, `start_prewarmer()` does it in a background thread of the app
+(started once per process by a_weather_app.py : the in-memory forecast cache of the app is warmed too,
+the HTTP and geocoding SQLite caches are shared by all the processes).
+
+From the terminal (a separate process only warms the SQLite caches) :
+python k_job_prewarm.py --top 50 --days 7 --workers 4
+python k_job_prewarm.py --once
+python k_job_prewarm.py --metrics-port 9109 (Prometheus metrics of the job on http://127.0.0.1:9109/metrics)
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from m_service_tracing import start_metrics_server
+
+
+# Number of cities refreshed and period of the monitoring rows mined
+PREWARM_TOP_CITIES = 50
+PREWARM_LOOKBACK_DAYS = 7
+# Number of workers of the geocoding (Nominatim has its own rate limiter)
+PREWARM_MAX_WORKERS = 4
+# Margin after the publication of a model run before the refresh (seconds)
+PREWARM_MARGIN = 120
+
+
+# Function dedicated to mine the most requested cities of the monitoring rows of the last `days` days
+# Returns [(city, lat, lon, requests)], the coordinates are the latest ones recorded for the city
+def top_cities(top=PREWARM_TOP_CITIES, days=PREWARM_LOOKBACK_DAYS):
+
+    from f_service_db_storage import read_monitoring_batches
+
+    start = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    counts = Counter()
+    coordinates = {}
+    # The default city of a failed extraction has a failed geocoding status : it is not counted
+    for batch in read_monitoring_batches(start=start, status={'geocoding_status': 'Successed'}):
+        batch = batch.dropna(subset=["geocoding_city", "geocoding_lat", "geocoding_lon"])
+        for city, lat, lon in zip(batch["geocoding_city"], batch["geocoding_lat"], batch["geocoding_lon"]):
+            key = city.strip().lower()
+            counts[key] += 1
+            coordinates[key] = (city, float(lat), float(lon))
+
+    return [coordinates[key] + (count,) for key, count in counts.most_common(top)]
+
+# Test
+# top_cities(top=10)
+
+
+# Function dedicated to refresh the geocoding of one city, returns its coordinates (the recorded ones if not resolved)
+def _refresh_coordinates(city, lat, lon):
+
+    from d_service_geocoding import resolve_city
+
+    try:
+        # The local layers answer without any request, Nominatim has its own rate limiter
+        resolved = resolve_city(city)
+        if resolved is not None:
+            _, lat, lon, _, _ = resolved
+    except Exception as error:
+        print(f"Prewarm geocoding of {city} failed : {error}")
+    return lat, lon
+
+
+# Function dedicated to refresh many cities : geocoding with a bounded pool of workers, then the forecasts in batches
+def prewarm(cities, max_workers=PREWARM_MAX_WORKERS):
+
+    from e_service_weather_forecast import FORECAST_MAX_DAYS, weather_forecast_batch
+
+    cities = list(cities)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prewarm") as executor:
+        coords = list(executor.map(lambda city: _refresh_coordinates(city[0], city[1], city[2]), cities))
+
+    failed = []
+    if coords:
+        try:
+            # The widest block of each grid cell is cached : every hourly horizon of the app is a slice of it
+            weather_forecast_batch(coords, horizon=FORECAST_MAX_DAYS, warm_cache=True)
+        except Exception as error:
+            print(f"Prewarm forecast failed : {error}")
+            failed = [city[0] for city in cities]
+    return {'cities': len(cities),
+            'failed': failed,
+            'elapsed_s': round(time.perf_counter() - start, 2)}
+
+# Test
+# prewarm([("Tours", 47.3900474, 0.6889268), ("Lyon", 45.7578137, 4.8320114)])
+
+
+# Function dedicated to refresh the most requested cities after each model run, until `stop` is set
+def run_forever(top=PREWARM_TOP_CITIES, days=PREWARM_LOOKBACK_DAYS, max_workers=PREWARM_MAX_WORKERS, stop=None):
+
+    from e_service_weather_forecast import next_model_run
+
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        try:
+            summary = prewarm(top_cities(top, days), max_workers=max_workers)
+            print(f"Prewarm : {json.dumps(summary, ensure_ascii=False)}")
+        except Exception as error:
+            print(f"Prewarm failed : {error}")
+        # Sleep until the next model run is published
+        stop.wait(max(0, next_model_run() - time.time()) + PREWARM_MARGIN)
+
+
+# Function dedicated to run the pre-warmer in a daemon thread of the app, returns the thread and its stop event
+def start_prewarmer(**kwargs):
+
+    stop = threading.Event()
+    thread = threading.Thread(target=run_forever, kwargs=dict(kwargs, stop=stop), name="prewarm", daemon=True)
+    thread.start()
+    return thread, stop
+
+
+# Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Refresh the forecasts of the most requested cities after each model run")
+    parser.add_argument("--top", type=int, default=PREWARM_TOP_CITIES, help="number of cities refreshed")
+    parser.add_argument("--days", type=int, default=PREWARM_LOOKBACK_DAYS, help="period of the monitoring rows mined")
+    parser.add_argument("--workers", type=int, default=PREWARM_MAX_WORKERS, help="number of concurrent geocodings")
+    parser.add_argument("--once", action="store_true", help="refresh once and exit")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve the metrics of the job on this port")
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        start_metrics_server(port=args.metrics_port)
+    if args.once:
+        print(json.dumps(prewarm(top_cities(args.top, args.days), max_workers=args.workers), indent=2, ensure_ascii=False))
+    else:
+        run_forever(top=args.top, days=args.days, max_workers=args.workers)
@@ -0,0 +1,512 @@
+"""
+End-to-end benchmark with offline stand-ins :
+=====================
+
+The pipeline is measured without any external service : a local HTTP server stands in for Open-Meteo, the Hugging Face
+inference API and Nominatim, the monitoring DB is a temporary SQLite file and the speech-to-text is the LocalRecognizer.
+The spaCy model and the local caches are the real ones.
+
+This module can be processed as following :
+- The corpus of French voice queries is read from `data/benchmark/corpus_fr.txt`.
+- Open-Meteo : the FlatBuffers responses recorded in `data/benchmark/openmeteo/` are replayed (`--record` fetches
+and saves them once, network needed), a synthetic response of the same shape is served for an unknown request.
+No recording is committed yet : until `--record` is run and its files committed, every payload is synthetic
+(`openmeteo_payloads` of the report counts the recorded, replayed and synthetic ones).
+- Hugging Face : the canned entities of `data/benchmark/hf_ner.json` (the texts not covered by the horizon rules).
+- Nominatim : the canned places of `data/benchmark/nominatim.json` (the cities which are not in the gazetteer),
+written by hand from the Nominatim answers, not recorded.
+- The report gives the latency percentiles per stage and end to end, the throughput for each level of concurrency,
+the peak RSS and the cache metrics, as JSON to diff between releases.
+- `--plans` compares the Open-Meteo payload sizes and decoding times of the corpus before/after the query planner.
+- `--render` compares the rendering time of the chart and the map, first view (built) and repeated view (cached artefacts).
+
+From the terminal :
+python l_benchmark.py --concurrency 1 4 16 --repeat 3 --output benchmark.json
+python l_benchmark.py --record
+python l_benchmark.py --plans
+python l_benchmark.py --render
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+try:
+    import resource
+except ImportError:
+    # Windows : no peak RSS
+    resource = None
+
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "benchmark")
+BENCHMARK_CORPUS_PATH = os.path.join(BENCHMARK_DIR, "corpus_fr.txt")
+HF_NER_FIXTURE_PATH = os.path.join(BENCHMARK_DIR, "hf_ner.json")
+NOMINATIM_FIXTURE_PATH = os.path.join(BENCHMARK_DIR, "nominatim.json")
+OPENMETEO_FIXTURES_DIR = os.path.join(BENCHMARK_DIR, "openmeteo")
+OPENMETEO_UPSTREAM_URL = "https://api.open-meteo.com/v1/meteofrance"
+
+# Levels of concurrency (simultaneous queries) and passes over the corpus for each level
+BENCHMARK_CONCURRENCY = (1, 4, 16)
+BENCHMARK_REPEAT = 3
+
+
+# Function dedicated to read the corpus (one utterance per line, # for comments)
+def load_corpus(path=BENCHMARK_CORPUS_PATH):
+
+    with open(path, encoding="utf-8") as corpus:
+        return [line.strip() for line in corpus if line.strip() and not line.startswith("#")]
+
+
+# Function dedicated to name the fixture of an Open-Meteo request (same parameters, same fixture)
+def _fixture_name(query):
+
+    params = sorted((name, values) for name, values in parse_qs(query).items() if name != "format")
+    return hashlib.sha1(json.dumps(params).encode("utf-8")).hexdigest()[:16] + ".bin"
+
+
+# Function dedicated to return the time range (epoch seconds) of the request : start_date/end_date or past/forecast days
+def _synthetic_time_range(params):
+
+    if "start_date" in params:
+        start = int(datetime.fromisoformat(params["start_date"][0]).replace(tzinfo=timezone.utc).timestamp())
+        end = int(datetime.fromisoformat(params["end_date"][0]).replace(tzinfo=timezone.utc).timestamp()) + 86400
+        return start, end
+    past_days = int(params.get("past_days", ["0"])[0])
+    forecast_days = int(params.get("forecast_days", ["7"])[0])
+    start = int(time.time()) // 86400 * 86400 - past_days * 86400
+    return start, start + (past_days + forecast_days) * 86400
+
+
+# Function dedicated to build a synthetic Open-Meteo FlatBuffers response (hourly, daily or current) for the parameters
+def synthetic_openmeteo_response(params):
+
+    import flatbuffers
+    import numpy as np
+
+    # WeatherApiResponse : current, daily and hourly are the fields 9, 10 and 11
+    slot, resolution = next((slot, name) for slot, name in ((11, "hourly"), (10, "daily"), (9, "current"))
+                            if name in params)
+    variables = ",".join(params[resolution]).split(",")
+    if resolution == "current":
+        interval = 900
+        start = int(time.time()) // interval * interval
+        end = start + interval
+        steps = 1
+    else:
+        interval = 3600 if resolution == "hourly" else 86400
+        start, end = _synthetic_time_range(params)
+        steps = (end - start) // interval
+    phase = np.arange(steps, dtype="float32") * (2 * np.pi / 24)
+
+    builder = flatbuffers.Builder(1024 + 4 * steps * len(variables))
+    offsets = []
+    for i, _ in enumerate(variables):
+        series = (10 + 5 * i + 5 * np.sin(phase + i)).astype("float32")
+        if resolution != "current":
+            values = builder.CreateNumpyVector(series)
+        # VariableWithValues : value is the field 2, values is the field 3
+        builder.StartObject(13)
+        if resolution == "current":
+            builder.PrependFloat32Slot(2, float(series[0]), 0)
+        else:
+            builder.PrependUOffsetTRelativeSlot(3, values, 0)
+        offsets.append(builder.EndObject())
+
+    builder.StartVector(4, len(offsets), 4)
+    for offset in reversed(offsets):
+        builder.PrependUOffsetTRelative(offset)
+    variables_vector = builder.EndVector()
+
+    # VariablesWithTime : time, time_end, interval, variables
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, start, 0)
+    builder.PrependInt64Slot(1, end, 0)
+    builder.PrependInt32Slot(2, interval, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variables_vector, 0)
+    series_table = builder.EndObject()
+
+    # WeatherApiResponse : latitude, longitude and the series of the resolution
+    builder.StartObject(16)
+    builder.PrependFloat32Slot(0, float(params.get("latitude", ["0"])[0]), 0)
+    builder.PrependFloat32Slot(1, float(params.get("longitude", ["0"])[0]), 0)
+    builder.PrependUOffsetTRelativeSlot(slot, series_table, 0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """Routes of the stand-in server : Open-Meteo (GET /v1/...), Nominatim (GET /search), Hugging Face (POST /models/...)."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, service, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(service, len(body))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.startswith("/v1/"):
+            self._send("openmeteo", self.server.openmeteo(url.query), "application/octet-stream")
+        elif url.path.startswith("/search"):
+            query = parse_qs(url.query).get("q", [""])[0].strip().lower()
+            place = self.server.nominatim.get(query)
+            places = [dict(place, lat=str(place["lat"]), lon=str(place["lon"]))] if place else []
+            self._send("nominatim", json.dumps(places).encode("utf-8"))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if not urlparse(self.path).path.startswith("/models/"):
+            self.send_error(404)
+            return
+        inputs = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))["inputs"]
+        texts = inputs if isinstance(inputs, list) else [inputs]
+        self._send("hf_ner", json.dumps([self.server.hf_ner.get(text, []) for text in texts]).encode("utf-8"))
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Local server standing in for the external services, run in a daemon thread (`with StandInServer() as server`)."""
+
+    daemon_threads = True
+
+    def __init__(self, record=False, fixtures_dir=OPENMETEO_FIXTURES_DIR):
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.record = record
+        self.fixtures_dir = fixtures_dir
+        with open(HF_NER_FIXTURE_PATH, encoding="utf-8") as fixture:
+            self.hf_ner = json.load(fixture)
+        with open(NOMINATIM_FIXTURE_PATH, encoding="utf-8") as fixture:
+            self.nominatim = json.load(fixture)
+        self.metrics = {}
+        # Origin of the Open-Meteo payloads served : a report on synthetic payloads only is not comparable to a recorded one
+        self.payloads = {'recorded': 0, 'replayed': 0, 'synthetic': 0}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, service, size):
+        with self.lock:
+            metrics = self.metrics.setdefault(service, {'requests': 0, 'bytes': 0})
+            metrics['requests'] += 1
+            metrics['bytes'] += size
+
+    def count_payload(self, origin):
+        with self.lock:
+            self.payloads[origin] += 1
+
+    def openmeteo(self, query):
+        path = os.path.join(self.fixtures_dir, _fixture_name(query))
+        if self.record:
+            with urllib.request.urlopen(f"{OPENMETEO_UPSTREAM_URL}?{query}", timeout=30) as response:
+                body = response.read()
+            os.makedirs(self.fixtures_dir, exist_ok=True)
+            with open(path, "wb") as fixture:
+                fixture.write(body)
+            self.count_payload('recorded')
+            return body
+        if os.path.exists(path):
+            self.count_payload('replayed')
+            with open(path, "rb") as fixture:
+                return fixture.read()
+        self.count_payload('synthetic')
+        return synthetic_openmeteo_response(parse_qs(query))
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, name="stand-in-server", daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+# Function dedicated to point the services to the stand-in server and to the temporary files of the benchmark
+# (to be called before the first use of the services : their clients are built once per process)
+def configure_services(server_url, workdir):
+
+    import b_service_azure_speech
+    import c_service_ner
+    import d_service_geocoding
+    import e_service_weather_forecast
+    import f_service_db_storage
+
+    b_service_azure_speech.set_recognizer(b_service_azure_speech.LocalRecognizer())
+    c_service_ner.HF_NER_API_URL = f"{server_url}/models/{c_service_ner.HORIZON_MODEL_NAME}"
+    d_service_geocoding.NOMINATIM_DOMAIN = urlparse(server_url).netloc
+    d_service_geocoding.NOMINATIM_SCHEME = "http"
+    d_service_geocoding.NOMINATIM_MIN_DELAY = 0
+    d_service_geocoding.GEOCODING_CACHE_PATH = os.path.join(workdir, "geocoding_cache.sqlite")
+    e_service_weather_forecast.OPENMETEO_URL = f"{server_url}/v1/meteofrance"
+    e_service_weather_forecast.OPENMETEO_CACHE_NAME = os.path.join(workdir, "openmeteo_cache")
+    db_path = os.path.join(workdir, "weather_app_monitoring.sqlite")
+    f_service_db_storage.set_connection_pool(f_service_db_storage.ConnectionPool(
+        connect=lambda: sqlite3.connect(db_path, check_same_thread=False)))
+
+
+# Function dedicated to return the percentiles (ms) of durations in seconds
+def _percentiles(durations):
+
+    durations_ms = [duration * 1000 for duration in durations]
+    if not durations_ms:
+        return None
+    summary = {'count': len(durations_ms), 'mean_ms': round(statistics.fmean(durations_ms), 2)}
+    if len(durations_ms) >= 2:
+        percentiles = statistics.quantiles(durations_ms, n=100)
+        summary.update(p50_ms=round(percentiles[49], 2), p95_ms=round(percentiles[94], 2), p99_ms=round(percentiles[98], 2))
+    return summary
+
+
+# Function dedicated to return the peak RSS of the process in MB (None if unknown)
+def peak_rss_mb():
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# Function dedicated to run one voice query through the pipeline, returns the timings (s), the storage future and the status
+def _run_query(text):
+
+    from b_service_azure_speech import LocalRecognizer
+    from g_pipeline_orchestrator import run_pipeline
+
+    start = time.perf_counter()
+    speech = LocalRecognizer(default_text=text).recognize_bytes(b"")
+    speech_duration = time.perf_counter() - start
+
+    output = run_pipeline(speech=speech, persist=True)
+    timings = dict(output['timings'], speech=speech_duration, total=time.perf_counter() - start)
+    return timings, output.get('storage'), output['weather']['weather_info'] == "Successed"
+
+
+# Function dedicated to run the corpus `repeat` times for each level of concurrency
+def run_benchmark(corpus, concurrency=BENCHMARK_CONCURRENCY, repeat=BENCHMARK_REPEAT):
+
+    from c_service_ner import get_horizon_metrics, warm_up_models
+    from d_service_geocoding import get_geocoding_metrics
+    from e_service_weather_forecast import get_forecast_cache_metrics, get_openmeteo_metrics
+    from f_service_db_storage import get_monitoring_writer
+    from m_service_tracing import get_tracing_metrics
+
+    start = time.perf_counter()
+    warm_up_models()
+    report = {'warm_up_s': round(time.perf_counter() - start, 3), 'levels': {}}
+
+    for level in concurrency:
+        queries = corpus * repeat
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level, thread_name_prefix="benchmark") as executor:
+            results = list(executor.map(_run_query, queries))
+        elapsed = time.perf_counter() - start
+
+        # The background storage is measured apart : the queued records are written by the DB writer
+        flush_start = time.perf_counter()
+        for _, storage, _ in results:
+            if storage is not None:
+                storage.result()
+        get_monitoring_writer().flush()
+
+        stages = sorted({stage for timings, _, _ in results for stage in timings if stage != 'total'})
+        report['levels'][str(level)] = {
+            'queries': len(queries),
+            'failed': sum(1 for _, _, success in results if not success),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_qps': round(len(queries) / elapsed, 2) if elapsed else None,
+            'end_to_end': _percentiles([timings['total'] for timings, _, _ in results]),
+            'stages': {stage: _percentiles([timings[stage] for timings, _, _ in results if stage in timings])
+                       for stage in stages},
+            'storage_flush_s': round(time.perf_counter() - flush_start, 3)}
+
+    report['peak_rss_mb'] = peak_rss_mb()
+    report['caches'] = {'forecast': get_forecast_cache_metrics(),
+                        'openmeteo': get_openmeteo_metrics(),
+                        'geocoding': get_geocoding_metrics(),
+                        'horizon': get_horizon_metrics()}
+    report['spans'] = get_tracing_metrics()
+    return report
+
+
+# Function dedicated to return the version of the code (git commit), to compare the reports between releases
+def _code_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Function dedicated to run the whole benchmark with the stand-ins, returns the JSON report as a dict
+def benchmark(concurrency=BENCHMARK_CONCURRENCY, repeat=BENCHMARK_REPEAT, corpus_path=BENCHMARK_CORPUS_PATH, record=False):
+
+    corpus = load_corpus(corpus_path)
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as workdir, StandInServer(record=record) as server:
+        configure_services(server.url, workdir)
+        report = run_benchmark(corpus, concurrency=concurrency, repeat=repeat)
+        from f_service_db_storage import close_database
+        close_database()
+
+    report.update(version=_code_version(),
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  corpus=len(corpus),
+                  repeat=repeat,
+                  stand_ins=server.metrics,
+                  openmeteo_payloads=server.payloads)
+    return report
+
+# Test
+# benchmark(concurrency=(1,), repeat=1)
+
+
+# Function dedicated to return the Open-Meteo payload of request parameters (recorded fixture, else synthetic)
+def _openmeteo_payload(params):
+
+    query = urlencode({name: ",".join(map(str, value)) if isinstance(value, list) else value
+                       for name, value in params.items()})
+    path = os.path.join(OPENMETEO_FIXTURES_DIR, _fixture_name(query))
+    if os.path.exists(path):
+        with open(path, "rb") as fixture:
+            return fixture.read()
+    return synthetic_openmeteo_response(parse_qs(query))
+
+
+# Function dedicated to return the median time (ms) of a decoding
+def _decode_ms(decode, runs=50):
+
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        decode()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+# Function dedicated to compare the Open-Meteo requests of the corpus before (past days and the 5 hourly variables
+# of the longest horizon) and after the query planner (no past days, daily summary of the long windows) :
+# payload size and decoding time per resolution
+def plan_report(corpus_path=BENCHMARK_CORPUS_PATH, lat=47.3900474, lon=0.6889268):
+
+    from c_service_ner import extract_horizon_window
+    from e_service_weather_forecast import (DISPLAY_VARIABLES, FORECAST_MAX_DAYS, HOURLY_VARIABLES, _forecast_params,
+                                            _parse_flatbuffers, decode_forecast, decode_hourly, fetch_plan,
+                                            plan_forecast, slice_plan)
+
+    # Request of the forecast service before the planner
+    past_days = 2
+    report = {}
+    for text in load_corpus(corpus_path):
+        window = extract_horizon_window(text)
+        horizon = window.last_day + 1 if window is not None else 1
+        before = _openmeteo_payload({"latitude": lat, "longitude": lon, "timezone": "GMT", "past_days": past_days,
+                                     "forecast_days": max(horizon, FORECAST_MAX_DAYS),
+                                     "hourly": [variable.name for variable in HOURLY_VARIABLES]})
+        # Request sent on a cold forecast cache : the minimal plan (the pre-warmer widens it)
+        plan = plan_forecast(horizon, window, DISPLAY_VARIABLES)
+        fetched = fetch_plan(plan)
+        after = _openmeteo_payload(_forecast_params(lat, lon, fetched))
+
+        before_response, after_response = _parse_flatbuffers(before)[0], _parse_flatbuffers(after)[0]
+        summary = report.setdefault(plan.resolution, {'requests': 0, 'bytes_before': 0, 'bytes_after': 0,
+                                                      'decode_ms_before': [], 'decode_ms_after': []})
+        summary['requests'] += 1
+        summary['bytes_before'] += len(before)
+        summary['bytes_after'] += len(after)
+        summary['decode_ms_before'].append(_decode_ms(lambda: decode_hourly(before_response, HOURLY_VARIABLES)))
+        summary['decode_ms_after'].append(_decode_ms(lambda: slice_plan(decode_forecast(after_response, fetched), plan)))
+
+    for summary in report.values():
+        for name in ('decode_ms_before', 'decode_ms_after'):
+            summary[name] = round(statistics.median(summary[name]), 4)
+        summary['bytes_ratio'] = round(summary['bytes_after'] / summary['bytes_before'], 3)
+    return report
+
+# Test
+# plan_report()
+
+
+# Function dedicated to compare the rendering of the chart and the map of a forecast : first view (artefacts built)
+# and repeated view (cached JSON and HTML, only the marker of the current time is added)
+def render_report(horizons=(2, 10), runs=20, lat=47.3900474, lon=0.6889268):
+
+    from e_service_weather_forecast import (DISPLAY_VARIABLES, _forecast_params, _parse_flatbuffers, decode_forecast,
+                                            hourly_to_dataframe, plan_forecast)
+    from p_service_rendering import build_weather_figure, build_weather_map, figure_with_now
+
+    report = {}
+    for horizon in horizons:
+        plan = plan_forecast(horizon, variables=DISPLAY_VARIABLES)
+        response = _parse_flatbuffers(_openmeteo_payload(_forecast_params(lat, lon, plan)))[0]
+        weather_df = hourly_to_dataframe(decode_forecast(response, plan))
+
+        first_view, repeated_view = [], []
+        for _ in range(runs):
+            start = time.perf_counter()
+            figure_json = build_weather_figure(weather_df, plan.resolution)
+            map_html = build_weather_map("Tours", lat, lon)
+            figure_with_now(figure_json, datetime.now(timezone.utc))
+            first_view.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            figure_with_now(figure_json, datetime.now(timezone.utc))
+            repeated_view.append(time.perf_counter() - start)
+
+        report[f"{plan.resolution}_{horizon}d"] = {'first_view': _percentiles(first_view),
+                                                   'repeated_view': _percentiles(repeated_view),
+                                                   'figure_bytes': len(figure_json),
+                                                   'map_bytes': len(map_html)}
+    return report
+
+# Test
+# render_report()
+
+
+# Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the pipeline with offline stand-ins")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(BENCHMARK_CONCURRENCY),
+                        help="numbers of simultaneous queries")
+    parser.add_argument("--repeat", type=int, default=BENCHMARK_REPEAT, help="passes over the corpus for each level")
+    parser.add_argument("--corpus", default=BENCHMARK_CORPUS_PATH, help="corpus of utterances (one per line)")
+    parser.add_argument("--record", action="store_true", help="record the Open-Meteo responses (network needed)")
+    parser.add_argument("--output", default=None, help="JSON report (printed if not given)")
+    parser.add_argument("--plans", action="store_true",
+                        help="only compare the Open-Meteo payloads and decoding times before/after the query planner")
+    parser.add_argument("--render", action="store_true",
+                        help="only compare the rendering of the chart and the map, first and repeated views")
+    args = parser.parse_args()
+
+    if args.plans:
+        benchmark_report = plan_report(corpus_path=args.corpus)
+    elif args.render:
+        benchmark_report = render_report()
+    else:
+        benchmark_report = benchmark(concurrency=args.concurrency, repeat=args.repeat, corpus_path=args.corpus,
+                                     record=args.record)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(benchmark_report, output, indent=2, ensure_ascii=False)
+    print(json.dumps(benchmark_report, indent=2, ensure_ascii=False))
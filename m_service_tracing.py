@@ -0,0 +1,291 @@
+"""
+Tracing and metrics of the stages :
+=====================
+
+Each service entry point runs in a span (`@traced("weather")` or `with span("weather"):`) which records the wall time,
+the time spent waiting on upstream HTTP services, the cache hits and the payload sizes of the stage. The services add
+to the current span from inside (`record_upstream`, `record_cache`), without passing it around.
+
+This module can be processed as following :
+- `get_tracing_metrics()` returns the p50/p95 latency of each stage and its counters (which stage dominates p95).
+- `prometheus_text()` exports the metrics in the Prometheus text format, `start_metrics_server(port)` serves it on /metrics
+(started by a_weather_app.py, or by k_job_prewarm.py with `--metrics-port`).
+- `enable_opentelemetry()` also emits every span as an OpenTelemetry span (opentelemetry-api is optional).
+
+Only the standard library is imported here : the services import this module at no cost.
+
+Ressources :
+- Prometheus text format : https://prometheus.io/docs/instrumenting/exposition_formats/
+- OpenTelemetry : https://opentelemetry.io/docs/languages/python/instrumentation/
+"""
+
+import contextvars
+import functools
+import inspect
+import statistics
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds (seconds) of the buckets of the latency histograms
+TRACING_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Number of recent durations kept per stage for the percentiles
+TRACING_WINDOW = 1000
+TRACING_PREFIX = "weather_app"
+# Address of the /metrics endpoint : local only by default, a scraper on another host needs METRICS_HOST="0.0.0.0"
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+
+class Span:
+    """Measures of one run of a stage, filled by the services while the stage runs."""
+
+    __slots__ = ('name', 'attributes', 'upstream_s', 'upstream_calls', 'cache_hits', 'cache_misses',
+                 'payload_bytes', 'error')
+
+    def __init__(self, name, attributes=None):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.upstream_s = 0.0
+        self.upstream_calls = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.payload_bytes = 0
+        self.error = False
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+
+class _StageMetrics:
+    """Aggregated measures of a stage (histogram of the wall time and counters)."""
+
+    def __init__(self):
+        self.buckets = [0] * len(TRACING_BUCKETS)
+        self.count = 0
+        self.sum_s = 0.0
+        self.errors = 0
+        self.upstream_s = 0.0
+        self.upstream_calls = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.payload_bytes = 0
+        self.durations = deque(maxlen=TRACING_WINDOW)
+
+    def add(self, span, duration):
+        self.count += 1
+        self.sum_s += duration
+        self.durations.append(duration)
+        for i, bound in enumerate(TRACING_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+        self.errors += span.error
+        self.upstream_s += span.upstream_s
+        self.upstream_calls += span.upstream_calls
+        self.cache_hits += span.cache_hits
+        self.cache_misses += span.cache_misses
+        self.payload_bytes += span.payload_bytes
+
+
+_stages = {}
+_stages_lock = threading.Lock()
+_current_span = contextvars.ContextVar("current_span", default=None)
+_otel_tracer = None
+
+
+# Function dedicated to run a block in a span : with span("weather") as current: ...
+@contextmanager
+def span(name, **attributes):
+
+    current = Span(name, attributes)
+    token = _current_span.set(current)
+    otel_span = _otel_tracer.start_as_current_span(name) if _otel_tracer is not None else None
+    start = time.perf_counter()
+    try:
+        if otel_span is not None:
+            with otel_span as exported:
+                try:
+                    yield current
+                except BaseException:
+                    current.error = True
+                    raise
+                finally:
+                    _export_span(exported, current)
+        else:
+            yield current
+    except BaseException:
+        current.error = True
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current_span.reset(token)
+        with _stages_lock:
+            _stages.setdefault(name, _StageMetrics()).add(current, duration)
+
+
+# Decorator running a function (or a coroutine) in a span
+# status_key : key of the output dict holding the status, a status starting with "Failed" counts as an error
+def traced(name, status_key=None):
+
+    def _failed(result):
+        return (status_key is not None and isinstance(result, dict)
+                and str(result.get(status_key) or "").startswith("Failed"))
+
+    def decorator(function):
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name) as current:
+                    result = await function(*args, **kwargs)
+                    current.error = _failed(result)
+                    return result
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name) as current:
+                result = function(*args, **kwargs)
+                current.error = _failed(result)
+                return result
+        return wrapper
+
+    return decorator
+
+
+# Function dedicated to return the span of the running stage (None outside a stage)
+def current_span():
+    return _current_span.get()
+
+
+# Function dedicated to add an upstream HTTP call (duration in seconds, size of the response) to the current span
+def record_upstream(duration_s, payload_bytes=0):
+
+    current = _current_span.get()
+    if current is not None:
+        current.upstream_s += duration_s
+        current.upstream_calls += 1
+        current.payload_bytes += payload_bytes or 0
+
+
+# Function dedicated to add a cache lookup to the current span
+def record_cache(hit):
+
+    current = _current_span.get()
+    if current is not None:
+        if hit:
+            current.cache_hits += 1
+        else:
+            current.cache_misses += 1
+
+
+# Function dedicated to copy the measures of a span into the OpenTelemetry span
+def _export_span(exported, current):
+
+    exported.set_attribute("upstream.duration_s", current.upstream_s)
+    exported.set_attribute("upstream.calls", current.upstream_calls)
+    exported.set_attribute("cache.hits", current.cache_hits)
+    exported.set_attribute("cache.misses", current.cache_misses)
+    exported.set_attribute("payload.bytes", current.payload_bytes)
+    exported.set_attribute("error", current.error)
+    for key, value in current.attributes.items():
+        if isinstance(value, (str, bool, int, float)):
+            exported.set_attribute(key, value)
+
+
+# Function dedicated to emit the spans with OpenTelemetry too (the SDK and the exporter are set by the application)
+def enable_opentelemetry(tracer_provider=None):
+
+    global _otel_tracer
+    from opentelemetry import trace
+    _otel_tracer = trace.get_tracer("vocal_weather_app", tracer_provider=tracer_provider)
+    return _otel_tracer
+
+
+# Function dedicated to return the latency percentiles (ms) and the counters of each stage
+def get_tracing_metrics():
+
+    metrics = {}
+    with _stages_lock:
+        for name, stage in _stages.items():
+            durations_ms = [duration * 1000 for duration in stage.durations]
+            metrics[name] = {'count': stage.count,
+                             'errors': stage.errors,
+                             'upstream_calls': stage.upstream_calls,
+                             'upstream_s': round(stage.upstream_s, 3),
+                             'cache_hits': stage.cache_hits,
+                             'cache_misses': stage.cache_misses,
+                             'payload_bytes': stage.payload_bytes}
+            if len(durations_ms) >= 2:
+                percentiles = statistics.quantiles(durations_ms, n=100)
+                metrics[name]['p50_ms'] = round(percentiles[49], 2)
+                metrics[name]['p95_ms'] = round(percentiles[94], 2)
+    return metrics
+
+
+# Function dedicated to reset the metrics (tests, benchmarks)
+def reset_tracing_metrics():
+    with _stages_lock:
+        _stages.clear()
+
+
+# Function dedicated to export the metrics in the Prometheus text format
+def prometheus_text(prefix=TRACING_PREFIX):
+
+    counters = (('errors', 'errors_total', "Runs of the stage which failed"),
+                ('upstream_calls', 'upstream_calls_total', "Upstream HTTP calls of the stage"),
+                ('upstream_s', 'upstream_seconds_total', "Time spent waiting on upstream HTTP services"),
+                ('cache_hits', 'cache_hits_total', "Cache lookups of the stage served by a cache"),
+                ('cache_misses', 'cache_misses_total', "Cache lookups of the stage missed"),
+                ('payload_bytes', 'payload_bytes_total', "Size of the upstream responses"))
+
+    with _stages_lock:
+        stages = sorted(_stages.items())
+        histogram = f"{prefix}_stage_duration_seconds"
+        lines = [f"# HELP {histogram} Wall time of the stages",
+                 f"# TYPE {histogram} histogram"]
+        for name, stage in stages:
+            cumulative = 0
+            for bound, count in zip(TRACING_BUCKETS, stage.buckets):
+                cumulative += count
+                lines.append(f'{histogram}_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{histogram}_bucket{{stage="{name}",le="+Inf"}} {stage.count}')
+            lines.append(f'{histogram}_sum{{stage="{name}"}} {stage.sum_s}')
+            lines.append(f'{histogram}_count{{stage="{name}"}} {stage.count}')
+
+        for attribute, suffix, description in counters:
+            metric = f"{prefix}_stage_{suffix}"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, stage in stages:
+                lines.append(f'{metric}{{stage="{name}"}} {getattr(stage, attribute)}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Function dedicated to serve the metrics on http://host:port/metrics from a daemon thread
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,188 @@
+"""
+Hourly rollups of the monitoring table :
+=====================
+
+The dashboards read the hourly aggregates of `weather_app_monitoring_hourly` instead of scanning the raw rows :
+one row per (hour, stage) with the number of requests, the failures, the latency percentiles and the cache hits.
+
+This module can be processed as following :
+- `rollup_monitoring()` is incremental : the last hour already aggregated (possibly partial) and the newer rows are
+aggregated again, the older hours are not read.
+- The raw rows are streamed in timestamp order (`read_monitoring_batches`) : an hour is aggregated as soon as
+its rows are read, the memory holds at most one hour and one batch.
+- To be scheduled every hour (cron, Azure Function, Streamlit background thread with `--every 3600`).
+
+From the terminal :
+python n_job_rollup.py
+python n_job_rollup.py --since "2024-03-01 00:00:00"
+python n_job_rollup.py --every 3600
+"""
+
+import argparse
+import sqlite3
+import time
+
+from j_lazy_import import lazy_import
+from f_service_db_storage import bootstrap_schema, get_connection_pool, read_monitoring_batches
+
+# Heavy library imported on first use
+pd = lazy_import("pandas")
+
+
+ROLLUP_TABLE = "weather_app_monitoring_hourly"
+# Stages aggregated : (stage, status column, duration column in ms, cache-hit column)
+ROLLUP_STAGES = (
+    ("speech", "speech_status", "speech_ms", None),
+    ("city", "extract_city_status", "extract_city_ms", None),
+    ("horizon", "extract_horizon_status", "extract_horizon_ms", None),
+    ("geocoding", "geocoding_status", "geocoding_ms", "geocoding_cache_hit"),
+    ("weather", "weather_status", "weather_ms", "weather_cache_hit"),
+)
+ROLLUP_COLUMNS = ("hour", "stage", "requests", "failures", "failure_rate", "p50_ms", "p95_ms", "p99_ms", "cache_hits")
+
+AZURE_CREATE_ROLLUP_TABLE = f'''
+    IF NOT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = '{ROLLUP_TABLE}')
+    BEGIN
+        CREATE TABLE {ROLLUP_TABLE} (
+            hour DATETIME2(0) NOT NULL,
+            stage NVARCHAR(20) NOT NULL,
+            requests INT,
+            failures INT,
+            failure_rate FLOAT,
+            p50_ms FLOAT,
+            p95_ms FLOAT,
+            p99_ms FLOAT,
+            cache_hits INT,
+            PRIMARY KEY (hour, stage)
+        );
+    END;
+'''
+
+SQLITE_CREATE_ROLLUP_TABLE = f'''
+    CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+        hour TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        requests INTEGER,
+        failures INTEGER,
+        failure_rate REAL,
+        p50_ms REAL,
+        p95_ms REAL,
+        p99_ms REAL,
+        cache_hits INTEGER,
+        PRIMARY KEY (hour, stage)
+    );
+'''
+
+
+# Function dedicated to create the rollup table and to return the last hour aggregated (None on the first run)
+def _last_rollup_hour(connection):
+
+    cursor = connection.cursor()
+    is_sqlite = isinstance(connection, sqlite3.Connection)
+    cursor.execute(SQLITE_CREATE_ROLLUP_TABLE if is_sqlite else AZURE_CREATE_ROLLUP_TABLE)
+    connection.commit()
+    cursor.execute(f"SELECT MAX(hour) FROM {ROLLUP_TABLE}")
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# Function dedicated to aggregate the rows of complete hours into rollup records
+def aggregate_hours(rows):
+
+    records = []
+    for hour, group in rows.groupby("hour", sort=True):
+        hour_text = hour.strftime("%Y-%m-%d %H:%M:%S")
+        for stage, status_column, duration_column, cache_column in ROLLUP_STAGES:
+            status = group[status_column].dropna()
+            if status.empty:
+                continue
+            failures = int(status.astype(str).str.startswith("Failed").sum())
+            durations = pd.to_numeric(group[duration_column], errors="coerce").dropna()
+            percentiles = durations.quantile([0.5, 0.95, 0.99]).tolist() if not durations.empty else [None] * 3
+            cache_hits = int(pd.to_numeric(group[cache_column], errors="coerce").fillna(0).sum()) if cache_column else None
+            records.append((hour_text, stage, int(status.shape[0]), failures, failures / status.shape[0],
+                            *(round(value, 1) if value is not None else None for value in percentiles), cache_hits))
+    return records
+
+
+# Function dedicated to update the hourly rollups from `since` (default : the last hour already aggregated)
+# Returns the number of rollup records written
+def rollup_monitoring(since=None):
+
+    with get_connection_pool().connection() as connection:
+        if connection is None:
+            print('Impossible to roll up the DB.')
+            return 0
+        bootstrap_schema(connection)
+        last_hour = _last_rollup_hour(connection)
+    first_hour = since if since is not None else last_hour
+    start_text = pd.Timestamp(first_hour).strftime("%Y-%m-%d %H:00:00") if first_hour is not None else None
+
+    columns = ["timestamp"] + [column for _, status, duration, cache in ROLLUP_STAGES
+                               for column in (status, duration, cache) if column]
+    records, pending = [], None
+    for batch in read_monitoring_batches(start=start_text):
+        batch = batch[columns].copy()
+        batch["hour"] = pd.to_datetime(batch["timestamp"]).dt.floor("h")
+        rows = batch if pending is None else pd.concat([pending, batch], ignore_index=True)
+        # The rows come in timestamp order : every hour before the last one of the batch is complete
+        last = rows["hour"].max()
+        records.extend(aggregate_hours(rows[rows["hour"] < last]))
+        pending = rows[rows["hour"] == last]
+    if pending is not None:
+        records.extend(aggregate_hours(pending))
+
+    if not records:
+        return 0
+    # The DB may have become unreachable while the monitoring rows were read
+    with get_connection_pool().connection() as connection:
+        if connection is None:
+            print('Rollups not saved to DB.')
+            return 0
+        cursor = connection.cursor()
+        # The hours aggregated again are replaced
+        cursor.execute(f"DELETE FROM {ROLLUP_TABLE} WHERE hour >= ?", [records[0][0]])
+        cursor.executemany(f"INSERT INTO {ROLLUP_TABLE} ({', '.join(ROLLUP_COLUMNS)}) "
+                           f"VALUES ({', '.join('?' * len(ROLLUP_COLUMNS))})", records)
+        connection.commit()
+    return len(records)
+
+# Test :
+# rollup_monitoring(since="2024-03-01")
+
+
+# Function dedicated to read the rollups of a period as a DataFrame (the dashboards query kilobytes)
+def read_rollups(start=None, end=None, stage=None):
+
+    conditions, params = [], []
+    for condition, value in (("hour >= ?", start), ("hour < ?", end), ("stage = ?", stage)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(str(value))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    with get_connection_pool().connection() as connection:
+        if connection is None:
+            print('Impossible to read data from DB.')
+            return None
+        _last_rollup_hour(connection)
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT {', '.join(ROLLUP_COLUMNS)} FROM {ROLLUP_TABLE} {where} ORDER BY hour, stage", params)
+        return pd.DataFrame.from_records([tuple(row) for row in cursor.fetchall()], columns=list(ROLLUP_COLUMNS))
+
+
+# Execution du script seulement s'il est appelé directement dans le terminal, sinon chargement uniquement sans exécution
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Hourly rollups of the monitoring table")
+    parser.add_argument("--since", default=None, help="first hour to aggregate again (default : the last hour aggregated)")
+    parser.add_argument("--every", type=float, default=None, help="run again every N seconds")
+    args = parser.parse_args()
+
+    since = args.since
+    while True:
+        print(f"Rollup : {rollup_monitoring(since=since)} hourly records written")
+        if args.every is None:
+            break
+        since = None
+        time.sleep(args.every)
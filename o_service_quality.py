@@ -0,0 +1,143 @@
+"""
+Quality gate of the vocal commands :
+=====================
+
+Procedure in the event of results below a minimum quality threshold : before paying for the horizon model,
+the geocoding and the forecast, the controller scores the transcription and the extracted city and picks
+the cheapest path to a usable command :
+- `proceed` : the transcription is confident enough and the NER found a city,
+- `fuzzy_gazetteer` : no city from the NER, but words of the transcription match a city of the local gazetteer
+("la météo à tour", "à saint etiene") : no API call,
+- `last_city` : no city in the command, the last city of the session is reused ("et pour demain ?"),
+- `reprompt` : the transcription is not confident or no city can be found : the user is asked again and
+nothing is called downstream (no silent default city).
+
+The decision is returned with the other outputs of the pipeline and stored in the monitoring table (`quality_decision`).
+The horizon below its minimal score falls back to the default horizon with `horizon_in_days`, a date beyond the
+forecast (`horizon_out_of_range`) is not forecast.
+
+Thresholds :
+- SPEECH_MIN_CONFIDENCE : confidence of the Azure recognition (0 to 1), unknown confidences are accepted.
+- QUALITY_FUZZY_MIN_SCORE : score of the gazetteer match of a word of the transcription (common words score below 0.6).
+- HORIZON_MIN_SCORE : score of the DATE entity of the horizon model.
+"""
+
+import re
+import threading
+from collections import Counter, OrderedDict
+
+
+SPEECH_MIN_CONFIDENCE = 0.5
+QUALITY_FUZZY_MIN_SCORE = 0.75
+HORIZON_MIN_SCORE = 0.5
+QUALITY_DEFAULT_HORIZON = 1
+# Number of sessions whose last city is kept
+QUALITY_MAX_SESSIONS = 1024
+
+_last_cities = OrderedDict()
+_last_cities_lock = threading.Lock()
+_quality_metrics = Counter()
+
+
+# Function dedicated to remember the last city resolved for a session (None : the process, e.g. the command line)
+def remember_city(city, session=None):
+
+    if not city:
+        return
+    with _last_cities_lock:
+        _last_cities[session] = city
+        _last_cities.move_to_end(session)
+        while len(_last_cities) > QUALITY_MAX_SESSIONS:
+            _last_cities.popitem(last=False)
+
+
+def last_city(session=None):
+    with _last_cities_lock:
+        return _last_cities.get(session)
+
+
+# Function dedicated to find a city of the gazetteer in the words of a transcription (groups of 1 to 3 words)
+# Returns (city, score) or None
+def city_from_gazetteer(text, min_score=QUALITY_FUZZY_MIN_SCORE):
+
+    from d_service_geocoding import get_gazetteer, normalise_city_name
+
+    if not text:
+        return None
+    gazetteer = get_gazetteer()
+    words = re.findall(r"[\w'-]+", normalise_city_name(text))
+    best = None
+    for size in (1, 2, 3):
+        for start in range(len(words) - size + 1):
+            for i, score in gazetteer.search(" ".join(words[start:start + size]), limit=1):
+                if score >= min_score and (best is None or score > best[1]):
+                    best = (gazetteer.names[i], score)
+    return best
+
+
+# Function dedicated to build the decision of the gate
+def _decision(decision, reason, city=None, score=None):
+
+    _quality_metrics[decision] += 1
+    return {'quality_decision': decision,
+            'quality_reason': reason,
+            'city': city,
+            'quality_score': score}
+
+
+# Function dedicated to decide what to do with a command from the outputs of the speech and city services
+def assess_command(speech, city, session=None):
+
+    # Part 1 - Transcription : failed or below the minimal confidence, nothing else can be trusted
+    if not speech or not speech.get('speech_text'):
+        return _decision("reprompt", "No speech recognized")
+    confidence = speech.get('speech_confidence')
+    if confidence is not None and confidence < SPEECH_MIN_CONFIDENCE:
+        return _decision("reprompt", f"Speech confidence {confidence:.2f} below {SPEECH_MIN_CONFIDENCE}", score=confidence)
+
+    # Part 2 - City from the NER
+    if city and city.get('city_extracted'):
+        return _decision("proceed", "City extracted", city['city_extracted'], confidence)
+
+    # Part 3 - Cheapest recovery : the local gazetteer, then the last city of the session, else ask again
+    match = city_from_gazetteer(speech['speech_text'])
+    if match is not None:
+        return _decision("fuzzy_gazetteer", "City matched in the gazetteer", match[0], match[1])
+    previous = last_city(session)
+    if previous is not None:
+        return _decision("last_city", "No city in the command, last city of the session", previous)
+    return _decision("reprompt", "No city in the command")
+
+# Test
+# assess_command({'speech_text': 'quel temps à saint etiene jeudi', 'speech_info': 'Successed'}, {'city_extracted': None})
+
+
+# Function dedicated to tell if the date asked is beyond the forecast (nothing is forecast rather than a wrong day)
+def horizon_out_of_range(horizon):
+
+    from c_service_ner import HORIZON_OUT_OF_RANGE_INFO
+    return bool(horizon) and horizon.get('horizon_extracted_info') == HORIZON_OUT_OF_RANGE_INFO
+
+
+# Function dedicated to return the horizon to forecast (default horizon if missing or below the minimal score)
+def horizon_in_days(horizon):
+
+    days = horizon.get('horizon_extracted') if horizon else None
+    score = horizon.get('horizon_extracted_score') if horizon else None
+    if days is None or (score is not None and score < HORIZON_MIN_SCORE):
+        return QUALITY_DEFAULT_HORIZON
+    return days
+
+
+# Function dedicated to return the days asked (HorizonWindow of the rules), None if unknown or below the minimal score
+def horizon_window(horizon):
+
+    score = horizon.get('horizon_extracted_score') if horizon else None
+    if not horizon or (score is not None and score < HORIZON_MIN_SCORE):
+        return None
+    return horizon.get('horizon_extracted_window')
+
+
+# Function dedicated to expose the number of each decision
+def get_quality_metrics():
+    return dict(_quality_metrics)
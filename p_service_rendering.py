@@ -0,0 +1,126 @@
+"""
+Rendering artefacts of the app :
+=====================
+
+The chart and the map of a forecast are built by pure functions returning serialised artefacts : the Plotly figure
+as JSON and the Folium map as HTML. The app caches them by (city, horizon, forecast run) : the repeated views of
+a city reuse the artefacts, the figure and the map are not rebuilt and Folium is not serialised again.
+
+This module can be processed as following :
+- `build_weather_figure(weather_df, resolution)` returns the JSON of the temperature and precipitation chart.
+- `figure_with_now(figure_json, now)` adds the marker of the current time to the figure (the artefact does not depend on the time).
+- `build_weather_map(city, lat, lon)` returns the HTML of the map of the city.
+- `get_rendering_metrics()` counts the artefacts built and their building time (a cache hit builds nothing).
+
+Ressources :
+- Plotly JSON : https://plotly.com/python/figure-structure/
+- Streamlit caching : https://docs.streamlit.io/develop/concepts/architecture/caching
+"""
+
+import json
+import threading
+import time
+from collections import Counter
+
+from j_lazy_import import lazy_import
+
+# Rendering libraries imported on first use
+np = lazy_import("numpy")
+plotly_subplots = lazy_import("plotly.subplots")
+go = lazy_import("plotly.graph_objs")
+folium = lazy_import("folium")
+
+
+# Height of the map (pixels)
+MAP_HEIGHT = 370
+# Columns of the chart (temperature, precipitation) for each resolution of the forecast
+CHART_COLUMNS = {'hourly': ("temperature_2m", "precipitation"),
+                 'current': ("temperature_2m", "precipitation"),
+                 'daily': ("temperature_2m_max", "precipitation_sum")}
+
+_rendering_metrics = Counter()
+_rendering_lock = threading.Lock()
+
+
+# Function dedicated to count an artefact built and its building time
+def _record_build(name, start):
+    with _rendering_lock:
+        _rendering_metrics[f'{name}_builds'] += 1
+        _rendering_metrics[f'{name}_ms'] += (time.perf_counter() - start) * 1000
+
+
+# Function dedicated to build the chart of the temperature and the precipitation, returns the figure as JSON
+def build_weather_figure(weather_df, resolution="hourly"):
+
+    start = time.perf_counter()
+    temperature_column, precipitation_column = CHART_COLUMNS.get(resolution, CHART_COLUMNS['hourly'])
+    # The ranges of the axes are computed once
+    temperature = weather_df[temperature_column].to_numpy()
+    precipitation = weather_df[precipitation_column].to_numpy()
+    temperature_min, temperature_max = float(np.nanmin(temperature)), float(np.nanmax(temperature))
+    precipitation_min, precipitation_max = float(np.nanmin(precipitation)), float(np.nanmax(precipitation))
+
+    # Create figure with secondary y axis
+    fig = plotly_subplots.make_subplots(specs=[[{"secondary_y": True}]])
+    fig.add_trace(go.Scatter(x=weather_df['date'], y=temperature, name="Temperature °C"), secondary_y=False)
+    fig.add_trace(go.Bar(x=weather_df['date'], y=precipitation, name="Precipitation mm"), secondary_y=True)
+
+    fig.update_yaxes(range=[temperature_min - 10, temperature_max + 10],
+                     title_text="Temperature °C",
+                     secondary_y=False,
+                     showgrid=False,
+                     zeroline=False)
+    fig.update_yaxes(range=[precipitation_min - 2, precipitation_max + 8],
+                     title_text="Precipitation (rain/showers/snow) mm",
+                     secondary_y=True,
+                     showgrid=False)
+    fig.update_layout(legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=0.7))
+
+    figure_json = fig.to_json()
+    _record_build('figure', start)
+    return figure_json
+
+# Test
+# build_weather_figure(weather_forecast_from_coord(lat=47.3900474, lon=0.6889268)['weather_df'])
+
+
+# Function dedicated to add the marker of the current time to a figure, returns the figure as a dict
+def figure_with_now(figure_json, now):
+
+    figure = json.loads(figure_json)
+    layout = figure.setdefault('layout', {})
+    x = now.isoformat()
+    layout.setdefault('shapes', []).append({'type': "line", 'x0': x, 'x1': x, 'xref': "x", 'y0': 0, 'y1': 1,
+                                            'yref': "paper", 'line': {'color': "red"}, 'opacity': 0.4})
+    layout.setdefault('annotations', []).append({'x': x, 'y': 1, 'xref': "x", 'yref': "paper",
+                                                 'text': now.strftime("%d %b %y, %H:%M"), 'showarrow': False})
+    return figure
+
+
+# Function dedicated to build the map of the city, returns the HTML page of the map
+def build_weather_map(city, lat, lon, height=MAP_HEIGHT):
+
+    start = time.perf_counter()
+    m = folium.Map(location=[lat, lon], zoom_start=7)
+    folium.Marker([lat, lon],
+                  popup=city,
+                  tooltip=f'Il fait toujours beau à {city} 😃').add_to(m)
+    # Same page as streamlit_folium.folium_static, rendered once
+    map_html = folium.Figure(height=height).add_child(m).render()
+    _record_build('map', start)
+    return map_html
+
+# Test
+# build_weather_map(city='Tours', lat=47.3900474, lon=0.6889268)
+
+
+# Function dedicated to expose the number of artefacts built and their mean building time
+def get_rendering_metrics():
+
+    with _rendering_lock:
+        metrics = dict(_rendering_metrics)
+    for name in ('figure', 'map'):
+        builds = metrics.get(f'{name}_builds', 0)
+        if builds:
+            metrics[f'{name}_mean_ms'] = round(metrics.pop(f'{name}_ms') / builds, 2)
+    return metrics
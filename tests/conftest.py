@@ -0,0 +1,14 @@
+"""
+Shared setup of the tests :
+=====================
+
+The services are flat modules at the root of the repository : the root is added to the import path.
+
+From the terminal (at the root of the repository) :
+python -m pytest -q
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
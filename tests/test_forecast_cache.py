@@ -0,0 +1,138 @@
+"""
+Tests of the forecast cache (e_service_weather_forecast) : keys on the model grid, blocks covering the plans,
+expiry at the next model run and the bounds of the cache. The forecasts are synthetic blocks, no request is sent.
+"""
+
+import datetime
+
+import numpy as np
+
+from c_service_ner import HorizonWindow
+from e_service_weather_forecast import (CURRENT_INTERVAL, DISPLAY_VARIABLES, FORECAST_MAX_DAYS, HOURLY_VARIABLES,
+                                        ForecastCache, HourlyForecast, _cached_request, fetch_plan, next_model_run,
+                                        plan_expiry, plan_forecast, snap_to_grid)
+
+
+TODAY = datetime.date(2026, 10, 19)
+# 10:00 GMT on TODAY
+NOW = datetime.datetime(2026, 10, 19, 10, tzinfo=datetime.timezone.utc).timestamp()
+KEY = (47.4, 0.7, "hourly")
+
+
+# Function dedicated to build a synthetic hourly block of the days and variables of a plan
+def forecast_block(plan):
+
+    start = datetime.datetime(plan.start_date.year, plan.start_date.month, plan.start_date.day,
+                              tzinfo=datetime.timezone.utc).timestamp()
+    hours = ((plan.end_date - plan.start_date).days + 1) * 24
+    times = (start + 3600 * np.arange(hours)).astype("int64")
+    values = np.arange(len(plan.variables) * hours, dtype="float32").reshape(len(plan.variables), hours)
+    return HourlyForecast(time=times, variables=tuple(variable.name for variable in plan.variables), values=values)
+
+
+def day_plan(first_day, last_day=None, variables=HOURLY_VARIABLES):
+    window = HorizonWindow(first_day, first_day if last_day is None else last_day)
+    return plan_forecast(window=window, variables=variables, today=TODAY)
+
+
+def test_points_of_a_grid_cell_share_the_key():
+    key, fetched, params = _cached_request(47.3900474, 0.6889268, day_plan(1))
+    assert key == _cached_request(47.3951, 0.6921, day_plan(1))[0]
+    assert key == snap_to_grid(47.3900474, 0.6889268) + ("hourly",)
+    assert (params["latitude"], params["longitude"]) == key[:2]
+    assert key != _cached_request(47.3900474, 0.6889268, plan_forecast(horizon=10, today=TODAY))[0]
+
+
+def test_minimal_request_by_default():
+    plan = day_plan(1, variables=DISPLAY_VARIABLES)
+    assert fetch_plan(plan, today=TODAY) == plan
+    assert _cached_request(47.39, 0.69, plan)[1] == plan
+
+    widest = fetch_plan(plan, today=TODAY, widen=True)
+    assert (widest.start_date, widest.end_date) == (TODAY, TODAY + datetime.timedelta(days=FORECAST_MAX_DAYS - 1))
+    assert widest.variables == tuple(HOURLY_VARIABLES)
+
+
+def test_covering_block_serves_a_slice():
+    cache = ForecastCache()
+    widest = fetch_plan(day_plan(0), today=TODAY, widen=True)
+    cache.put(KEY, forecast_block(widest), widest, now=NOW)
+
+    forecast = cache.get(KEY, day_plan(1, variables=DISPLAY_VARIABLES), now=NOW)
+    assert forecast.variables == tuple(variable.name for variable in DISPLAY_VARIABLES)
+    assert forecast.values.shape == (len(DISPLAY_VARIABLES), 24)
+    assert forecast.time[0] == NOW - 10 * 3600 + 86400
+    assert cache.metrics['hits'] == 1
+
+
+def test_block_not_covering_is_a_miss():
+    cache = ForecastCache()
+    plan = day_plan(1, variables=DISPLAY_VARIABLES)
+    cache.put(KEY, forecast_block(plan), plan, now=NOW)
+    assert cache.get(KEY, day_plan(2, variables=DISPLAY_VARIABLES), now=NOW) is None
+    # Other variables of the same day
+    assert cache.get(KEY, day_plan(1), now=NOW) is None
+    assert cache.get((47.425, 0.7, "hourly"), plan, now=NOW) is None
+    assert cache.metrics['misses'] == 3
+
+
+def test_expiry_at_the_next_model_run():
+    cache = ForecastCache()
+    plan = day_plan(1)
+    cache.put(KEY, forecast_block(plan), plan, now=NOW)
+    expires_at = plan_expiry(plan, NOW)
+    assert expires_at == next_model_run(NOW) > NOW
+
+    assert cache.get(KEY, plan, now=expires_at - 1) is not None
+    assert cache.get(KEY, plan, now=expires_at) is None
+    assert cache.metrics['expired'] == 1
+    assert cache.metrics['bytes'] == 0
+    assert KEY not in cache.entries
+
+
+def test_next_model_run():
+    # Runs every 3 hours, published 2 hours later : the 06:00 run is published at 08:00, the 09:00 run at 11:00
+    assert next_model_run(NOW) == NOW + 3600
+    assert next_model_run(NOW + 3600) == NOW + 4 * 3600
+
+
+def test_current_conditions_expire_on_the_quarter():
+    plan = plan_forecast(window=HorizonWindow(0, 0, now=True), today=TODAY)
+    assert plan.resolution == "current"
+    assert plan_expiry(plan, NOW + 60) == NOW + CURRENT_INTERVAL
+
+
+def test_new_block_drops_the_covered_ones():
+    cache = ForecastCache()
+    narrow = day_plan(1, variables=DISPLAY_VARIABLES)
+    widest = fetch_plan(narrow, today=TODAY, widen=True)
+    cache.put(KEY, forecast_block(narrow), narrow, now=NOW)
+    cache.put(KEY, forecast_block(widest), widest, now=NOW)
+    assert [block[1] for block in cache.entries[KEY]] == [widest]
+
+    # Already covered : not stored
+    cache.put(KEY, forecast_block(narrow), narrow, now=NOW)
+    assert [block[1] for block in cache.entries[KEY]] == [widest]
+    assert cache.metrics['bytes'] == ForecastCache._nbytes(forecast_block(widest))
+
+
+def test_blocks_per_key_are_bounded():
+    cache = ForecastCache(max_blocks=4)
+    plans = [day_plan(day) for day in range(5)]
+    for plan in plans:
+        cache.put(KEY, forecast_block(plan), plan, now=NOW)
+    assert [block[1] for block in cache.entries[KEY]] == plans[1:]
+    assert cache.metrics['evictions'] == 1
+    assert cache.get(KEY, plans[0], now=NOW) is None
+
+
+def test_least_recently_used_key_is_evicted():
+    cache = ForecastCache(max_entries=2)
+    plan = day_plan(1)
+    keys = [(47.4, 0.7, "hourly"), (48.85, 2.35, "hourly"), (43.3, 5.375, "hourly")]
+    cache.put(keys[0], forecast_block(plan), plan, now=NOW)
+    cache.put(keys[1], forecast_block(plan), plan, now=NOW)
+    # The first key is used again : the second one is the least recently used
+    cache.get(keys[0], plan, now=NOW)
+    cache.put(keys[2], forecast_block(plan), plan, now=NOW)
+    assert list(cache.entries) == [keys[0], keys[2]]
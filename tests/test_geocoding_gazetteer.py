@@ -0,0 +1,115 @@
+"""
+Tests of the local layers of the geocoding (d_service_geocoding) : LRU, SQLite cache and gazetteer,
+the phonetic aliases accepted locally and the fuzzy matches used only when Nominatim fails.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+import d_service_geocoding
+from d_service_geocoding import (FUZZY_MIN_SCORE, _resolve_locally, _sqlite_set, city_to_coordinates,
+                                 normalise_city_name, resolve_city)
+
+
+# Real towns missing from the gazetteer whose closest entry is another city
+WRONG_CITY_CASES = [("Saint-Lô", "Saint-Malo"),
+                    ("Saint-Dié", "Saint-Denis"),
+                    ("Aix-les-Bains", "Digne-les-Bains"),
+                    ("Marseillan", "Marseille"),
+                    ("Parisot", "Paris"),
+                    ("Cannes-Écluse", "Cannes")]
+
+
+# Empty LRU and SQLite caches for each test, Nominatim is never asked unless a test replaces it
+@pytest.fixture(autouse=True)
+def isolated_caches(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(d_service_geocoding, "GEOCODING_CACHE_PATH", str(tmp_path / "geocoding.sqlite"))
+    monkeypatch.setattr(d_service_geocoding, "_sqlite_connection", None)
+    monkeypatch.setattr(d_service_geocoding, "_lru_cache", type(d_service_geocoding._lru_cache)())
+    nominatim_geocode(monkeypatch, error=AssertionError("Nominatim asked"))
+    yield
+    if d_service_geocoding._sqlite_connection is not None:
+        d_service_geocoding._sqlite_connection.close()
+
+
+# Function dedicated to replace Nominatim : the location of `coordinates`, None, or the error raised
+def nominatim_geocode(monkeypatch, coordinates=None, error=None):
+
+    calls = []
+
+    def _geocode(city, **kwargs):
+        calls.append(city)
+        if error is not None:
+            raise error
+        return None if coordinates is None else SimpleNamespace(latitude=coordinates[0], longitude=coordinates[1])
+
+    monkeypatch.setattr(d_service_geocoding, "_get_nominatim_geocode", lambda: _geocode)
+    return calls
+
+
+def test_normalise_city_name():
+    assert normalise_city_name(" St-Étienne ") == "saint etienne"
+    assert normalise_city_name("L'Haÿ-les-Roses") == "l hay les roses"
+
+
+def test_exact_match_then_lru():
+    city, lat, lon, score, source = _resolve_locally(normalise_city_name("Tours"))
+    assert (city, score, source) == ("Tours", 1.0, "gazetteer")
+    assert _resolve_locally(normalise_city_name("TOURS"))[-1] == "lru"
+
+
+def test_sqlite_layer():
+    _sqlite_set("marseillan", "Marseillan", 43.35, 3.53)
+    assert _resolve_locally("marseillan") == ("Marseillan", 43.35, 3.53, None, "sqlite")
+
+
+@pytest.mark.parametrize("spoken, city", [("tour", "Tours"), ("bordo", "Bordeaux")])
+def test_phonetic_alias(spoken, city):
+    resolved = _resolve_locally(normalise_city_name(spoken))
+    assert resolved[0] == city
+    assert resolved[-1] == "gazetteer_phonetic"
+
+
+@pytest.mark.parametrize("city, closest", WRONG_CITY_CASES)
+def test_fuzzy_match_is_not_accepted_locally(city, closest):
+    assert _resolve_locally(normalise_city_name(city)) is None
+
+
+@pytest.mark.parametrize("city, closest", WRONG_CITY_CASES)
+def test_nominatim_before_fuzzy_match(city, closest, monkeypatch):
+    calls = nominatim_geocode(monkeypatch, coordinates=(45.0, 5.0))
+    assert resolve_city(city) == (city, 45.0, 5.0, None, "nominatim")
+    assert calls == [city]
+    # Stored into the caches
+    assert resolve_city(city)[-1] == "lru"
+
+
+@pytest.mark.parametrize("city, closest", WRONG_CITY_CASES)
+def test_fuzzy_match_when_nominatim_fails(city, closest, monkeypatch):
+    calls = nominatim_geocode(monkeypatch, error=TimeoutError("Nominatim timed out"))
+    name, lat, lon, score, source = resolve_city(city)
+    assert (name, source) == (closest, "gazetteer_fuzzy")
+    assert score >= FUZZY_MIN_SCORE
+    # Not cached : Nominatim is asked again next time
+    resolve_city(city)
+    assert calls == [city, city]
+
+
+def test_fuzzy_match_when_nominatim_finds_nothing(monkeypatch):
+    nominatim_geocode(monkeypatch)
+    assert resolve_city("Parisot")[::4] == ("Paris", "gazetteer_fuzzy")
+
+
+def test_unknown_city_when_nominatim_fails(monkeypatch):
+    nominatim_geocode(monkeypatch, error=TimeoutError("Nominatim timed out"))
+    with pytest.raises(TimeoutError):
+        resolve_city("Xqzwvk")
+
+
+def test_output_has_the_matched_name():
+    geocoding = city_to_coordinates("bordo")
+    assert geocoding['city'] == "Bordeaux"
+    assert geocoding['geocoding_info'] == "Successed"
+    assert geocoding['geocoding_source'] == "gazetteer_phonetic"
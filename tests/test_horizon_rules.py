@@ -0,0 +1,89 @@
+"""
+Tests of the rule-based French horizon parser (c_service_ner) :
+the relative expressions, the weekdays with and without "prochain" and the dates out of range.
+"""
+
+import datetime
+
+import pytest
+
+from c_service_ner import (HORIZON_MAX_DAYS, HORIZON_NOT_FOUND_INFO, HORIZON_OUT_OF_RANGE_INFO, HorizonWindow,
+                           _horizon_fields, extract_horizon_rules, extract_horizon_window)
+
+
+# Monday 19 October 2026
+MONDAY = datetime.date(2026, 10, 19)
+
+
+@pytest.mark.parametrize("text, window", [
+    ("quelle est la météo à Tours aujourd'hui", HorizonWindow(0, 0)),
+    ("il fait quel temps en ce moment à Lyon", HorizonWindow(0, 0, now=True)),
+    ("la météo de demain à Paris", HorizonWindow(1, 1)),
+    ("et après-demain à Brest", HorizonWindow(2, 2)),
+    ("la météo pour les 3 prochains jours", HorizonWindow(0, 2)),
+    ("la météo sur les cinq jours à venir", HorizonWindow(0, 4)),
+    ("il pleut dans 4 jours à Nantes", HorizonWindow(4, 4)),
+    ("le temps ce week-end à Nice", HorizonWindow(5, 6)),
+    ("la météo de la semaine prochaine", HorizonWindow(7, 13)),
+    ("la météo de cette semaine", HorizonWindow(0, 6)),
+    ("la météo le 25 octobre", HorizonWindow(6, 6)),
+])
+def test_relative_expressions(text, window):
+    assert extract_horizon_window(text, today=MONDAY) == window
+
+
+@pytest.mark.parametrize("text, days", [
+    # The same weekday is today, "prochain" is in a week
+    ("la météo de lundi", 0),
+    ("la météo de lundi prochain", 7),
+    ("la météo de mercredi", 2),
+    ("la météo de mercredi prochain", 2),
+    ("la météo de dimanche", 6),
+])
+def test_weekdays(text, days):
+    assert extract_horizon_window(text, today=MONDAY) == HorizonWindow(days, days)
+
+
+def test_weekend_on_sunday_is_today():
+    sunday = MONDAY - datetime.timedelta(days=1)
+    assert extract_horizon_window("la météo ce week-end", today=sunday) == HorizonWindow(0, 0)
+
+
+def test_horizon_counts_today():
+    assert extract_horizon_rules("la météo de demain", today=MONDAY) == 2
+    assert extract_horizon_rules("la météo de lundi prochain", today=MONDAY) == 8
+
+
+def test_past_date_is_next_year_out_of_range():
+    # The 1st of October is already past : the 1st of October 2027 is beyond the forecast
+    window = extract_horizon_window("la météo du 1er octobre", today=MONDAY)
+    assert window.first_day > HORIZON_MAX_DAYS
+    assert extract_horizon_rules("la météo du 1er octobre", today=MONDAY) is None
+
+
+def test_explicit_past_year_is_not_found():
+    assert extract_horizon_window("la météo du 3 octobre 2026", today=MONDAY) is None
+
+
+@pytest.mark.parametrize("text", ["dans 20 jours", "pour les 17 prochains jours"])
+def test_out_of_range(text):
+    window = extract_horizon_window(text, today=MONDAY)
+    assert window.last_day >= HORIZON_MAX_DAYS
+    assert extract_horizon_rules(text, today=MONDAY) is None
+    fields = _horizon_fields(window)
+    assert fields['horizon_extracted_info'] == HORIZON_OUT_OF_RANGE_INFO
+    assert fields['horizon_extracted'] is None
+
+
+def test_last_day_in_range():
+    window = extract_horizon_window("pour les 16 prochains jours", today=MONDAY)
+    assert _horizon_fields(window)['horizon_extracted'] == HORIZON_MAX_DAYS
+
+
+def test_no_date_is_a_failure():
+    assert extract_horizon_window("quelle est la météo à Tours", today=MONDAY) is None
+    fields = _horizon_fields(None)
+    assert fields['horizon_extracted_info'] == HORIZON_NOT_FOUND_INFO
+    assert fields['horizon_extracted'] is None
+    # The status of a failed extraction is kept
+    assert _horizon_fields(None, status="Failed. Timeout")['horizon_extracted_info'] == "Failed. Timeout"
@@ -0,0 +1,149 @@
+"""
+Tests of the monitoring storage (f_service_db_storage) : batches of the background writer and keyset pagination
+of the reads, with a SQLite stand-in of the DB.
+"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import f_service_db_storage
+from f_service_db_storage import (MONITORING_COLUMNS, ConnectionPool, MonitoringWriter, insert_records,
+                                  read_monitoring_batches, set_connection_pool)
+
+
+# Function dedicated to replace the insert of the writer : the batches are recorded
+def recording_insert(batches, error=None):
+
+    def _insert(batch):
+        batches.append(list(batch))
+        if error is not None:
+            raise error
+        return len(batch)
+
+    return _insert
+
+
+def test_writer_flushes_full_batches():
+    batches = []
+    writer = MonitoringWriter(batch_size=2, flush_interval=0.2, insert=recording_insert(batches))
+    for record in range(5):
+        writer.put(record)
+    assert writer.flush(timeout=2)
+    assert batches == [[0, 1], [2, 3], [4]]
+    writer.close(timeout=2)
+
+
+def test_writer_flushes_after_the_interval():
+    batches = []
+    writer = MonitoringWriter(batch_size=100, flush_interval=0.1, insert=recording_insert(batches))
+    start = time.monotonic()
+    writer.put("record")
+    assert writer.flush(timeout=2)
+    assert 0.05 < time.monotonic() - start < 1
+    assert batches == [["record"]]
+    writer.close(timeout=2)
+
+
+def test_writer_drops_a_failed_batch():
+    batches = []
+    writer = MonitoringWriter(batch_size=2, flush_interval=0.05,
+                              insert=recording_insert(batches, error=sqlite3.OperationalError("database is locked")))
+    writer.put("record")
+    # The failed batch is not retried : the writer is not blocked on it
+    assert writer.flush(timeout=2)
+    assert writer.pending == 0
+    writer.close(timeout=2)
+
+
+def test_writer_close_flushes_without_waiting_for_the_interval():
+    batches = []
+    writer = MonitoringWriter(batch_size=100, flush_interval=30, insert=recording_insert(batches))
+    for record in range(3):
+        writer.put(record)
+    start = time.monotonic()
+    writer.close(timeout=5)
+    assert time.monotonic() - start < 1
+    assert not writer.thread.is_alive()
+    assert batches == [[0, 1, 2]]
+
+
+def test_writer_put_from_many_threads():
+    batches = []
+    writer = MonitoringWriter(batch_size=7, flush_interval=0.05, insert=recording_insert(batches))
+    threads = [threading.Thread(target=lambda: [writer.put(i) for i in range(50)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert writer.flush(timeout=5)
+    assert sorted(record for batch in batches for record in batch) == sorted(list(range(50)) * 4)
+    assert max(len(batch) for batch in batches) <= 7
+    writer.close(timeout=2)
+
+
+# SQLite stand-in of the DB, the pool of the process is given back after the test
+@pytest.fixture
+def sqlite_pool(tmp_path):
+
+    path = str(tmp_path / "monitoring.sqlite")
+    previous = f_service_db_storage._pool
+    pool = ConnectionPool(size=2, connect=lambda: sqlite3.connect(path, check_same_thread=False))
+    set_connection_pool(pool)
+    yield pool
+    pool.close()
+    set_connection_pool(previous)
+
+
+# Function dedicated to build a monitoring row with only a timestamp and statuses
+def monitoring_row(timestamp, text, weather_status="Successed"):
+    row = dict.fromkeys(MONITORING_COLUMNS)
+    row.update(timestamp=timestamp, speech_text=text, speech_status="Successed", weather_status=weather_status)
+    return tuple(row[column] for column in MONITORING_COLUMNS)
+
+
+# Rows inserted out of order, with rows without timestamp (tables migrated from the NVARCHAR timestamps)
+ROWS = [monitoring_row("2026-10-19 10:00:00", "a"),
+        monitoring_row(None, "null 1"),
+        monitoring_row("2026-10-19 09:00:00", "b", weather_status="Failed. Timeout"),
+        monitoring_row("2026-10-19 10:00:00", "c"),
+        monitoring_row(None, "null 2"),
+        monitoring_row("2026-10-19 10:00:00", "d", weather_status="Failed. Timeout"),
+        monitoring_row(None, "null 3"),
+        monitoring_row("2026-10-20 08:00:00", "e")]
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 3, 100])
+def test_keyset_pagination_across_null_timestamps(sqlite_pool, batch_size):
+    assert insert_records(ROWS) == len(ROWS)
+    batches = list(read_monitoring_batches(batch_size=batch_size))
+    assert all(len(batch) <= batch_size for batch in batches)
+
+    texts = [text for batch in batches for text in batch['speech_text']]
+    # Every row once, the rows without timestamp first, then by (timestamp, id)
+    assert texts == ["null 1", "null 2", "null 3", "b", "a", "c", "d", "e"]
+    ids = [row_id for batch in batches for row_id in batch['id']]
+    assert len(set(ids)) == len(ROWS)
+
+
+def test_filters_of_the_reads(sqlite_pool):
+    insert_records(ROWS)
+    failed = list(read_monitoring_batches(status={'weather_status': "Failed"}, batch_size=1))
+    assert [batch['speech_text'][0] for batch in failed] == ["b", "d"]
+
+    in_range = list(read_monitoring_batches(start="2026-10-19 10:00:00", end="2026-10-20", batch_size=2))
+    assert [text for batch in in_range for text in batch['speech_text']] == ["a", "c", "d"]
+
+    with pytest.raises(ValueError):
+        list(read_monitoring_batches(status={'speech_text': "a"}))
+
+
+def test_writer_with_the_database(sqlite_pool):
+    writer = MonitoringWriter(batch_size=3, flush_interval=0.05)
+    for row in ROWS:
+        writer.put(row)
+    assert writer.flush(timeout=5)
+    writer.close(timeout=2)
+    assert sum(len(batch) for batch in read_monitoring_batches()) == len(ROWS)
@@ -0,0 +1,159 @@
+"""
+Tests of the pipeline orchestrator (g_pipeline_orchestrator) : stages of a dependency graph run in parallel,
+a stage past its timeout or failing is replaced by its fallback, and the pipeline of the app skips the upstream
+services when the quality gate asks the user again. The services are replaced by stubs.
+"""
+
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+import c_service_ner
+from c_service_ner import HorizonWindow
+from g_pipeline_orchestrator import Stage, _time_left, run_pipeline, run_stages
+
+
+SPEECH = {'speech_text': "quelle est la météo à Tours demain", 'speech_info': "Successed"}
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        yield pool
+
+
+# Function dedicated to build a stage which sleeps, then returns its name and the start of its function
+def sleeping_stage(name, seconds, requires=(), timeout=None, background=False):
+
+    def _function(results):
+        start = time.perf_counter()
+        time.sleep(seconds)
+        return {'name': name, 'start': start}
+
+    return Stage(name, _function, requires, timeout, {'name': name, 'info': "Failed. Timeout"}, background)
+
+
+def test_independent_stages_run_in_parallel(executor):
+    stages = [sleeping_stage('a', 0.2), sleeping_stage('b', 0.2), sleeping_stage('c', 0.01, requires=('a', 'b'))]
+    start = time.perf_counter()
+    results, timings = run_stages(stages, executor=executor)
+    assert time.perf_counter() - start < 0.35
+    assert abs(results['a']['start'] - results['b']['start']) < 0.1
+    # A stage starts when its requirements are done
+    assert results['c']['start'] >= max(results['a']['start'], results['b']['start']) + 0.2
+    assert set(timings) == {'a', 'b', 'c'}
+
+
+def test_stage_past_its_timeout_gets_its_fallback(executor):
+    stages = [sleeping_stage('slow', 1, timeout=0.1), sleeping_stage('next', 0.01, requires=('slow',))]
+    start = time.perf_counter()
+    results, timings = run_stages(stages, executor=executor)
+    assert time.perf_counter() - start < 0.5
+    assert results['slow'] == {'name': 'slow', 'info': "Failed. Timeout"}
+    assert results['next']['name'] == 'next'
+    assert 0.1 <= timings['slow'] < 0.5
+
+
+def test_failing_stage_gets_its_fallback(executor):
+
+    def _fail(results):
+        raise ConnectionError("service down")
+
+    stages = [Stage('failing', _fail, (), 1, {'info': "Failed. Timeout"}, False)]
+    results, _ = run_stages(stages, executor=executor)
+    assert results['failing'] == {'info': "Failed. Timeout"}
+
+
+def test_deadline_starts_with_the_function():
+    # One worker : the second stage waits in the queue longer than its timeout, then runs within it
+    stages = [sleeping_stage('first', 0.2, timeout=1), sleeping_stage('queued', 0.05, timeout=0.15)]
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        results, _ = run_stages(stages, executor=pool)
+    assert results['queued']['name'] == 'queued'
+    assert 'info' not in results['queued']
+
+
+def test_time_left_is_passed_to_the_stage(executor):
+    stages = [Stage('timed', lambda results: _time_left(results, 'timed'), (), 2, None, False),
+              Stage('untimed', lambda results: _time_left(results, 'untimed'), (), None, None, False)]
+    results, _ = run_stages(stages, executor=executor)
+    assert 1.5 < results['timed'] <= 2
+    assert results['untimed'] is None
+
+
+def test_background_stage_is_not_awaited(executor):
+    stages = [sleeping_stage('a', 0.01), sleeping_stage('store', 0.3, requires=('a',), background=True)]
+    start = time.perf_counter()
+    results, timings = run_stages(stages, executor=executor)
+    assert time.perf_counter() - start < 0.25
+    assert isinstance(results['store'], Future)
+    assert results['store'].result()['name'] == 'store'
+    assert 'store' not in timings
+
+
+def test_unknown_requirement(executor):
+    with pytest.raises(ValueError):
+        run_stages([sleeping_stage('a', 0, requires=('missing',))], executor=executor)
+
+
+# Services of the pipeline replaced by stubs : each call is recorded with the start of the stub
+@pytest.fixture
+def services(monkeypatch):
+
+    calls = {}
+
+    def _extract_city(text):
+        calls['city'] = time.perf_counter()
+        time.sleep(0.2)
+        city = "Tours" if "Tours" in text else None
+        return {'city_extracted': city, 'city_extracted_info': "Successed"}
+
+    def _extract_horizon(text, timeout=None):
+        calls['horizon'] = time.perf_counter()
+        time.sleep(0.2)
+        return {'horizon_extracted': 2, 'horizon_extracted_info': "Successed", 'horizon_extracted_code': None,
+                'horizon_extracted_score': 1.0, 'horizon_extracted_window': HorizonWindow(1, 1)}
+
+    def _geocode(city, timeout=None):
+        calls['geocoding'] = (city, timeout)
+        return {'city': city, 'lat': 47.39, 'lon': 0.69, 'geocoding_info': "Successed"}
+
+    def _forecast(lat, lon, horizon, window, timeout=None):
+        calls['weather'] = (lat, lon, horizon, window, timeout)
+        return {'weather_info': "Successed"}
+
+    monkeypatch.setattr(c_service_ner, "extract_city", _extract_city)
+    monkeypatch.setattr(c_service_ner, "extract_horizon", _extract_horizon)
+    return calls, _geocode, _forecast
+
+
+def test_pipeline_runs_city_and_horizon_together(services, executor):
+    calls, geocode, forecast = services
+    start = time.perf_counter()
+    results = run_pipeline(speech=SPEECH, persist=False, executor=executor, session=str(uuid.uuid4()),
+                           geocode=geocode, forecast=forecast)
+    assert time.perf_counter() - start < 0.35
+    assert abs(calls['city'] - calls['horizon']) < 0.1
+    assert results['quality']['quality_decision'] == "proceed"
+    assert calls['geocoding'][0] == "Tours"
+    lat, lon, horizon, window, timeout = calls['weather']
+    assert (lat, lon, horizon, window) == (47.39, 0.69, 2, HorizonWindow(1, 1))
+    # The forecast gets the time left to the weather stage
+    assert 0 < timeout <= 20
+    assert results['weather'] == {'weather_info': "Successed"}
+    assert set(results['timings']) >= {'city', 'horizon', 'quality', 'geocoding', 'weather', 'total'}
+
+
+def test_pipeline_skips_the_services_on_reprompt(services, executor):
+    calls, geocode, forecast = services
+    speech = {'speech_text': "quel temps fera-t-il demain", 'speech_info': "Successed"}
+    results = run_pipeline(speech=speech, persist=False, executor=executor, session=str(uuid.uuid4()),
+                           geocode=geocode, forecast=forecast)
+    assert results['quality']['quality_decision'] == "reprompt"
+    assert results['geocoding']['geocoding_info'].startswith("Skipped")
+    assert results['weather']['weather_info'].startswith("Skipped")
+    assert 'geocoding' not in calls and 'weather' not in calls
+    # The horizon does not depend on the gate
+    assert results['horizon']['horizon_extracted'] == 2